@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark loading, filtering, searching and the API, writing the results as
+`JSON`.
+
+Usage: python benchmark.py [<data_path>] [options]
+"""
+import argparse
+
+from server.benchmark import BENCHMARKS, dump, run
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('data_path', nargs='?')
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--only', action='append',
+                        choices=[name for name, func in BENCHMARKS])
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--load-count', type=int, default=3)
+    parser.add_argument('--radius', type=float, default=2000)
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--columnar', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = run(
+        data_path=args.data_path,
+        names=args.only,
+        count=args.count,
+        load_count=args.load_count,
+        radius=args.radius,
+        limit=args.limit,
+        columnar=args.columnar,
+        seed=args.seed
+    )
+
+    print dump(results, args.output)
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+Compile the `CSV` files into a binary snapshot.
+
+Usage: python buildsnapshot.py <snapshot_path> [<data_path>]
+"""
+import sys
+
+from server.snapshot import build_snapshot
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.exit(__doc__.strip())
+
+    build_snapshot(*sys.argv[1:])
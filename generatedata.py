@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Write a synthetic data set of the `CSV` files, e.g. for the benchmarks.
+
+Usage: python generatedata.py <data_path> [options]
+"""
+import argparse
+
+from server.generator import DataGenerator
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('data_path')
+    parser.add_argument('--shops', type=int, default=10000)
+    parser.add_argument('--products', type=int, default=1000000)
+    parser.add_argument('--tags', type=int, default=26)
+    parser.add_argument('--tags-per-shop', type=float, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print DataGenerator(
+        shops=args.shops,
+        products=args.products,
+        tags=args.tags,
+        tags_per_shop=args.tags_per_shop,
+        seed=args.seed
+    ).write(args.data_path)
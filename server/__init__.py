@@ -1,4 +0,0 @@
-from server.utils import load_data
-
-# Loading the data in the beginning of tests
-load_data()
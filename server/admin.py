@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from flask import Blueprint, current_app, jsonify, request
+
+from server.decorators import admin_required
+from server.utils import get_version
+
+admin = Blueprint('admin', __name__)
+
+
+@admin.route('/admin/reload', methods=['POST'])
+@admin_required
+def reload_data():
+    """
+    Reload the data now, without waiting for the watcher of ``DATA_PATH``.
+
+    The data is read again only when the `CSV` files have changed, or
+    anyway with ``force=1``. It's read in the background by the
+    ``server.reload.DataReloader``, the request doesn't wait for it. The
+    response has the ``version`` of the current data and whether it's
+    ``reloading``, with ``202 Accepted`` when it is.
+    """
+    reloader = current_app.extensions['data_reloader']
+    force = request.args.get('force') == '1'
+    reloading = force or reloader.is_stale()
+
+    if reloading:
+        reloader.reload_in_background(force)
+
+    response = jsonify({'version': get_version(), 'reloading': reloading})
+    response.status_code = 202 if reloading else 200
+
+    return response
@@ -1,26 +1,88 @@
 # -*- coding: utf-8 -*-
 import logging
 import hashlib
+import itertools
+import json
+import math
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, request
 import flask
 
+from server import metrics
 from server.decorators import crossdomain
-from server.models import Products, ModelObjectManager, Tags, Taggings, Shops
-from server.search import Search
-from server.utils import get_cash, cache
+from server.models import Products, get_dataset
+from server.profiling import is_profiling
+from server.search import (MATCH_ALL, MATCH_ANY, METERS_PER_DEGREE, get_cell,
+                           get_search, get_tag_search)
+from server.utils import get_cache, get_cash, get_version
 
 api = Blueprint('api', __name__)
 
+# Formats of the streamed responses of ``search``
+STREAM_JSON = 'json'
+STREAM_NDJSON = 'ndjson'
+
+STREAM_MIMETYPES = {
+    STREAM_JSON: 'application/json',
+    STREAM_NDJSON: 'application/x-ndjson'
+}
+
 
 @api.route('/search', methods=['GET'])
 @crossdomain(origin='*')
+@metrics.timed('search_request_seconds')
 def search():
+    lat, lng, radius, limit, tags, match = get_search_args()
+    stream_format = request.args.get('stream')
+
+    if stream_format:
+        if stream_format not in STREAM_MIMETYPES:
+            flask.abort(400)
+
+        return stream_products(
+            search_shop_ids(lat, lng, radius, limit, tags, match),
+            limit,
+            stream_format
+        )
+
+    # The arguments are unicode, `JSON` encodes any of them as `ASCII`
+    args = sorted(request.args.items(multi=True))
+    ckey = 'search.{0}.{1}'.format(
+        get_version(),
+        hashlib.md5(json.dumps(args)).hexdigest()
+    )
+
+    def new_value():
+        return search_products(lat, lng, radius, limit, tags, match)
+
+    if is_profiling():
+        # Profiling a cached result would only show the cache lookup
+        result = new_value()
+    else:
+        # Searching on a miss is timed by its own stages too
+        with metrics.span('search_stage_seconds', stage='cache'):
+            result = get_cash(key=ckey, timeout=5 * 60, new_value=new_value)
+
+    with metrics.span('search_stage_seconds', stage='jsonify'):
+        return get_json_response(result)
+
+
+@metrics.timed('search_stage_seconds', stage='parse')
+def get_search_args():
+    """
+    Parse the arguments of ``search``, aborting the request when they're
+    not valid.
+
+    :returns: The ``lat``, ``lng``, ``radius``, ``count``, ``tags[]`` and
+        ``tags_match`` arguments.
+    :rtype: tuple
+    """
     lat = request.args.get('lat')
     lng = request.args.get('lng')
     tags = request.args.getlist('tags[]')
     radius = request.args.get('radius')
     limit = request.args.get('count')
+    match = request.args.get('tags_match', MATCH_ANY)
 
     required_params = [lat, lng]
     for param in required_params:
@@ -31,11 +93,18 @@ def search():
         lng = float(lng)
 
         if radius and radius not in ['', None]:
-            radius = float(float(radius) * 0.000621371)
+            radius = float(radius)
     except ValueError:
         logging.error('Error in casting position')
         flask.abort(400)
 
+    if not is_valid_number(lat) or not is_valid_number(lng):
+        flask.abort(400)
+
+    # Cells of the grid can't be computed for an infinite radius
+    if radius and not is_valid_number(radius, 0):
+        flask.abort(400)
+
     if limit and limit not in ['', None]:
         try:
             limit = int(limit)
@@ -44,54 +113,466 @@ def search():
     else:
         flask.abort(404)
 
-    ckey = hashlib.md5('.'.join(i for i in request.args.values())).hexdigest()
-    result = get_cash(ckey)
-    if result:
-        return jsonify(result)
-
-    taggings = []
-    invalid_tag_values = ['', None, [], u'', [''], [u'']]
-    if tags and tags not in invalid_tag_values and isinstance(tags, list):
-        tags = get_cash(
-            key='.'.join([i for i in tags]),
-            new_value=Tags().objects.filter({'tag__in': tags})
+    if match not in (MATCH_ANY, MATCH_ALL):
+        flask.abort(400)
+
+    return lat, lng, radius, limit, tags, match
+
+
+def is_valid_number(value, minimum=None):
+    """
+    :type value: float
+    :type minimum: float
+    :returns: Whether the ``value`` is finite, and not below the
+        ``minimum`` when it's given.
+    :rtype: bool
+    """
+    if math.isinf(value) or math.isnan(value):
+        return False
+
+    return minimum is None or value >= minimum
+
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Metrics of the process in the Prometheus text format, see
+    ``server.metrics``, with the counters of the cache when it keeps them.
+    """
+    counters = {}
+    cache = get_cache()
+
+    if hasattr(cache, 'get_stats'):
+        for namespace, stats in cache.get_stats().items():
+            for name in ('hits', 'misses', 'evictions'):
+                key = ('cache_{0}_total'.format(name),
+                       (('namespace', namespace), ))
+                counters[key] = stats[name]
+
+    return flask.Response(
+        metrics.registry.render(counters),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
+def search_products(lat, lng, radius, limit, tags, match=MATCH_ANY):
+    """
+    Return the most popular products of the shops around the location, see
+    ``search_shop_ids``.
+
+    :param radius: Radius in meters.
+    :param match: ``MATCH_ANY`` or ``MATCH_ALL`` of the ``tags``.
+    :type lat: float
+    :type lng: float
+    :type radius: float
+    :type limit: int
+    :type tags: list of str
+    :type match: str
+
+    :returns: The `JSON` of the ``products``.
+    :rtype: str
+    """
+    return get_products(
+        search_shop_ids(lat, lng, radius, limit, tags, match),
+        limit
+    )
+
+
+def search_shop_ids(lat, lng, radius, limit, tags, match=MATCH_ANY):
+    """
+    Return the ``id``s of the shops around the location to search the
+    ``limit`` products in.
+
+    With ``MATCH_ANY``, shops having any of the ``tags`` are searched and
+    unknown tags are ignored. With ``MATCH_ALL``, shops having all of them
+    are searched, by masking the shops of the whole k-d tree with the tag
+    bitsets, and an unknown tag matches no shops.
+
+    :param radius: Radius in meters.
+    :param match: ``MATCH_ANY`` or ``MATCH_ALL`` of the ``tags``.
+    :type lat: float
+    :type lng: float
+    :type radius: float
+    :type limit: int
+    :type tags: list of str
+    :type match: str
+
+    :rtype: list of str
+    """
+    # Points of one dataset are meaningless in another, the searches are
+    # of the same dataset even when it's reloaded meanwhile.
+    dataset = get_dataset()
+    search = get_search(dataset)
+    tag_search = get_tag_search(dataset)
+    grid_size = flask.current_app.config['SEARCH_GRID_SIZE']
+
+    tags = get_valid_tags(tags, match, dataset)
+
+    if grid_size and radius:
+        candidates = get_candidates(lat, lng, radius, tags, grid_size, match,
+                                    dataset)
+
+        def get_points(k):
+            return search.get_candidate_points(candidates, lat, lng, radius, k)
+    elif tags and match == MATCH_ANY:
+        def get_points(k):
+            return tag_search.get_points(tags, lat, lng, radius, k)
+    elif tags:
+        mask = tag_search.get_mask(tags, match)
+
+        def get_points(k):
+            return search.get_points(lat, lng, radius, k, mask=mask)
+    else:
+        def get_points(k):
+            return search.get_points(lat, lng, radius, k)
+
+    with metrics.span('search_stage_seconds', stage='spatial'):
+        if flask.current_app.config['SEARCH_ADAPTIVE']:
+            shop_ids = get_adaptive_shop_ids(get_points, limit, search=search)
+        else:
+            shop_ids = search.get_shop_ids(get_points(None))
+
+    metrics.inc('search_shops_returned_total', len(shop_ids))
+
+    return shop_ids
+
+
+@api.route('/search/batch', methods=['POST', 'OPTIONS'])
+@crossdomain(origin='*', headers=['Content-Type'])
+def search_batch():
+    """
+    Search many locations in one request, e.g. for backend jobs.
+
+    The request body is a `JSON` object of ``points``, a list of latitude
+    and longitude pairs, and the ``radius``, ``count``, ``tags`` and
+    ``tags_match`` shared by all of them. The response has the ``products``
+    of each point in ``results``, in the order of the points.
+    """
+    data = request.get_json(silent=True)
+
+    if not isinstance(data, dict):
+        flask.abort(400)
+
+    radius = data.get('radius')
+    tags = data.get('tags') or []
+    match = data.get('tags_match') or MATCH_ANY
+    points = data.get('points')
+
+    if not isinstance(points, list):
+        flask.abort(400)
+
+    # Before converting any of the points of a too large batch
+    if len(points) > flask.current_app.config['SEARCH_BATCH_MAX_POINTS']:
+        flask.abort(413)
+
+    if match not in (MATCH_ANY, MATCH_ALL):
+        flask.abort(400)
+
+    # A string would be searched as its characters
+    if (not isinstance(tags, list) or
+            not all(isinstance(i, basestring) for i in tags)):
+        flask.abort(400)
+
+    try:
+        points = [(float(lat), float(lng)) for lat, lng in points]
+        limit = int(data['count'])
+
+        if radius not in ['', None]:
+            radius = float(radius)
+    except (KeyError, TypeError, ValueError):
+        logging.error('Error in casting batch search')
+        flask.abort(400)
+
+    if not all(is_valid_number(i) for point in points for i in point):
+        flask.abort(400)
+
+    if radius not in ['', None] and not is_valid_number(radius, 0):
+        flask.abort(400)
+
+    return get_json_response(join_fragments(
+        'results',
+        search_products_many(points, radius, limit, tags, match)
+    ))
+
+
+def search_products_many(points, radius, limit, tags, match=MATCH_ANY):
+    """
+    Batch version of ``search_products``.
+
+    The shops in the ``radius`` of all the ``points`` are looked up with a
+    single query of the k-d tree, using ``SEARCH_N_JOBS`` processes, then
+    the products of each point are ranked. Results are not cached, since a
+    batch is unlikely to be repeated as a whole.
+
+    :param points: List of latitude and longitude degrees.
+    :param radius: Radius in meters.
+    :type points: list of tuple
+    :type radius: float
+    :type limit: int
+    :type tags: list of str
+    :type match: str
+
+    :returns: The `JSON` of the ``products`` of each point.
+    :rtype: list of str
+    """
+    dataset = get_dataset()
+    search = get_search(dataset)
+    tag_search = get_tag_search(dataset)
+    n_jobs = flask.current_app.config['SEARCH_N_JOBS']
+
+    tags = get_valid_tags(tags, match, dataset)
+
+    if tags and match == MATCH_ANY:
+        points = tag_search.query_many(tags, points, radius, None, n_jobs)
+    elif tags:
+        points = search.query_many(
+            points,
+            radius,
+            None,
+            n_jobs,
+            mask=tag_search.get_mask(tags, match)
         )
-        tag_ids = [i.id for i in tags] if tags else []
-        if tag_ids:
-            taggings = get_cash(
-                key=''.join(tag_ids),
-                new_value=Taggings().objects.filter({'tag_id__in': tag_ids})
-            )
-
-    if taggings:
-        shop_ids = [i.shop_id for i in taggings]
-        shops = get_cash(
-            key=hashlib.md5(''.join(shop_ids)).hexdigest(),
-            new_value=Shops().objects.filter({'id__in': shop_ids})
+    else:
+        points = search.query_many(points, radius, None, n_jobs)
+
+    return [get_products(search.get_shop_ids(i), limit) for i in points]
+
+
+def get_valid_tags(tags, match=MATCH_ANY, dataset=None):
+    """
+    Return the sorted unique ``tags`` to search, leaving out the empty ones.
+    Unknown tags are left out too with ``MATCH_ANY``, they can't match any
+    shop, but are kept with ``MATCH_ALL``, since no shop has all the tags.
+
+    The tags are known to the ``dataset``, the current one by default.
+
+    :type tags: list of str
+    :type match: str
+    :type dataset: server.models.Dataset
+    :rtype: list of str
+    """
+    tags = set(i for i in tags if i)
+
+    if match == MATCH_ANY:
+        tags &= set(get_tag_search(dataset).get_tags())
+
+    return sorted(tags)
+
+
+def get_products(shop_ids, limit):
+    """
+    Return the ``limit`` most popular products of the shops.
+
+    The `JSON` of each product, with its shop, is encoded once and then
+    joined into the responses as it is, see
+    ``ModelObjectManager.get_fragments``.
+
+    :type shop_ids: list of str
+    :type limit: int
+
+    :returns: The `JSON` of the ``products``.
+    :rtype: str
+    """
+    manager = Products().objects
+
+    with metrics.span('search_stage_seconds', stage='products'):
+        product_list = manager.merge('shop_id', shop_ids, limit)
+
+    metrics.inc('search_products_returned_total', len(product_list))
+
+    with metrics.span('search_stage_seconds', stage='serialize'):
+        return join_fragments(
+            'products',
+            manager.get_fragments(product_list, get_cache())
         )
+
+
+def stream_products(shop_ids, limit, stream_format):
+    """
+    Stream the ``limit`` most popular products of the shops, for clients
+    asking for many of them, e.g. exports.
+
+    Products are taken from the merge of ``Products`` a chunk of
+    ``SEARCH_STREAM_CHUNK_SIZE`` at a time and sent as soon as they're
+    encoded, so the first bytes are sent before the last products are
+    ranked and a request keeps one chunk in memory whatever the ``limit``.
+    Streamed responses are not cached, nor the fragments of their products
+    which are not cached yet.
+
+    :param stream_format: ``STREAM_JSON`` for the same `JSON` as
+        ``get_products`` sent in chunks, or ``STREAM_NDJSON`` for a line of
+        `JSON` for each product.
+    :type shop_ids: list of str
+    :type limit: int
+    :type stream_format: str
+    :rtype: flask.Response
+    """
+    chunks = iter_fragments(
+        Products().objects,
+        shop_ids,
+        limit,
+        flask.current_app.config['SEARCH_STREAM_CHUNK_SIZE']
+    )
+
+    if stream_format == STREAM_NDJSON:
+        content = ('\n'.join(i) + '\n' for i in chunks)
     else:
-        shops = get_cash(key='all_shops', new_value=Shops().objects.all())
+        content = iter_json_list('products', chunks)
+
+    return flask.Response(content,
+                          mimetype=STREAM_MIMETYPES[stream_format])
+
+
+def iter_fragments(manager, shop_ids, limit, chunk_size):
+    """
+    Iterate the `JSON` of the ``limit`` most popular products of the shops,
+    see ``ModelObjectManager.iter_merge``.
+
+    :type manager: server.models.ModelObjectManager
+    :type shop_ids: list of str
+    :type limit: int
+    :type chunk_size: int
+    :returns: Lists of up to ``chunk_size`` fragments.
+    :rtype: iterator of list
+    """
+    products = itertools.islice(manager.iter_merge('shop_id', shop_ids),
+                                max(limit, 0))
+
+    while True:
+        product_list = list(itertools.islice(products, chunk_size))
+        if not product_list:
+            return
+
+        metrics.inc('search_products_returned_total', len(product_list))
+
+        # Streams can be as large as the data, caching them would keep all
+        # of it encoded
+        yield manager.get_fragments(product_list, get_cache(), store=False)
+
+
+def iter_json_list(name, chunks):
+    """
+    Streamed version of ``join_fragments``.
+
+    :type name: str
+    :param chunks: Lists of the `JSON` of the items.
+    :type chunks: iterator of list
+    :rtype: iterator of str
+    """
+    yield '{{"{0}":['.format(name)
+
+    separator = ''
+    for fragments in chunks:
+        yield separator + ','.join(fragments)
+        separator = ','
+
+    yield ']}'
+
 
-    search = Search()
-    search.set_shops(shops)
+def join_fragments(name, fragments):
+    """
+    :param fragments: `JSON` of each of the items.
+    :type name: str
+    :type fragments: list of str
+    :returns: The `JSON` of an object with the list of the items as
+        ``name``.
+    :rtype: str
+    """
+    return '{{"{0}":[{1}]}}'.format(name, ','.join(fragments))
 
-    product_list = []
-    search.query(lat, lng, radius, 50)
-    shops = search.get_nearby_shops()
 
-    for shop in shops:
-        if len(product_list) >= limit:
-            break
+def get_json_response(content):
+    """
+    :param content: Encoded `JSON`.
+    :type content: str
+    :rtype: flask.Response
+    """
+    return flask.Response(content, mimetype='application/json')
 
-        product_list += get_cash(
-            key="shop_products.{0}".format(shop.id),
-            new_value=Products().objects.filter(
-                {'shop_id': shop.id},
-                ('popularity', ModelObjectManager.SORT_BY_DESCENDING)
-            )
+
+def get_adaptive_shop_ids(get_points, limit, k=8, search=None):
+    """
+    Return ``id``s of the nearest shops which have at least ``limit``
+    products, or all the shops in the radius when they don't.
+
+    The ``k`` nearest shops are looked up first and ``k`` is doubled until
+    they have enough products, instead of looking up all the shops in the
+    radius.
+
+    :param get_points: Callable returning the ``k`` nearest points.
+    :param search: The ``Search`` of the points, the current one by default.
+    :type get_points: callable
+    :type limit: int
+    :type k: int
+    :type search: server.search.Search
+
+    :rtype: list of str
+    """
+    search = search or get_search()
+    manager = Products().objects
+
+    while True:
+        shop_ids = search.get_shop_ids(get_points(k))
+        products = sum(
+            len(manager.get_index_pks({'shop_id__exact': i}))
+            for i in shop_ids
         )
 
-    result = {'products': [i.to_dict() for i in product_list[0:limit]]}
-    cache.set(ckey, result, timeout=5 * 60)
+        if products >= limit or len(shop_ids) < k:
+            return shop_ids
+
+        k *= 2
+
+
+def get_candidates(lat, lng, radius, tags, grid_size, match=MATCH_ANY,
+                   dataset=None):
+    """
+    Return positions of the shops which may be in the ``radius`` of the
+    location, cached for the cell of the grid that the location is in.
+
+    The candidates are the shops in the ``radius``, rounded up to the
+    ``grid_size``, of any location in the cell. Nearby requests share them
+    and only need to check the distance of the candidates. They're cached
+    for the version of the ``dataset``, the current one by default.
+
+    :type lat: float
+    :type lng: float
+    :param radius: Radius in meters.
+    :param grid_size: Size of the cells in degrees.
+    :type radius: float
+    :type tags: list of str
+    :type grid_size: float
+    :type match: str
+    :type dataset: server.models.Dataset
+
+    :rtype: numpy.ndarray
+    """
+    dataset = dataset or get_dataset()
+    cell = get_cell(lat, lng, grid_size)
+    cell_size = grid_size * METERS_PER_DEGREE
+    radius_cells = int(math.ceil(radius / cell_size))
+    key = 'candidates.{0}.{1!r}.{2}.{3}.{4}.{5}.{6}'.format(
+        dataset.version,
+        grid_size,
+        cell[0],
+        cell[1],
+        radius_cells,
+        match,
+        ','.join(tags)
+    )
+
+    def get_cell_candidates():
+        search = get_search(dataset)
+        candidates = search.get_candidates(
+            (cell[0] + 0.5) * grid_size,
+            (cell[1] + 0.5) * grid_size,
+            (radius_cells + math.sqrt(2) / 2) * cell_size
+        )
+
+        if tags:
+            mask = get_tag_search(dataset).get_mask(tags, match)
+            candidates = candidates[mask[candidates]]
+
+        return candidates
 
-    return jsonify(result)
+    return get_cash(key, timeout=5 * 60, new_value=get_cell_candidates)
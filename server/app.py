@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
+import logging
 import os
+import signal
+import tempfile
 
-from flask import Flask
+from flask import Flask, current_app
 
+from server import metrics
+from server.admin import admin
 from server.api import api
+from server.profiling import init_profiling
+from server.reload import DataReloader
+from server.snapshot import load_or_build_snapshot
+from server.utils import LRUCache, load_data, set_cache
 
 
 def create_app(settings_overrides=None):
     app = Flask(__name__)
     configure_settings(app, settings_overrides)
+    configure_cache(app)
+    configure_metrics(app)
+    configure_data(app)
     configure_blueprints(app)
+    configure_profiling(app)
     return app
 
 
@@ -19,11 +32,90 @@ def configure_settings(app, settings_override):
     app.config.update({
         'DEBUG': True,
         'TESTING': False,
-        'DATA_PATH': data_path
+        'DATA_PATH': data_path,
+        'DATA_RELOAD_INTERVAL': None,
+        'DATA_RELOAD_SIGNAL': None,
+        'SNAPSHOT_PATH': None,
+        'COLUMNAR': False,
+        'SEARCH_GRID_SIZE': None,
+        'SEARCH_ADAPTIVE': False,
+        'SEARCH_N_JOBS': 1,
+        'SEARCH_BATCH_MAX_POINTS': 1000,
+        'SEARCH_STREAM_CHUNK_SIZE': 100,
+        'CACHE': None,
+        'CACHE_MAX_SIZE': 64 * 1024 * 1024,
+        'CACHE_QUOTAS': {
+            'search': 48 * 1024 * 1024,
+            'fragments': 16 * 1024 * 1024
+        },
+        'METRICS_ENABLED': True,
+        'PROFILE_ENABLED': False,
+        'PROFILE_ENDPOINTS': ('api.search', 'api.search_batch'),
+        'PROFILE_SAMPLE_PERCENT': 0,
+        'PROFILE_DIR': os.path.join(tempfile.gettempdir(), 'profiles'),
+        'PROFILE_SORT': 'cumulative',
+        'PROFILE_TOP': 30,
+        'ADMIN_TOKEN': None
     })
     if settings_override:
         app.config.update(settings_override)
 
 
+def configure_cache(app):
+    cache = app.config['CACHE']
+
+    if cache is None:
+        cache = LRUCache(
+            app.config['CACHE_MAX_SIZE'],
+            app.config['CACHE_QUOTAS']
+        )
+
+    set_cache(cache)
+
+
+def configure_metrics(app):
+    metrics.registry.enabled = app.config['METRICS_ENABLED']
+
+
+def configure_data(app):
+    data_path = app.config['DATA_PATH']
+    snapshot_path = app.config['SNAPSHOT_PATH']
+
+    if snapshot_path:
+        load_or_build_snapshot(snapshot_path, data_path)
+    else:
+        load_data(data_path, app.config['COLUMNAR'])
+
+    reloader = DataReloader(data_path, snapshot_path, app.config['COLUMNAR'])
+    app.extensions['data_reloader'] = reloader
+
+    if app.config['DATA_RELOAD_INTERVAL']:
+        app.before_request(start_watching)
+
+    if app.config['DATA_RELOAD_SIGNAL']:
+        try:
+            signal.signal(
+                app.config['DATA_RELOAD_SIGNAL'],
+                reloader.handle_signal
+            )
+        except ValueError:
+            logging.error('Reload signal is only handled in the main thread')
+
+
+def start_watching():
+    """
+    Start polling the data for changes in the current process, see
+    ``DataReloader.start_watching``.
+    """
+    current_app.extensions['data_reloader'].start_watching(
+        current_app.config['DATA_RELOAD_INTERVAL']
+    )
+
+
+def configure_profiling(app):
+    init_profiling(app)
+
+
 def configure_blueprints(app):
     app.register_blueprint(api)
+    app.register_blueprint(admin)
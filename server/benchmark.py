@@ -0,0 +1,321 @@
+"""
+`server.benchmark`
+
+Repeatable benchmarks of the entry points of the app, reporting their
+throughput, latency percentiles and peak memory as `JSON`, so results of
+different versions can be compared.
+
+Each benchmark runs in a forked process of its own, so its peak memory isn't
+hidden by the peak of the benchmarks before it. Data is loaded from
+``data_path``, e.g. a data set written by ``server.generator``.
+
+* ``load``: ``server.utils.load_data``.
+* ``filter``: ``ModelObjectManager.filter`` of the products of a shop and of
+    the popular products.
+* ``set_shops``: Building the k-d tree with ``Search.set_shops``.
+* ``query``: ``Search.get_points`` of all the shops in the radius.
+* ``api``: ``GET /search`` through the test client, without the cache.
+"""
+import json
+import multiprocessing
+import platform
+import resource
+import time
+import traceback
+
+import numpy
+from werkzeug.contrib.cache import NullCache
+
+from server.models import Products, Shops
+from server.search import Search, get_search
+from server.utils import get_data_version, load_data
+
+# Percentiles of the latencies
+PERCENTILES = (50, 95, 99)
+
+
+def get_peak_memory():
+    """
+    :returns: Peak resident memory of the process in kilobytes.
+    :rtype: int
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(func, count):
+    """
+    Call ``func`` with the number of the call ``count`` times.
+
+    :type func: callable
+    :type count: int
+    :returns: Throughput, per second, and latency percentiles, in
+        milliseconds, of the calls.
+    :rtype: dict
+    """
+    latencies = []
+    started = time.time()
+
+    for i in xrange(count):
+        call_started = time.time()
+        func(i)
+        latencies.append(time.time() - call_started)
+
+    seconds = time.time() - started
+    latencies = numpy.array(latencies) * 1000
+    result = {
+        'count': count,
+        'seconds': seconds,
+        'throughput': count / seconds if seconds else None,
+        'latency_ms': dict(
+            ('p{0}'.format(i), numpy.percentile(latencies, i))
+            for i in PERCENTILES
+        )
+    }
+    result['latency_ms']['mean'] = latencies.mean()
+    result['latency_ms']['max'] = latencies.max()
+
+    return result
+
+
+def get_locations(count, seed=0):
+    """
+    :type count: int
+    :type seed: int
+    :returns: ``count`` locations next to random shops.
+    :rtype: list of tuple
+    """
+    random = numpy.random.RandomState(seed)
+    locations = get_search().get_locations()
+    offsets = random.standard_normal((count, 2)) * 0.005
+
+    return [
+        tuple(i) for i in
+        locations[random.randint(0, len(locations), count)] + offsets
+    ]
+
+
+def bench_load(options):
+    """
+    Reading the `CSV` files and building their indexes.
+
+    :type options: dict
+    :rtype: dict
+    """
+    return measure(
+        lambda i: load_data(options['data_path'], options['columnar']),
+        options['load_count']
+    )
+
+
+def bench_filter(options):
+    """
+    Filtering the products of random shops, an ``exact`` lookup of an
+    index, and the most popular products, a range lookup.
+
+    :type options: dict
+    :rtype: dict
+    """
+    load_data(options['data_path'], options['columnar'])
+    manager = Products().objects
+    shop_ids = get_search().shop_ids
+    random = numpy.random.RandomState(options['seed'])
+    shop_ids = shop_ids[random.randint(0, len(shop_ids), options['count'])]
+
+    return {
+        'shop_id': measure(
+            lambda i: manager.filter({'shop_id': shop_ids[i]}),
+            options['count']
+        ),
+        'popularity': measure(
+            lambda i: manager.filter({'popularity__gte': 0.99}),
+            min(options['count'], 100)
+        )
+    }
+
+
+def bench_set_shops(options):
+    """
+    Building the k-d tree of all the shops.
+
+    :type options: dict
+    :rtype: dict
+    """
+    load_data(options['data_path'], options['columnar'])
+    shops = Shops().objects.all()
+
+    return measure(
+        lambda i: Search().set_shops(shops),
+        options['load_count']
+    )
+
+
+def bench_query(options):
+    """
+    Looking up the shops in the radius of random locations.
+
+    :type options: dict
+    :rtype: dict
+    """
+    load_data(options['data_path'], options['columnar'])
+    search = get_search()
+    locations = get_locations(options['count'], options['seed'])
+    radius = options['radius']
+
+    return measure(
+        lambda i: search.get_points(locations[i][0], locations[i][1],
+                                    radius, None),
+        options['count']
+    )
+
+
+def bench_api(options):
+    """
+    Searching random locations through ``GET /search``, the cache is
+    disabled so every request is a miss.
+
+    :type options: dict
+    :rtype: dict
+    """
+    # Imported here, the app imports all of the benchmarked modules
+    from server.app import create_app
+
+    app = create_app(settings_overrides={
+        'DEBUG': False,
+        'DATA_PATH': options['data_path'],
+        'COLUMNAR': options['columnar'],
+        'CACHE': NullCache()
+    })
+    client = app.test_client()
+    locations = get_locations(options['count'], options['seed'])
+    urls = [
+        '/search?lat={0}&lng={1}&radius={2}&count={3}'.format(
+            lat,
+            lng,
+            options['radius'],
+            options['limit']
+        )
+        for lat, lng in locations
+    ]
+
+    return measure(lambda i: client.get(urls[i]), options['count'])
+
+
+BENCHMARKS = (
+    ('load', bench_load),
+    ('filter', bench_filter),
+    ('set_shops', bench_set_shops),
+    ('query', bench_query),
+    ('api', bench_api),
+)
+
+
+def run_isolated(func, options):
+    """
+    Run the benchmark in a forked process.
+
+    :type func: callable
+    :type options: dict
+    :returns: Result of the benchmark with the ``peak_memory_kb`` of its
+        process, or the ``error`` of it.
+    :rtype: dict
+    """
+    def target(connection):
+        try:
+            result = {'result': func(options)}
+        except Exception:
+            result = {'error': traceback.format_exc()}
+
+        result['peak_memory_kb'] = get_peak_memory()
+        connection.send(result)
+        connection.close()
+
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=target, args=(sender, ))
+    process.start()
+    sender.close()
+
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': 'Benchmark process exited with {0}'.format(
+            process.exitcode
+        )}
+
+    process.join()
+
+    return result
+
+
+def run(data_path=None, names=None, count=1000, load_count=3, radius=2000,
+        limit=50, columnar=False, seed=0, isolated=True):
+    """
+    Run the benchmarks.
+
+    :param names: Names of the benchmarks to run, all of ``BENCHMARKS`` by
+        default.
+    :param count: Number of the calls of each benchmark, ``load_count`` for
+        loading the data and building the k-d tree.
+    :param isolated: Running each benchmark in a process of its own.
+    :type data_path: str
+    :type names: list of str
+    :type count: int
+    :type load_count: int
+    :type radius: float
+    :type limit: int
+    :type columnar: bool
+    :type seed: int
+    :type isolated: bool
+    :returns: Results of the benchmarks with the versions of the data and
+        the platform they're run on.
+    :rtype: dict
+    """
+    options = {
+        'data_path': data_path,
+        'count': count,
+        'load_count': load_count,
+        'radius': radius,
+        'limit': limit,
+        'columnar': columnar,
+        'seed': seed
+    }
+    results = {}
+
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        if isolated:
+            results[name] = run_isolated(func, options)
+        else:
+            results[name] = {'result': func(options)}
+
+    return {
+        'created': time.time(),
+        'data_version': get_data_version(data_path),
+        'platform': {
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'machine': platform.machine(),
+            'cpus': multiprocessing.cpu_count()
+        },
+        'options': options,
+        'benchmarks': results
+    }
+
+
+def dump(results, file_name=None):
+    """
+    Write the results as `JSON` into ``file_name``, or return them when
+    it's not given.
+
+    :type results: dict
+    :type file_name: str
+    :rtype: str
+    """
+    content = json.dumps(results, indent=2, sort_keys=True)
+
+    if file_name:
+        with open(file_name, 'w') as outfile:
+            outfile.write(content)
+
+    return content
@@ -5,10 +5,13 @@ Decorator for the HTTP Access Control
 
 Source: http://flask.pocoo.org/snippets/56/
 """
+import hmac
 from datetime import timedelta
 from functools import update_wrapper
 
-from flask import make_response, request, current_app
+from flask import abort, make_response, request, current_app
+
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
 
 
 def crossdomain(origin=None, methods=None, headers=None,
@@ -51,3 +54,33 @@ def crossdomain(origin=None, methods=None, headers=None,
         f.provide_automatic_options = False
         return update_wrapper(wrapped_function, f)
     return decorator
+
+
+def is_admin():
+    """
+    :returns: Whether the request has the ``ADMIN_TOKEN`` of the app in its
+        ``X-Admin-Token`` header.
+    :rtype: bool
+    """
+    token = current_app.config.get('ADMIN_TOKEN')
+    given = request.headers.get(ADMIN_TOKEN_HEADER, '')
+
+    # Comparing in constant time, the token is a secret.
+    return bool(token) and hmac.compare_digest(str(given), str(token))
+
+
+def admin_required(f):
+    """
+    Allow the view only for the admin callers, see ``is_admin``. The view
+    doesn't exist when the app has no ``ADMIN_TOKEN``.
+    """
+    def wrapped_function(*args, **kwargs):
+        if not current_app.config.get('ADMIN_TOKEN'):
+            abort(404)
+
+        if not is_admin():
+            abort(403)
+
+        return f(*args, **kwargs)
+
+    return update_wrapper(wrapped_function, f)
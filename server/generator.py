@@ -0,0 +1,222 @@
+"""
+`server.generator`
+
+Synthetic data sets in the format of the `CSV` files in ``./data/``, of any
+size, for measuring how the app scales (see ``server.benchmark``).
+
+Shops are clustered around cities, each city has a weight for the share of
+the shops in it and a spread for how far its shops are from its center, so
+the density of the shops is like a real catalog: dense city centers and few
+shops in between. The number of products of a shop is skewed, most shops
+have a few products and a few shops have many.
+"""
+import csv
+import os
+from os.path import join
+
+import numpy
+
+from server.search import METERS_PER_DEGREE
+
+# Name, latitude, longitude, weight and spread in meters of the cities
+CITIES = (
+    ('Stockholm', 59.3293, 18.0686, 0.40, 4000),
+    ('Gothenburg', 57.7089, 11.9746, 0.20, 3500),
+    ('Malmo', 55.6050, 13.0038, 0.15, 3000),
+    ('Uppsala', 59.8586, 17.6389, 0.10, 2500),
+    ('Vasteras', 59.6099, 16.5448, 0.05, 2000),
+    ('Orebro', 59.2753, 15.2134, 0.05, 2000),
+    ('Linkoping', 58.4108, 15.6214, 0.05, 2000),
+)
+
+TAGS = (
+    'trousers', 'outerwear', 'shirts', 'plates', 'knitwear', 'knits',
+    'posters', 'men', 'scandinavian', 'underwear', 'sweaters', 'clothes',
+    'lights', 'cool', 'casual', 'tops', 'formal', 'fashion', 'kitchenware',
+    'livingroom', 'paintings', 'women', 'cutlery', 'accessories', 'kids',
+    'home',
+)
+
+# Rows written at once
+CHUNK_SIZE = 100000
+
+
+class DataGenerator(object):
+    """
+    DataGenerator
+
+    Writing ``shops.csv``, ``products.csv``, ``tags.csv`` and
+    ``taggings.csv`` with random data. The same ``seed`` generates the same
+    data.
+
+    Attributes:
+    ==========
+
+    * ``shops``: Number of the shops.
+    * ``products``: Number of the products, spread over the shops.
+    * ``tags``: Number of the tags, the names in ``TAGS`` are used first.
+    * ``tags_per_shop``: Average number of the tags of each shop.
+    * ``cities``: The cities of the shops, see ``CITIES``.
+    * ``random``: The ``numpy.random.RandomState`` of the data.
+    """
+    shops = None
+    products = None
+    tags = None
+    tags_per_shop = None
+    cities = None
+    random = None
+
+    def __init__(self, shops=10000, products=50000, tags=len(TAGS),
+                 tags_per_shop=3, cities=CITIES, seed=0):
+        """
+        :type shops: int
+        :type products: int
+        :type tags: int
+        :type tags_per_shop: float
+        :type cities: tuple
+        :type seed: int
+        """
+        self.shops = shops
+        self.products = products
+        self.tags = tags
+        self.tags_per_shop = tags_per_shop
+        self.cities = cities
+        self.random = numpy.random.RandomState(seed)
+
+    def get_ids(self, count):
+        """
+        :type count: int
+        :returns: ``count`` random hex ``id``s of 32 characters.
+        :rtype: list of str
+        """
+        return [self.random.bytes(16).encode('hex') for i in xrange(count)]
+
+    def get_tag_names(self):
+        """
+        :rtype: list of str
+        """
+        return [
+            TAGS[i] if i < len(TAGS) else 'tag{0}'.format(i)
+            for i in xrange(self.tags)
+        ]
+
+    def get_locations(self, count):
+        """
+        :type count: int
+        :returns: Latitudes and longitudes of ``count`` shops clustered
+            around the cities.
+        :rtype: tuple of numpy.ndarray
+        """
+        weights = numpy.array([i[3] for i in self.cities], dtype=float)
+        cities = self.random.choice(
+            len(self.cities),
+            size=count,
+            p=weights / weights.sum()
+        )
+        centers = numpy.array([i[1:3] for i in self.cities])[cities]
+        spreads = numpy.array([i[4] for i in self.cities])[cities]
+
+        # Offsets in meters around the centers, converted to degrees
+        offsets = self.random.standard_normal((count, 2))
+        offsets *= (spreads / METERS_PER_DEGREE)[:, None]
+        lat = centers[:, 0] + offsets[:, 0]
+        lng = centers[:, 1] + offsets[:, 1] / numpy.cos(numpy.radians(lat))
+
+        return lat, lng
+
+    def get_shop_weights(self):
+        """
+        :returns: Probabilities of a product being of each shop, skewed to
+            have a few shops with many of the products.
+        :rtype: numpy.ndarray
+        """
+        weights = self.random.pareto(1.5, size=self.shops) + 1
+
+        return weights / weights.sum()
+
+    def write(self, data_path):
+        """
+        Write the `CSV` files into ``data_path``.
+
+        :type data_path: str
+        :returns: Number of the rows of each file.
+        :rtype: dict
+        """
+        if not os.path.isdir(data_path):
+            os.makedirs(data_path)
+
+        shop_ids = self.get_ids(self.shops)
+        tag_ids = self.get_ids(self.tags)
+        lat, lng = self.get_locations(self.shops)
+
+        write_csv(
+            join(data_path, 'shops.csv'),
+            ('id', 'name', 'lat', 'lng'),
+            (
+                (shop_id, 'Shop {0}'.format(i), repr(lat[i]), repr(lng[i]))
+                for i, shop_id in enumerate(shop_ids)
+            )
+        )
+        write_csv(
+            join(data_path, 'tags.csv'),
+            ('id', 'tag'),
+            zip(tag_ids, self.get_tag_names())
+        )
+
+        tags_count = self.random.poisson(self.tags_per_shop, self.shops)
+        taggings = []
+
+        for i, shop_id in enumerate(shop_ids):
+            count = min(tags_count[i], self.tags)
+            for tag in self.random.choice(self.tags, count, replace=False):
+                taggings.append((shop_id, tag_ids[tag]))
+
+        write_csv(
+            join(data_path, 'taggings.csv'),
+            ('id', 'shop_id', 'tag_id'),
+            (
+                (tagging_id, shop_id, tag_id) for tagging_id, (shop_id, tag_id)
+                in zip(self.get_ids(len(taggings)), taggings)
+            )
+        )
+
+        weights = self.get_shop_weights()
+        rows = 0
+
+        with open(join(data_path, 'products.csv'), 'wb') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(('id', 'shop_id', 'title', 'popularity',
+                             'quantity'))
+
+            while rows < self.products:
+                count = min(CHUNK_SIZE, self.products - rows)
+                shops = self.random.choice(self.shops, count, p=weights)
+                popularity = self.random.beta(1.5, 1.5, count).round(3)
+                quantity = self.random.randint(0, 21, count)
+                writer.writerows(
+                    (product_id, shop_ids[shops[i]],
+                     'Product {0}'.format(rows + i), popularity[i],
+                     quantity[i])
+                    for i, product_id in enumerate(self.get_ids(count))
+                )
+                rows += count
+
+        return {
+            'shops': self.shops,
+            'products': self.products,
+            'tags': self.tags,
+            'taggings': len(taggings)
+        }
+
+
+def write_csv(file_name, header, rows):
+    """
+    :type file_name: str
+    :type header: tuple of str
+    :type rows: iterable
+    :rtype: None
+    """
+    with open(file_name, 'wb') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(header)
+        writer.writerows(rows)
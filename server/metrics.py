@@ -0,0 +1,449 @@
+"""
+`server.metrics`
+
+In-process metrics of the app: histograms of the time spent in each stage
+of a search and counters of the work done, exposed in the Prometheus text
+format by ``GET /metrics``.
+
+Recording is a lookup of the metric and a few additions under a lock, cheap
+enough to be left on in production, and nothing at all when the
+``registry`` is disabled (``METRICS_ENABLED``).
+"""
+import bisect
+import threading
+import time
+from functools import wraps
+
+# Upper bounds of the buckets of the histograms, in seconds
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# Quantiles of the histograms exposed next to their buckets
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Type and help of the known metrics
+METRICS = {
+    'search_request_seconds': (
+        'histogram', 'Time spent in the /search view.'),
+    'search_stage_seconds': (
+        'histogram', 'Time spent in each stage of the /search view.'),
+    'search_build_seconds': (
+        'histogram', 'Time spent building the k-d tree of the shops.'),
+    'search_query_seconds': (
+        'histogram', 'Time spent querying the k-d tree of the shops.'),
+    'search_shops_returned_total': (
+        'counter', 'Shops found around the searched locations.'),
+    'search_products_returned_total': (
+        'counter', 'Products returned by the searches.'),
+    'model_filter_seconds': (
+        'histogram', 'Time spent filtering the models.'),
+    'model_merge_seconds': (
+        'histogram', 'Time spent merging the sorted models of an index.'),
+    'model_rows_scanned_total': (
+        'counter', 'Rows checked by the filters and merges.'),
+    'cache_hits_total': ('counter', 'Cache hits of each namespace.'),
+    'cache_misses_total': ('counter', 'Cache misses of each namespace.'),
+    'cache_evictions_total': ('counter', 'Cache evictions of each namespace.'),
+}
+
+
+class Histogram(object):
+    """
+    Histogram
+
+    Counting the observed values in fixed ``buckets``, the quantiles are
+    estimated from them.
+
+    Attributes:
+    ==========
+
+    * ``buckets``: Upper bounds of the buckets, sorted.
+    * ``counts``: Number of the values of each bucket, not cumulative, the
+        last one is of the values above all of the ``buckets``.
+    * ``count``: Number of all the values.
+    * ``sum``: Sum of all the values.
+    """
+    buckets = None
+    counts = None
+    count = 0
+    sum = 0.0
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        :type buckets: tuple of float
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+
+    def observe(self, value):
+        """
+        :type value: float
+        :rtype: None
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_quantile(self, quantile):
+        """
+        Estimate the ``quantile`` by interpolating linearly in its bucket,
+        like Prometheus ``histogram_quantile``.
+
+        :type quantile: float
+        :rtype: float
+        """
+        if not self.count:
+            return None
+
+        rank = quantile * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i]
+
+                return lower + (upper - lower) * (rank - seen) / count
+
+            seen += count
+
+        return self.buckets[-1]
+
+    def get_cumulative_counts(self):
+        """
+        :returns: Upper bounds of the buckets, ``+Inf`` included, with the
+            number of the values up to each of them.
+        :rtype: list of tuple
+        """
+        bounds = [repr(i) for i in self.buckets] + ['+Inf']
+        counts = []
+        total = 0
+
+        for count in self.counts:
+            total += count
+            counts.append(total)
+
+        return zip(bounds, counts)
+
+
+class Span(object):
+    """
+    Span
+
+    Context manager observing its duration in a histogram of the
+    ``registry``.
+
+    Attributes:
+    ==========
+
+    * ``registry``: The ``Registry`` of the histogram.
+    * ``name``: Name of the histogram.
+    * ``labels``: Labels of the histogram.
+    * ``started``: Time the span was entered.
+    """
+    registry = None
+    name = None
+    labels = None
+    started = None
+
+    def __init__(self, registry, name, labels):
+        """
+        :type registry: Registry
+        :type name: str
+        :type labels: dict
+        """
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.registry.observe(
+            self.name,
+            time.time() - self.started,
+            **self.labels
+        )
+
+
+class NoopSpan(object):
+    """
+    NoopSpan
+
+    Span of a disabled ``Registry``, observing nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Registry(object):
+    """
+    Registry
+
+    Histograms and counters of the process, each one by its name and its
+    labels.
+
+    Attributes:
+    ==========
+
+    * ``enabled``: Recording the metrics, when it's not set recording them
+        does nothing.
+    * ``histograms``: A hash/dictionary of names and labels to their
+        ``Histogram``.
+    * ``counters``: A hash/dictionary of names and labels to their value.
+    """
+    enabled = True
+    histograms = None
+    counters = None
+
+    def __init__(self, enabled=True):
+        """
+        :type enabled: bool
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        :rtype: None
+        """
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def span(self, name, **labels):
+        """
+        Time a block into the histogram of ``name``:
+
+            with registry.span('search_stage_seconds', stage='parse'):
+                ...
+
+        :type name: str
+        :rtype: Span
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+
+        return Span(self, name, labels)
+
+    def observe(self, name, value, **labels):
+        """
+        :type name: str
+        :type value: float
+        :rtype: None
+        """
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        """
+        :type name: str
+        :type value: float
+        :rtype: None
+        """
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get_histogram(self, name, **labels):
+        """
+        :type name: str
+        :rtype: Histogram
+        """
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def get_counter(self, name, **labels):
+        """
+        :type name: str
+        :rtype: float
+        """
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render(self, counters=None):
+        """
+        Render the metrics in the Prometheus text format.
+
+        Histograms have their estimated ``QUANTILES`` too, as the gauges of
+        ``<name>_quantile``.
+
+        :param counters: Extra counters which aren't kept in the registry,
+            e.g. of the cache, a hash/dictionary of names and labels to their
+            value.
+        :type counters: dict
+        :rtype: str
+        """
+        with self._lock:
+            histograms = dict(
+                (key, (histogram.get_cumulative_counts(), histogram.sum,
+                       histogram.count,
+                       [histogram.get_quantile(i) for i in QUANTILES]))
+                for key, histogram in self.histograms.items()
+            )
+            counters = dict(self.counters.items() + (counters or {}).items())
+
+        lines = []
+
+        for name, series in sorted(group(histograms).items()):
+            add_header(lines, name, 'histogram')
+
+            for labels, (buckets, total, count, quantiles) in series:
+                for bound, value in buckets:
+                    lines.append(format_sample(
+                        name + '_bucket', labels + (('le', bound), ), value
+                    ))
+
+                lines.append(format_sample(name + '_sum', labels, total))
+                lines.append(format_sample(name + '_count', labels, count))
+
+            add_header(lines, name + '_quantile', 'gauge')
+
+            for labels, (buckets, total, count, quantiles) in series:
+                for quantile, value in zip(QUANTILES, quantiles):
+                    lines.append(format_sample(
+                        name + '_quantile',
+                        labels + (('quantile', repr(quantile)), ),
+                        value
+                    ))
+
+        for name, series in sorted(group(counters).items()):
+            add_header(lines, name, 'counter')
+
+            for labels, value in series:
+                lines.append(format_sample(name, labels, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def group(metrics):
+    """
+    :param metrics: A hash/dictionary of names and labels to their values.
+    :type metrics: dict
+    :returns: A hash/dictionary of names to their labels and values, sorted
+        by the labels.
+    :rtype: dict
+    """
+    grouped = {}
+
+    for (name, labels), value in metrics.items():
+        grouped.setdefault(name, []).append((labels, value))
+
+    return dict((k, sorted(v)) for k, v in grouped.items())
+
+
+def add_header(lines, name, default_type):
+    """
+    :type lines: list of str
+    :type name: str
+    :type default_type: str
+    :rtype: None
+    """
+    metric_type, description = METRICS.get(name, (default_type, None))
+
+    if description:
+        lines.append('# HELP {0} {1}'.format(name, description))
+
+    lines.append('# TYPE {0} {1}'.format(name, metric_type))
+
+
+def format_sample(name, labels, value):
+    """
+    :type name: str
+    :type labels: tuple of tuple
+    :type value: float
+    :rtype: str
+    """
+    if value is None:
+        value = 'NaN'
+    elif isinstance(value, float):
+        value = repr(value)
+
+    if not labels:
+        return '{0} {1}'.format(name, value)
+
+    return '{0}{{{1}}} {2}'.format(
+        name,
+        ','.join('{0}="{1}"'.format(k, escape(v)) for k, v in labels),
+        value
+    )
+
+
+def escape(value):
+    """
+    Escape a label value of the Prometheus text format.
+
+    :type value: str
+    :rtype: str
+    """
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+registry = Registry()
+
+
+def span(name, **labels):
+    """
+    Time a block into the histogram of ``name`` of the process ``registry``.
+
+    :type name: str
+    :rtype: Span
+    """
+    return registry.span(name, **labels)
+
+
+def inc(name, value=1, **labels):
+    """
+    Increment the counter of ``name`` of the process ``registry``.
+
+    :type name: str
+    :type value: float
+    :rtype: None
+    """
+    registry.inc(name, value, **labels)
+
+
+def timed(name, **labels):
+    """
+    Decorator timing each call of the function into the histogram of
+    ``name`` of the process ``registry``.
+
+    :type name: str
+    :rtype: callable
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            with registry.span(name, **labels):
+                return func(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
@@ -1,7 +1,131 @@
 import sys
+import heapq
+import itertools
+import json
 import operator
+from collections import defaultdict
+from functools import cmp_to_key
 
-from server import exceptions
+import numpy
+
+from server import exceptions, metrics
+from server.storage import (RANGE_LOOKUPS, ColumnarTable, ColumnIndex,
+                            SortedIndex)
+
+descending = cmp_to_key(lambda a, b: cmp(b, a))
+
+COLLECTIONS = (list, tuple, set, frozenset)
+
+# Seconds the encoded `JSON` of a model is cached for, it never changes for
+# a version of the data so it's only evicted by the size of the cache
+FRAGMENTS_TIMEOUT = 24 * 60 * 60
+
+
+def merge_groups(heap, sort_key, build):
+    """
+    Merge sorted groups of keys, one item from each group at a time.
+
+    :param heap: ``(sort key, number, position, end, keys)`` of each group,
+        the group is ``keys[position:end]`` and ``number`` breaks the ties
+        in the order of the groups.
+    :param sort_key: Callable of a key to its sort key.
+    :param build: Callable of a key to its model.
+    :type heap: list of tuple
+    :type sort_key: callable
+    :type build: callable
+    :rtype: iterator of Model
+    """
+    heapq.heapify(heap)
+
+    while heap:
+        key, number, position, end, keys = heap[0]
+        yield build(keys[position])
+
+        position += 1
+        if position < end:
+            heapq.heapreplace(
+                heap,
+                (sort_key(keys[position]), number, position, end, keys)
+            )
+        else:
+            heapq.heappop(heap)
+
+
+class Dataset(object):
+    """
+    Dataset
+
+    A version of the whole data with everything built from it. The data is
+    reloaded by building a new ``Dataset`` and setting it with
+    ``set_dataset``, one reference swapped at once, so requests never see
+    the tables of one version with the indexes of another.
+
+    Attributes:
+    ==========
+
+    * ``version``: Version of the data, e.g. derived from the `CSV` files it
+        is read from. Cached values depending on the data are keyed by it.
+    * ``raw_data`` Hold the whole data in, it acts as the database in memory.
+        Each set of data is kept with their unique ``id``, either as a
+        hash/dictionary of rows or as a ``server.storage.ColumnarTable``.
+    * ``indexes`` Hold the secondary indexes of ``raw_data``, for each model
+        name and each of its ``Model.indexed_fields`` there's a hash table
+        of field values to the list of ``id``s having that value.
+    * ``sorted_indexes`` Hold the ``server.storage.SortedIndex`` of each of
+        ``Model.sorted_fields`` for each model name, for range lookups.
+    * ``plans`` Hold the compiled ``QueryPlan``s of the filters, for each
+        model name and shape of the filters.
+    * ``search``: The ``server.search.Search`` of the shops, built on its
+        first use by ``server.search.get_search``.
+    * ``tag_search``: The ``server.search.TagSearch`` of the shops, built on
+        its first use by ``server.search.get_tag_search``.
+    """
+    version = None
+    raw_data = None
+    indexes = None
+    sorted_indexes = None
+    plans = None
+    search = None
+    tag_search = None
+
+    def __init__(self, raw_data=None, indexes=None, sorted_indexes=None,
+                 version=None):
+        """
+        :type raw_data: dict
+        :type indexes: dict
+        :type sorted_indexes: dict
+        :type version: str
+        """
+        self.version = version
+        self.raw_data = raw_data or {}
+        self.indexes = indexes or {}
+        self.sorted_indexes = sorted_indexes or {}
+        self.plans = {}
+
+
+_dataset = Dataset()
+
+
+def get_dataset():
+    """
+    :returns: The current ``Dataset`` of the process.
+    :rtype: Dataset
+    """
+    return _dataset
+
+
+def set_dataset(dataset):
+    """
+    Swap the current ``Dataset`` of the process. Managers created from now
+    on work on the new one, the ones already working on the previous
+    ``Dataset`` finish on it.
+
+    :type dataset: Dataset
+    :rtype: None
+    """
+    global _dataset
+
+    _dataset = dataset
 
 
 class ModelObjectManager(object):
@@ -31,23 +155,34 @@ class ModelObjectManager(object):
         * Lookup ``in`` is useful for passing a list or tuple into filter.
         * Lookup `exact` won't be used directly, is for internal usage of
         ``ModelObjectManager`` itself.
-    * ``raw_data`` Hold the whole data in, it acts as the database in memory.
-        Each set of data is kept with their unique ``id``.
+        * Lookups ``gt``, ``gte``, ``lt`` and ``lte`` compare the field with
+        the value and ``range`` takes a pair of the low and high values,
+        both included.
+    * ``dataset``: The ``Dataset`` the manager works on, the current one
+        when the manager is created. A manager keeps working on its
+        ``Dataset`` when a new one is set, so a filter never mixes the data
+        of two versions.
     * ``SORT_BY_ASCENDING`` Define ascending.
     * ``SORT_BY_DESCENDING`` Define defending.
     """
     model = None
     allowed_lookups = None
-    raw_data = {}
+    dataset = None
 
     SORT_BY_ASCENDING = 1
     SORT_BY_DESCENDING = 2
 
-    def __init__(self, model):
+    # Lookups that indexes cover, in the order of their selectivity
+    LOOKUP_RANKS = dict([('exact', 0), ('in', 1)] +
+                        [(i, 2) for i in RANGE_LOOKUPS])
+
+    def __init__(self, model, dataset=None):
         """
         :rtype: model
+        :type dataset: Dataset
         """
         self.model = model
+        self.dataset = dataset or get_dataset()
 
     def get_allowed_lookups(self):
         """
@@ -56,7 +191,12 @@ class ModelObjectManager(object):
         if not self.allowed_lookups:
             self.allowed_lookups = {
                 'in': self.filter_lookup_in,
-                'exact': self.filter_lookup_exact
+                'exact': self.filter_lookup_exact,
+                'gt': self.filter_lookup_gt,
+                'gte': self.filter_lookup_gte,
+                'lt': self.filter_lookup_lt,
+                'lte': self.filter_lookup_lte,
+                'range': self.filter_lookup_range
             }
 
         return self.allowed_lookups
@@ -65,7 +205,19 @@ class ModelObjectManager(object):
         """
         :rtype: dict
         """
-        return self.raw_data
+        return self.dataset.raw_data
+
+    def get_indexes(self):
+        """
+        :rtype: dict
+        """
+        return self.dataset.indexes.get(self.get_model_name(), {})
+
+    def get_sorted_indexes(self):
+        """
+        :rtype: dict
+        """
+        return self.dataset.sorted_indexes.get(self.get_model_name(), {})
 
     def get_model(self):
         """
@@ -79,6 +231,19 @@ class ModelObjectManager(object):
         """
         return self.model.__class__.__name__
 
+    def build_model(self, data):
+        """
+        Build a model of a row of the data, its relations are looked up in
+        the ``dataset`` of the manager, see ``Relation``.
+
+        :type data: dict
+        :rtype: Model
+        """
+        obj = self.model.__class__(**data)
+        obj._dataset = self.dataset
+
+        return obj
+
     @staticmethod
     def filter_lookup_in(data, attr, what):
         """
@@ -99,6 +264,62 @@ class ModelObjectManager(object):
         """
         return data[attr] == what
 
+    @staticmethod
+    def filter_lookup_gt(data, attr, what):
+        """
+        :type data: dict
+        :type attr: str
+        :type what: object
+
+        :rtype: bool
+        """
+        return data[attr] > what
+
+    @staticmethod
+    def filter_lookup_gte(data, attr, what):
+        """
+        :type data: dict
+        :type attr: str
+        :type what: object
+
+        :rtype: bool
+        """
+        return data[attr] >= what
+
+    @staticmethod
+    def filter_lookup_lt(data, attr, what):
+        """
+        :type data: dict
+        :type attr: str
+        :type what: object
+
+        :rtype: bool
+        """
+        return data[attr] < what
+
+    @staticmethod
+    def filter_lookup_lte(data, attr, what):
+        """
+        :type data: dict
+        :type attr: str
+        :type what: object
+
+        :rtype: bool
+        """
+        return data[attr] <= what
+
+    @staticmethod
+    def filter_lookup_range(data, attr, what):
+        """
+        :type data: dict
+        :type attr: str
+        :param what: Pair of the low and high values, both included.
+        :type what: tuple
+
+        :rtype: bool
+        """
+        return what[0] <= data[attr] <= what[1]
+
     @staticmethod
     def get_filter_lookup_type(lookup_filter):
         """
@@ -108,6 +329,266 @@ class ModelObjectManager(object):
         """
         return lookup_filter.split('__')[1]
 
+    @staticmethod
+    def build_indexes(model_data, fields, sort_by=None):
+        """
+        Build the secondary indexes of ``fields`` over the given data.
+
+        When ``sort_by`` is given, the list of ``id``s of each value is kept
+        sorted by it.
+
+        Indexes of a ``ColumnarTable`` are built as ``ColumnIndex`` arrays.
+
+        :type model_data: dict
+        :type fields: tuple of str
+        :type sort_by: tuple of str
+
+        :returns: Hash table of field names to hash tables of values to the
+            list of ``id``s having that value.
+        :rtype: dict
+        """
+        reverse = False
+        if sort_by:
+            reverse = sort_by[1] == ModelObjectManager.SORT_BY_DESCENDING
+
+        if isinstance(model_data, ColumnarTable):
+            sort_field = sort_by[0] if sort_by else None
+            return dict(
+                (i, ColumnIndex.build(model_data, i, sort_field, reverse))
+                for i in fields
+            )
+
+        indexes = dict((i, defaultdict(list)) for i in fields)
+
+        for pk, data in model_data.items():
+            for field_name in fields:
+                indexes[field_name][data[field_name]].append(pk)
+
+        if sort_by:
+            for index in indexes.values():
+                for pks in index.values():
+                    pks.sort(
+                        key=lambda pk: model_data[pk][sort_by[0]],
+                        reverse=reverse
+                    )
+
+        return dict((k, dict(v)) for k, v in indexes.items())
+
+    @staticmethod
+    def build_sorted_indexes(model_data, fields):
+        """
+        Build the ``server.storage.SortedIndex`` of ``fields`` over the given
+        data.
+
+        :type model_data: dict
+        :type fields: tuple of str
+        :rtype: dict
+        """
+        if isinstance(model_data, ColumnarTable):
+            return dict(
+                (i, SortedIndex.from_table(model_data, i)) for i in fields
+            )
+
+        return dict((i, SortedIndex.from_rows(model_data, i)) for i in fields)
+
+    def get_index_pks(self, filters):
+        """
+        Return ``id``s of the data which may match the ``filters`` by looking
+        them up in the indexes, ``id`` itself is always indexed.
+
+        Only ``exact`` lookups and ``in`` lookups with a list, tuple or set
+        are covered by indexes, and range lookups by sorted indexes.
+
+        :type filters: dict
+
+        :returns: List of ``id``s or ``None`` when no index covers filters.
+        :rtype: list of str
+        """
+        for k, v in filters.items():
+            attr, lookup_type = self.parse_lookup(k)
+            pks = self.get_lookup_pks(attr, lookup_type, v)
+
+            if pks is not None:
+                return pks
+
+        return None
+
+    def get_lookup_pks(self, attr, lookup_type, value):
+        """
+        Same as ``get_index_pks`` for a single lookup.
+
+        :type attr: str
+        :type lookup_type: str
+        :type value: object
+
+        :returns: List of ``id``s or ``None`` when no index covers the
+            lookup.
+        :rtype: list of str
+        """
+        indexes = self.get_indexes()
+        model_data = self.get_raw_data()[self.get_model_name()]
+        values = self.get_lookup_values(lookup_type, value)
+
+        if lookup_type in RANGE_LOOKUPS:
+            sorted_indexes = self.get_sorted_indexes()
+            if attr not in sorted_indexes:
+                return None
+
+            return sorted_indexes[attr].get_keys(lookup_type, value).tolist()
+
+        if values is None or (attr != 'id' and attr not in indexes):
+            return None
+
+        if attr == 'id':
+            return [i for i in values if i in model_data]
+
+        pks = []
+        for i in values:
+            pks += indexes[attr].get(i, [])
+
+        return pks
+
+    @staticmethod
+    def get_lookup_values(lookup_type, value):
+        """
+        :type lookup_type: str
+        :type value: object
+
+        :returns: Values that an index is looked up for, or ``None`` when
+            an index can't be used for the lookup.
+        :rtype: list
+        """
+        if lookup_type == 'exact':
+            return [value]
+        elif lookup_type == 'in' and isinstance(value, COLLECTIONS):
+            return set(value)
+
+        return None
+
+    def get_field_names(self):
+        """
+        :returns: Names of the fields of the data, including ``id``.
+        :rtype: list of str
+        """
+        model_data = self.get_raw_data()[self.get_model_name()]
+
+        if isinstance(model_data, ColumnarTable):
+            return model_data.get_field_names()
+
+        for pk in model_data:
+            return ['id'] + [i for i in model_data[pk] if i != 'id']
+
+        return list(self.get_model().fields)
+
+    def get_plan(self, filters, sort_by=None):
+        """
+        Return the ``QueryPlan`` of the shape of ``filters``, compiling it
+        on the first use of the shape.
+
+        :type filters: dict
+        :type sort_by: tuple of str
+        :raises exceptions.FieldDoesNotExist: If lookup field doesn't exist.
+        :raises exceptions.InvalidSortKey: If the sort key is not valid.
+        :raises exceptions.LookupIsNotAllowed: If lookup type is invalid.
+        :rtype: QueryPlan
+        """
+        key = (
+            self.get_model_name(),
+            tuple(sorted(filters)),
+            sort_by[0] if sort_by else None
+        )
+        plan = self.dataset.plans.get(key)
+
+        if plan is None:
+            plan = self.compile(filters, sort_by)
+            self.dataset.plans[key] = plan
+
+        return plan
+
+    def compile(self, filters, sort_by=None):
+        """
+        Compile the ``filters`` into a ``QueryPlan``.
+
+        The lookups are validated once, ordered by their estimated
+        selectivity, most selective first, and the index of the most
+        selective indexed lookup is chosen for finding the candidates.
+
+        :type filters: dict
+        :type sort_by: tuple of str
+        :raises exceptions.FieldDoesNotExist: If lookup field doesn't exist.
+        :raises exceptions.InvalidSortKey: If the sort key is not valid.
+        :raises exceptions.LookupIsNotAllowed: If lookup type is invalid.
+        :rtype: QueryPlan
+        """
+        field_names = self.get_field_names()
+        allowed_lookups = self.get_allowed_lookups()
+        indexes = self.get_indexes()
+        sorted_indexes = self.get_sorted_indexes()
+        total = len(self.get_raw_data()[self.get_model_name()])
+        lookups = []
+
+        if sort_by and sort_by[0] not in field_names:
+            raise exceptions.InvalidSortKey(sort_by[0])
+
+        for key in filters:
+            attr, lookup_type = self.parse_lookup(key)
+
+            if attr not in field_names:
+                raise exceptions.FieldDoesNotExist(attr)
+
+            if lookup_type not in allowed_lookups:
+                raise exceptions.LookupIsNotAllowed(lookup_type)
+
+            if attr == 'id':
+                rows = 1
+            elif attr in indexes:
+                rows = float(total) / max(len(indexes[attr]), 1)
+            else:
+                rows = total
+
+            rank = self.LOOKUP_RANKS.get(lookup_type, len(self.LOOKUP_RANKS))
+            lookups.append(((rank, rows), key, attr, lookup_type))
+
+        lookups.sort()
+        index_lookup = None
+
+        for i, (selectivity, key, attr, lookup_type) in enumerate(lookups):
+            if lookup_type in RANGE_LOOKUPS:
+                indexed = attr in sorted_indexes
+            else:
+                indexed = attr == 'id' or attr in indexes
+
+            if lookup_type in self.LOOKUP_RANKS and indexed:
+                index_lookup = i
+                break
+
+        return QueryPlan(
+            [(key, attr, lookup_type, allowed_lookups[lookup_type])
+             for selectivity, key, attr, lookup_type in lookups],
+            index_lookup
+        )
+
+    @classmethod
+    def clear_plans(cls):
+        """
+        Drop the compiled ``QueryPlan``s of the current ``Dataset``, e.g.
+        when its data is changed in place.
+
+        :rtype: None
+        """
+        get_dataset().plans.clear()
+
+    @staticmethod
+    def parse_lookup(lookup_filter):
+        """
+        :type lookup_filter: str
+        :returns: Field name and lookup type, ``exact`` by default.
+        :rtype: tuple of str
+        """
+        parts = lookup_filter.split('__')
+
+        return parts[0], parts[1] if len(parts) > 1 else 'exact'
+
     @staticmethod
     def sort_by(data_list, sort_by):
         """
@@ -123,64 +604,175 @@ class ModelObjectManager(object):
             reverse=sort_by[1] == ModelObjectManager.SORT_BY_DESCENDING
         )
 
-    def filter(self, filters, sort_by=None):
+    def filter(self, filters, sort_by=None, select_related=()):
         """
+        Return the models matching all of the ``filters``, see
+        ``get_plan``.
+
+        :param select_related: Names of the relations to resolve for all of
+            the models at once, see ``select_related``.
         :type filters: dict
         :type sort_by: tuple of str
+        :type select_related: tuple of str
         :raises exceptions.FieldDoesNotExist: If lookup field doesn't exist.
         :raises exceptions.InvalidSortKey: If the sort key is not valid.
         :raises exceptions.LookupIsNotAllowed: If lookup type is invalid.
         :rtype: list of Model
         """
-        data_list = []
-        raw_data = self.get_raw_data()
-        model = self.get_model()
         model_name = self.get_model_name()
-        model_data = raw_data[model_name]
-        allowed_lookups = self.get_allowed_lookups()
-        # Just to get field names
-        first_id = model_data.keys()[0]
-        first_row = model_data[first_id]
-        first_row['id'] = first_id
 
-        for fn in filters:
-            fn_key = fn.split('__')[0]
-            if fn_key not in first_row.keys():
-                raise exceptions.FieldDoesNotExist(fn_key)
+        with metrics.span('model_filter_seconds', model=model_name):
+            model_data = self.get_raw_data()[model_name]
+            plan = self.get_plan(filters, sort_by)
+            lookups = plan.get_lookups(filters)
 
-            if sort_by and sort_by[0] not in first_row.keys():
-                raise exceptions.InvalidSortKey(sort_by[0])
+            if isinstance(model_data, ColumnarTable):
+                data_list = self.filter_columns(model_data, plan, lookups)
+            else:
+                data_list = self.filter_rows(model_data, plan, lookups)
 
-            if not fn.endswith('__'):
-                filters['{0}__exact'.format(fn)] = filters.pop(fn)
+            if sort_by:
+                data_list = self.sort_by(data_list, sort_by)
 
-        for pk, data in model_data.items():
+            return self.select_related(data_list, select_related)
+
+    def filter_rows(self, model_data, plan, lookups):
+        """
+        Filter hash/dictionary rows with the lookups of the ``plan``, only
+        the candidates of its index are checked when it has one. Checking a
+        row stops at its first failing lookup.
+
+        :type model_data: dict
+        :type plan: QueryPlan
+        :param lookups: Lookups of the ``plan`` with their values, see
+            ``QueryPlan.get_lookups``.
+        :type lookups: list of tuple
+        :rtype: list of Model
+        """
+        model = self.get_model()
+        pks = None
+
+        if plan.index_lookup is not None:
+            attr, lookup_type, filter_lookup, value = lookups[
+                plan.index_lookup
+            ]
+            pks = self.get_lookup_pks(attr, lookup_type, value)
+
+        if pks is None:
+            rows = model_data.iteritems()
+        else:
+            rows = ((pk, model_data[pk]) for pk in pks)
+            lookups = [i for n, i in enumerate(lookups)
+                       if n != plan.index_lookup]
+
+        metrics.inc(
+            'model_rows_scanned_total',
+            len(model_data if pks is None else pks),
+            model=self.get_model_name()
+        )
+
+        data_list = []
+        for pk, data in rows:
             data['id'] = pk
-            row_matches = True
 
-            for k, v in filters.items():
-                lookup_type = self.get_filter_lookup_type(k)
-                attr = k.split('__')[0]
+            for attr, lookup_type, filter_lookup, value in lookups:
+                if not filter_lookup(data, attr, value):
+                    break
+            else:
+                data_list.append(self.build_model(data))
 
-                if lookup_type not in allowed_lookups:
-                    raise exceptions.LookupIsNotAllowed(lookup_type)
+        return data_list
 
-                filter_lookup = allowed_lookups[lookup_type]
+    def filter_columns(self, model_data, plan, lookups):
+        """
+        Filter a ``ColumnarTable`` with vectorized lookups over its columns,
+        only the matching rows are built as models.
 
-                if not filter_lookup(data, attr, v):
-                    row_matches = False
+        When the ``plan`` has an index, only the positions of its candidates
+        are checked.
 
-            if row_matches:
-                data_list.append(model.__class__(**data))
+        :type model_data: ColumnarTable
+        :type plan: QueryPlan
+        :param lookups: Lookups of the ``plan`` with their values, see
+            ``QueryPlan.get_lookups``.
+        :type lookups: list of tuple
+        :rtype: list of Model
+        """
+        model = self.get_model()
+        positions = None
+
+        if plan.index_lookup is not None:
+            attr, lookup_type, filter_lookup, value = lookups[
+                plan.index_lookup
+            ]
+            positions = self.get_lookup_positions(
+                model_data,
+                attr,
+                lookup_type,
+                value
+            )
+
+        if positions is not None:
+            lookups = [i for n, i in enumerate(lookups)
+                       if n != plan.index_lookup]
+
+        metrics.inc(
+            'model_rows_scanned_total',
+            len(model_data if positions is None else positions),
+            model=self.get_model_name()
+        )
 
-        if sort_by:
-            data_list = self.sort_by(data_list, sort_by)
+        positions = model_data.get_positions(
+            [(attr, lookup_type, value)
+             for attr, lookup_type, filter_lookup, value in lookups],
+            positions
+        )
 
-        return data_list
+        return [self.build_model(model_data.get_row(i)) for i in positions]
+
+    def get_lookup_positions(self, model_data, attr, lookup_type, value):
+        """
+        Same as ``get_lookup_pks`` but positions of the rows of a
+        ``ColumnarTable``.
+
+        :type model_data: ColumnarTable
+        :type attr: str
+        :type lookup_type: str
+        :type value: object
 
-    def all(self, sort_by=None):
+        :returns: Array of positions or ``None`` when no index covers the
+            lookup.
+        :rtype: numpy.ndarray
         """
+        indexes = self.get_indexes()
+        values = self.get_lookup_values(lookup_type, value)
+
+        if lookup_type in RANGE_LOOKUPS:
+            sorted_indexes = self.get_sorted_indexes()
+            if attr not in sorted_indexes:
+                return None
+
+            return sorted_indexes[attr].get_keys(lookup_type, value)
+
+        if values is None:
+            return None
+
+        if attr == 'id':
+            positions = [model_data.get_position(i) for i in values]
+            return numpy.array([i for i in positions if i is not None],
+                               dtype=int)
+
+        if isinstance(indexes.get(attr), ColumnIndex):
+            return indexes[attr].get_positions(values)
+
+        return None
+
+    def all(self, sort_by=None, select_related=()):
+        """
+        :param select_related: Names of the relations to resolve for all of
+            the models at once, see ``select_related``.
         :type sort_by: tuple of str
+        :type select_related: tuple of str
         :raises exceptions.InvalidSortKey: If the sort key is not valid.
         :rtype: list of Model
         """
@@ -190,7 +782,7 @@ class ModelObjectManager(object):
         data_list = []
         for pk, v in raw_data[self.get_model_name()].items():
             v['id'] = pk
-            data_list.append(model.__class__(**v))
+            data_list.append(self.build_model(v))
 
         if sort_by and sort_by[0] not in data_list[0].get_model_field_names():
             raise exceptions.InvalidSortKey(sort_by[0])
@@ -198,8 +790,284 @@ class ModelObjectManager(object):
         if sort_by:
             data_list = self.sort_by(data_list, sort_by)
 
+        return self.select_related(data_list, select_related)
+
+    def select_related(self, data_list, relations):
+        """
+        Resolve the ``relations`` of all the models in ``data_list`` in one
+        batch, instead of one lookup on the first access of each of them.
+
+        The related models are looked up with a single ``id__in`` filter and
+        each one is built once, models with the same related ``id`` share
+        it.
+
+        :type data_list: list of Model
+        :type relations: tuple of str
+        :raises exceptions.FieldDoesNotExist: If a relation doesn't exist.
+        :rtype: list of Model
+        """
+        model_class = self.get_model().__class__
+
+        for name in relations:
+            relation = getattr(model_class, name, None)
+            if not isinstance(relation, Relation):
+                raise exceptions.FieldDoesNotExist(name)
+
+            pks = set(getattr(i, relation.field_name) for i in data_list)
+            if not pks:
+                continue
+
+            manager = ModelObjectManager(relation.get_model()(), self.dataset)
+            related = dict(
+                (i.id, i) for i in manager.filter({'id__in': pks})
+            )
+
+            for obj in data_list:
+                pk = getattr(obj, relation.field_name)
+                if pk in related:
+                    setattr(obj, name, related[pk])
+
         return data_list
 
+    def get_fragments(self, data_list, cache=None, store=True):
+        """
+        Return the `JSON` of each of the models, like ``Model.to_dict`` with
+        the related models embedded.
+
+        The `JSON` of a model is encoded on its first use and kept in the
+        ``cache``, in ``fragments`` namespace for the version of the
+        ``Dataset``. The data of a version never changes, so a response is
+        assembled by joining the fragments of its models. Without a
+        ``cache`` they're encoded on every call, and without ``store`` the
+        cached ones are used but the missing ones are not cached, e.g. for
+        streaming many models. Related models are encoded once too and
+        embedded as they are, their relations are resolved in one batch for
+        the models not encoded yet.
+
+        :param cache: Cache bounding the memory of the fragments, e.g. a
+            ``server.utils.LRUCache`` with a quota for ``fragments``.
+        :type data_list: list of Model
+        :type cache: werkzeug.contrib.cache.BaseCache
+        :type store: bool
+        :rtype: list of str
+        """
+        prefix = 'fragments.{0}.{1}.'.format(self.dataset.version,
+                                             self.get_model_name())
+        keys = [prefix + i.id for i in data_list]
+        fragments = {}
+
+        if cache is not None and keys:
+            fragments = cache.get_dict(*keys)
+
+        missing = [i for i, key in zip(data_list, keys)
+                   if fragments.get(key) is None]
+
+        if missing:
+            relations = self.get_model().relations
+            self.select_related(missing, [i.get_name() for i in relations])
+
+            related = []
+            for relation in relations:
+                manager = ModelObjectManager(relation.get_model()(),
+                                             self.dataset)
+                related.append((relation.get_name(), manager.get_fragments(
+                    [getattr(i, relation.get_name()) for i in missing],
+                    cache,
+                    store
+                )))
+
+            for n, obj in enumerate(missing):
+                fields = json.dumps(
+                    dict(zip(obj.get_model_field_names(), obj.get_values())),
+                    sort_keys=True,
+                    separators=(',', ':')
+                )
+                fragments[prefix + obj.id] = fields[:-1] + ''.join(
+                    ',{0}:{1}'.format(json.dumps(name), values[n])
+                    for name, values in related
+                ) + '}'
+
+            if cache is not None and store:
+                cache.set_many(
+                    dict((prefix + i.id, fragments[prefix + i.id])
+                         for i in missing),
+                    FRAGMENTS_TIMEOUT
+                )
+
+        return [fragments[i] for i in keys]
+
+    def merge(self, field_name, values, count, select_related=()):
+        """
+        Return the first ``count`` models having one of ``values`` for the
+        indexed ``field_name``, sorted by ``Model.ordering``.
+
+        The lists of ``id``s of the index are already sorted by the
+        ``Model.ordering`` so they are merged with a heap, one item from each
+        list at a time, until ``count`` models are found. Only the returned
+        models are built.
+
+        :param select_related: Names of the relations to resolve for all of
+            the models at once, see ``select_related``.
+        :type field_name: str
+        :type values: list of str
+        :type count: int
+        :type select_related: tuple of str
+        :raises exceptions.FieldDoesNotExist: If the field is not indexed.
+        :rtype: list of Model
+        """
+        model_name = self.get_model_name()
+
+        with metrics.span('model_merge_seconds', model=model_name):
+            data_list = self.merge_index(field_name, values, count)
+            metrics.inc('model_rows_scanned_total', len(data_list),
+                        model=model_name)
+
+            return self.select_related(data_list, select_related)
+
+    def merge_index(self, field_name, values, count):
+        """
+        Merge the lists of ``id``s of the index of ``field_name``, see
+        ``merge``.
+
+        :type field_name: str
+        :type values: list of str
+        :type count: int
+        :raises exceptions.FieldDoesNotExist: If the field is not indexed.
+        :rtype: list of Model
+        """
+        return list(itertools.islice(
+            self.iter_merge(field_name, values),
+            max(count, 0)
+        ))
+
+    def iter_merge(self, field_name, values):
+        """
+        Iterate the models having one of ``values`` for the indexed
+        ``field_name`` sorted by ``Model.ordering``, like ``merge`` without
+        a ``count``. Each model is built when it's reached, so they can be
+        consumed one chunk at a time, e.g. by a streamed response.
+
+        :type field_name: str
+        :type values: list of str
+        :raises exceptions.FieldDoesNotExist: If the field is not indexed.
+        :rtype: iterator of Model
+        """
+        indexes = self.get_indexes()
+        model_data = self.get_raw_data()[self.get_model_name()]
+
+        if field_name not in indexes:
+            raise exceptions.FieldDoesNotExist(field_name)
+
+        if isinstance(indexes[field_name], ColumnIndex):
+            return self.merge_columns(model_data, indexes[field_name], values)
+
+        return self.merge_rows(model_data, indexes[field_name], values)
+
+    def merge_rows(self, model_data, index, values):
+        """
+        Merge the lists of ``id``s of a hash/dictionary index, see
+        ``iter_merge``.
+
+        :type model_data: dict
+        :type index: dict
+        :type values: list of str
+        :rtype: iterator of Model
+        """
+        model = self.get_model()
+        ordering = model.ordering
+
+        def sort_key(pk):
+            if not ordering:
+                return None
+
+            value = model_data[pk][ordering[0]]
+            if ordering[1] == self.SORT_BY_DESCENDING:
+                return descending(value)
+
+            return value
+
+        def build(pk):
+            data = model_data[pk]
+            data['id'] = pk
+            return self.build_model(data)
+
+        heap = []
+        for i, value in enumerate(values):
+            pks = index.get(value)
+            if pks:
+                heap.append((sort_key(pks[0]), i, 0, len(pks), pks))
+
+        return merge_groups(heap, sort_key, build)
+
+    def merge_columns(self, model_data, index, values):
+        """
+        Merge the groups of positions of a ``ColumnIndex``, see
+        ``iter_merge``.
+
+        The groups are found at once and the rows are compared by the values
+        of the ordering column, negated for the descending order, instead of
+        building a row for each comparison. Codes of categorical columns
+        are in the order of their values, so they're compared as they are.
+
+        :type model_data: ColumnarTable
+        :type index: ColumnIndex
+        :type values: list of str
+        :rtype: iterator of Model
+        """
+        model = self.get_model()
+        ordering = model.ordering
+        positions = index.positions
+        codes = index.get_codes(values)
+        starts = index.offsets[codes]
+        ends = index.offsets[codes + 1]
+
+        if not ordering:
+            column, sign = None, 0
+        elif ordering[1] == self.SORT_BY_DESCENDING:
+            column, sign = model_data.columns[ordering[0]], -1
+        else:
+            column, sign = model_data.columns[ordering[0]], 1
+
+        def get_values(rows):
+            return rows if column is None else column[rows]
+
+        def sort_key(position):
+            return sign * get_values(position).item()
+
+        def build(position):
+            return self.build_model(model_data.get_row(position))
+
+        keys = (get_values(positions[starts]) * sign).tolist()
+        heap = [
+            (key, i, start, end, positions) for i, (key, start, end) in
+            enumerate(zip(keys, starts.tolist(), ends.tolist()))
+        ]
+
+        return merge_groups(heap, sort_key, build)
+
+    def values_list(self, *fields):
+        """
+        Return the values of given ``fields`` for all the data, without
+        building any ``Model`` for them.
+
+        :type fields: tuple of str
+        :raises exceptions.FieldDoesNotExist: If a field doesn't exist.
+        :rtype: list of tuple
+        """
+        model_data = self.get_raw_data()[self.get_model_name()]
+        values = []
+
+        for pk, data in model_data.items():
+            data['id'] = pk
+
+            for field_name in fields:
+                if field_name not in data:
+                    raise exceptions.FieldDoesNotExist(field_name)
+
+            values.append(tuple(data[i] for i in fields))
+
+        return values
+
     def get(self, pk):
         """
         Return object by given `id`.
@@ -219,39 +1087,268 @@ class ModelObjectManager(object):
         obj = model_raw_data[pk]
         obj['id'] = pk
 
-        return model.__class__(**obj)
+        return self.build_model(obj)
+
+
+class QueryPlan(object):
+    """
+    QueryPlan
+
+    Filters compiled by ``ModelObjectManager.compile``. A plan depends only
+    on the shape of the filters, their field names and lookup types, so
+    it's compiled once and used again for any values of the same filters.
+
+    Attributes:
+    ==========
+
+    * ``lookups``: List of ``(key, field_name, lookup_type, filter_lookup)``
+        of the filters, ordered by their selectivity, most selective first.
+    * ``index_lookup``: Position of the lookup in ``lookups`` that its index
+        is used for finding the candidates, ``None`` when no index covers
+        any of them.
+    """
+    lookups = None
+    index_lookup = None
+
+    def __init__(self, lookups, index_lookup=None):
+        """
+        :type lookups: list of tuple
+        :type index_lookup: int
+        """
+        self.lookups = lookups
+        self.index_lookup = index_lookup
+
+    def get_lookups(self, filters):
+        """
+        Bind the values of ``filters`` to the lookups, the values of ``in``
+        lookups are converted to sets.
+
+        :type filters: dict
+        :returns: List of ``(field_name, lookup_type, filter_lookup,
+            value)``.
+        :rtype: list of tuple
+        """
+        lookups = []
+
+        for key, attr, lookup_type, filter_lookup in self.lookups:
+            value = filters[key]
+
+            if lookup_type == 'in' and isinstance(value, COLLECTIONS):
+                try:
+                    value = frozenset(value)
+                except TypeError:
+                    pass
+
+            lookups.append((attr, lookup_type, filter_lookup, value))
+
+        return lookups
+
+
+class ManagerDescriptor(object):
+    """
+    ManagerDescriptor
+
+    Keeping one ``ModelObjectManager`` per ``Model`` class, created on its
+    first access, instead of one for each model instance. The manager is
+    created again when a new ``Dataset`` is set.
+
+    Attributes:
+    ==========
+
+    * ``managers``: A hash/dictionary of ``Model`` classes to their manager.
+    """
+    managers = None
+
+    def __init__(self):
+        self.managers = {}
+
+    def __get__(self, instance, owner):
+        """
+        :type instance: Model
+        :type owner: type
+        :rtype: ModelObjectManager
+        """
+        manager = self.managers.get(owner)
+
+        if manager is None or manager.dataset is not get_dataset():
+            manager = ModelObjectManager(owner())
+            self.managers[owner] = manager
+
+        return manager
+
+
+class Relation(object):
+    """
+    Relation
+
+    Related model of a ``<name>_id`` field, set on the model class as
+    ``<name>``.
+
+    The related model is looked up on the first access of the attribute and
+    kept on the model instance, so the relations that are never read cost
+    nothing. It's looked up in the ``Dataset`` that the model has been built
+    from, even when another one is the current one by then.
+    ``ModelObjectManager.select_related`` sets them for many models at once.
+
+    Attributes:
+    ==========
+
+    * ``field_name``: Name of the field keeping the related ``id``.
+    * ``model_name``: Name of the related model, by default the plural of
+        the field name without ``_id``, e.g. ``Shops`` for ``shop_id``.
+    """
+    field_name = None
+    model_name = None
+
+    def __init__(self, field_name, model_name=None):
+        """
+        :type field_name: str
+        :type model_name: str
+        """
+        self.field_name = field_name
+        self.model_name = model_name or '{0}s'.format(
+            field_name[:-len('_id')].capitalize()
+        )
+
+    def get_name(self):
+        """
+        :returns: Name of the attribute on the model.
+        :rtype: str
+        """
+        return self.field_name[:-len('_id')]
+
+    def get_cache_name(self):
+        """
+        :returns: Name of the attribute keeping the related model once it's
+            looked up.
+        :rtype: str
+        """
+        return '_{0}'.format(self.get_name())
+
+    def get_model(self):
+        """
+        :rtype: type
+        """
+        return getattr(sys.modules[__name__], self.model_name)
+
+    def __get__(self, instance, owner):
+        """
+        :type instance: Model
+        :type owner: type
+        :raises exceptions.ObjectDoesNotExist: If the related model doesn't
+            exist.
+        :rtype: Model
+        """
+        if instance is None:
+            return self
+
+        related = getattr(instance, self.get_cache_name(), None)
+
+        if related is None:
+            # Models of a previous dataset keep reading from it
+            manager = ModelObjectManager(
+                self.get_model()(),
+                getattr(instance, '_dataset', None)
+            )
+            related = manager.get(getattr(instance, self.field_name))
+            self.__set__(instance, related)
+
+        return related
+
+    def __set__(self, instance, value):
+        """
+        :type instance: Model
+        :type value: Model
+        """
+        setattr(instance, self.get_cache_name(), value)
+
+
+class ModelMeta(type):
+    """
+    ModelMeta
+
+    Collecting the ``Relation``s of the models and building the models that
+    declare their ``schema`` as compact rows: ``__slots__`` of their fields
+    and the related models, instead of a ``__dict__`` for each instance.
+    """
+    def __new__(mcs, name, bases, attrs):
+        relations = [i for i in attrs.values() if isinstance(i, Relation)]
+        for base in bases:
+            relations += getattr(base, 'relations', ())
+        attrs['relations'] = tuple(relations)
+
+        if attrs.get('schema'):
+            fields = [i[0] for i in attrs['schema']]
+            attrs['fields'] = fields
+            attrs['values_getter'] = operator.attrgetter(*fields)
+            attrs['__slots__'] = tuple(fields) + tuple(
+                i.get_cache_name() for i in relations
+            ) + ('_dataset', )
+
+        return type.__new__(mcs, name, bases, attrs)
 
 
 class Model(object):
     """
     Model
 
-    Keeping the data that being hold in ``ModelObjectManager.raw_data``
+    Keeping the data that being hold in ``Dataset.raw_data``
     as models.
 
-    ``Model`` can access the data in ``ModelObjectManager.raw_data`` through
+    ``Model`` can access the data in ``Dataset.raw_data`` through
     ``Model.object`` attribute.
 
     On the initializer of ``Model`` attributes will be set and can be
     treated as model fields. ``fields`` that that are ending with ``_id``
-    are considered as relational keys and the related model would be set
-    on th model.
+    are considered as relational keys, the related model is available on
+    the model through the ``Relation`` declared for them.
+
+    ``schema`` declares the fields of the model and their types, like
+    ``(('id', str), ('lat', float))``. The `CSV` values are converted to
+    these types once, when the data is loaded, and the model instances keep
+    only these fields in ``__slots__``. Models without a ``schema`` take any
+    field they're given.
+
+    ``indexed_fields`` declares the fields that ``ModelObjectManager`` keeps
+    secondary indexes for, ``exact`` and ``in`` lookups on them won't scan
+    the whole data. ``sorted_fields`` declares the fields that it keeps
+    sorted indexes for, range lookups on them are done by binary search.
+    ``ordering`` is a sort key like ``(<field_name>,
+    ModelObjectManager.SORT_BY_DESCENDING)`` that the indexes are kept
+    sorted by.
     """
-    objects = None
+    __metaclass__ = ModelMeta
+    __slots__ = ()
+
+    objects = ManagerDescriptor()
     fields = []
+    schema = ()
+    relations = ()
+    values_getter = None
+    indexed_fields = ()
+    sorted_fields = ()
+    ordering = None
 
     def __init__(self, *args, **kwargs):
-        self.objects = ModelObjectManager(self)
-        self.fields = kwargs.keys()
+        if not self.schema:
+            self.fields = kwargs.keys()
 
         for k, v in kwargs.items():
             setattr(self, k, v)
 
-            if k.endswith('_id'):
-                re_model_name = k.replace('_id', '')
-                rel_model_class = getattr(sys.modules[__name__],
-                                          '{0}s'.format(re_model_name.capitalize()))
-                setattr(self, re_model_name, rel_model_class().objects.get(pk=v))
+    @classmethod
+    def to_python(cls, row):
+        """
+        Convert the values of a row, as it's read from the `CSV` files, to
+        the types of the ``schema``.
+
+        :type row: dict
+        :rtype: dict
+        """
+        types = dict(cls.schema)
+
+        return dict((k, types[k](v) if k in types else v)
+                    for k, v in row.items())
 
     def get_model_field_names(self):
         """
@@ -265,16 +1362,30 @@ class Model(object):
         """
         return self.__class__.__name__
 
+    def get_values(self):
+        """
+        :returns: Values of the fields, in the order of
+            ``get_model_field_names``.
+        :rtype: tuple
+        """
+        fields = self.get_model_field_names()
+
+        if self.values_getter is None or len(fields) == 1:
+            return tuple(getattr(self, i) for i in fields)
+
+        return self.values_getter(self)
+
     def to_dict(self):
         """
         :rtype: dict
         """
-        dictator = {}
-        for field_name in self.get_model_field_names():
-            dictator[field_name] = getattr(self, field_name)
-            if field_name.endswith('_id'):
-                field_name = field_name.replace('_id', '')
-                dictator[field_name] = getattr(self, field_name).to_dict()
+        dictator = dict(zip(self.get_model_field_names(), self.get_values()))
+
+        for relation in self.relations:
+            dictator[relation.get_name()] = getattr(
+                self,
+                relation.get_name()
+            ).to_dict()
 
         return dictator
 
@@ -292,18 +1403,43 @@ class Model(object):
 
 
 class Products(Model):
-    pass
+    schema = (
+        ('id', str),
+        ('shop_id', str),
+        ('title', str),
+        ('popularity', float),
+        ('quantity', int)
+    )
+    shop = Relation('shop_id')
+    indexed_fields = ('shop_id', )
+    sorted_fields = ('popularity', 'quantity')
+    ordering = ('popularity', ModelObjectManager.SORT_BY_DESCENDING)
 
 
 class Shops(Model):
-    pass
+    schema = (
+        ('id', str),
+        ('name', str),
+        ('lat', float),
+        ('lng', float)
+    )
+    sorted_fields = ('lat', 'lng')
 
 
 class Tags(Model):
-    pass
+    schema = (
+        ('id', str),
+        ('tag', str)
+    )
+    indexed_fields = ('tag', )
 
 
 class Taggings(Model):
-    pass
-
-
+    schema = (
+        ('id', str),
+        ('shop_id', str),
+        ('tag_id', str)
+    )
+    shop = Relation('shop_id')
+    tag = Relation('tag_id')
+    indexed_fields = ('shop_id', 'tag_id')
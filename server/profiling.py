@@ -0,0 +1,204 @@
+"""
+`server.profiling`
+
+Profiling requests in place with ``cProfile``, e.g. a slow query shape,
+without redeploying.
+
+The hook is opt-in, with ``PROFILE_ENABLED`` set the requests of
+``PROFILE_ENDPOINTS`` are profiled when:
+
+* They're sampled, ``PROFILE_SAMPLE_PERCENT`` percent of the requests.
+* An admin caller (see ``server.decorators.is_admin``) asks for it with the
+    ``X-Profile`` header. ``X-Profile: inline`` returns the summary of the
+    profile as the response instead of the response of the view.
+
+A profiled search is run without the cache of its results (see
+``is_profiling``), so the profile shows the search and not a cache lookup.
+Streamed responses (``GET /search?stream=...``) are sent after the request
+hooks have run, so only their parsing and the start of the stream are
+profiled, not the products encoded while streaming.
+
+Profiles are dumped into ``PROFILE_DIR`` as ``.pstats`` files, readable by
+``pstats.Stats``, with a ``.txt`` summary of the ``PROFILE_TOP`` functions
+sorted by ``PROFILE_SORT``. The ``X-Profile-Path`` header of the response
+points to the dump for admin callers only. When the hook is off nothing is
+registered on the app, so it costs nothing.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import random
+import time
+from cStringIO import StringIO
+
+import flask
+from flask import g, request
+
+from server.decorators import is_admin
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PATH_HEADER = 'X-Profile-Path'
+
+# Values of the header
+PROFILE_DUMP = '1'
+PROFILE_INLINE = 'inline'
+
+
+def init_profiling(app):
+    """
+    Register the hook on the ``app`` when ``PROFILE_ENABLED`` is set.
+
+    :type app: flask.Flask
+    :rtype: None
+    """
+    if not app.config['PROFILE_ENABLED']:
+        return
+
+    app.before_request(start_profile)
+    app.after_request(stop_profile)
+    app.teardown_request(discard_profile)
+
+
+def get_profile_mode():
+    """
+    :returns: ``PROFILE_DUMP`` or ``PROFILE_INLINE`` when the request is to
+        be profiled, or ``None``.
+    :rtype: str
+    """
+    config = flask.current_app.config
+
+    if request.endpoint not in config['PROFILE_ENDPOINTS']:
+        return None
+
+    mode = request.headers.get(PROFILE_HEADER)
+
+    if mode in (PROFILE_DUMP, PROFILE_INLINE) and is_admin():
+        return mode
+
+    if random.random() * 100 < config['PROFILE_SAMPLE_PERCENT']:
+        return PROFILE_DUMP
+
+    return None
+
+
+def is_profiling():
+    """
+    :returns: Whether the current request is being profiled.
+    :rtype: bool
+    """
+    return getattr(g, 'profile', None) is not None
+
+
+def start_profile():
+    """
+    Start profiling the request when it's to be profiled.
+
+    :rtype: None
+    """
+    mode = get_profile_mode()
+
+    if mode is None:
+        return
+
+    g.profile = cProfile.Profile()
+    g.profile_mode = mode
+    g.profile.enable()
+
+
+def stop_profile(response):
+    """
+    Stop profiling the request and dump the profile, or return its summary
+    as the response for ``PROFILE_INLINE``.
+
+    :type response: flask.Response
+    :rtype: flask.Response
+    """
+    profile = getattr(g, 'profile', None)
+
+    if profile is None:
+        return response
+
+    profile.disable()
+    g.profile = None
+
+    config = flask.current_app.config
+    summary = get_summary(profile, config['PROFILE_SORT'],
+                          config['PROFILE_TOP'])
+
+    try:
+        path = dump_profile(profile, summary, config['PROFILE_DIR'])
+    except (IOError, OSError):
+        logging.exception('[profile]: Dumping the profile failed')
+        path = None
+
+    if g.profile_mode == PROFILE_INLINE:
+        response = flask.Response(summary, mimetype='text/plain')
+
+    # The path of the dump is shown to admin callers only
+    if path and is_admin():
+        response.headers[PROFILE_PATH_HEADER] = path
+
+    return response
+
+
+def discard_profile(exception=None):
+    """
+    Stop profiling a request which has failed before ``stop_profile``.
+
+    :rtype: None
+    """
+    profile = getattr(g, 'profile', None)
+
+    if profile is not None:
+        profile.disable()
+        g.profile = None
+
+
+def get_summary(profile, sort='cumulative', top=30):
+    """
+    :type profile: cProfile.Profile
+    :param sort: Sort key of ``pstats.Stats.sort_stats``.
+    :param top: Number of the functions in the summary.
+    :type sort: str
+    :type top: int
+    :returns: The ``top`` functions of the profile sorted by ``sort``.
+    :rtype: str
+    """
+    stream = StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats(sort).print_stats(top)
+
+    return stream.getvalue()
+
+
+def dump_profile(profile, summary, profile_dir):
+    """
+    Dump the profile of the request and its summary into ``profile_dir``.
+
+    :type profile: cProfile.Profile
+    :type summary: str
+    :type profile_dir: str
+    :returns: Path of the ``.pstats`` file, or ``None`` without a
+        ``profile_dir``.
+    :rtype: str
+    """
+    if not profile_dir:
+        return None
+
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+
+    name = '{0}-{1}-{2}'.format(
+        request.endpoint,
+        time.strftime('%Y%m%d%H%M%S'),
+        os.urandom(4).encode('hex')
+    )
+    path = os.path.join(profile_dir, name + '.pstats')
+    profile.dump_stats(path)
+
+    with open(os.path.join(profile_dir, name + '.txt'), 'w') as outfile:
+        outfile.write('{0} {1}\n\n'.format(request.method, request.full_path))
+        outfile.write(summary)
+
+    return path
@@ -0,0 +1,227 @@
+"""
+`server.reload`
+
+Reloading the data without restarting the process.
+
+A new ``server.models.Dataset`` is read, with its indexes and its
+``server.search.Search``, while the current one keeps serving the requests,
+then it's set as the current ``Dataset`` at once. Cached values are keyed by
+the version of the ``Dataset``, so the values of the previous data are never
+served again and are evicted from the cache in time.
+
+A reload is triggered by ``DataReloader.watch``, polling the `CSV` files for
+changes in each process (see ``DataReloader.start_watching``), by a signal
+handled by ``DataReloader.handle_signal`` or by the ``POST /admin/reload``
+endpoint.
+"""
+import logging
+import os
+import threading
+import time
+
+from server import models
+from server.search import get_search, get_tag_search
+from server.snapshot import open_or_build_snapshot
+from server.utils import get_data_version, read_dataset
+
+# Reloads are done one at a time, they may be triggered by many sources
+_reload_lock = threading.Lock()
+
+
+class DataReloader(object):
+    """
+    DataReloader
+
+    Reading the data of the app into a new ``server.models.Dataset`` and
+    setting it as the current one.
+
+    Attributes:
+    ==========
+
+    * ``data_path``: Directory of the `CSV` files.
+    * ``snapshot_path``: Directory of the snapshot of the data, when the data
+        is loaded from a snapshot.
+    * ``columnar``: Keeping the data as ``server.storage.ColumnarTable``s.
+    * ``watcher_pid``: Id of the process which ``start_watching`` has
+        started watching in.
+    * ``watcher_thread``: The last thread started by ``watch``.
+    * ``reload_thread``: The last thread started by
+        ``reload_in_background``.
+    """
+    data_path = None
+    snapshot_path = None
+    columnar = False
+    watcher_pid = None
+    watcher_thread = None
+    reload_thread = None
+
+    def __init__(self, data_path=None, snapshot_path=None, columnar=False):
+        """
+        :type data_path: str
+        :type snapshot_path: str
+        :type columnar: bool
+        """
+        self.data_path = data_path
+        self.snapshot_path = snapshot_path
+        self.columnar = columnar
+        self._watch_lock = threading.Lock()
+        self._stop_watching = threading.Event()
+
+    def build(self):
+        """
+        Read the data into a new ``server.models.Dataset``, building its
+        ``server.search.Search`` and ``server.search.TagSearch`` too, so the
+        first requests on it don't wait for them.
+
+        :rtype: server.models.Dataset
+        """
+        if self.snapshot_path:
+            dataset = open_or_build_snapshot(self.snapshot_path,
+                                             self.data_path)
+        else:
+            dataset = read_dataset(self.data_path, self.columnar)
+
+        get_search(dataset)
+        get_tag_search(dataset)
+
+        return dataset
+
+    def is_stale(self):
+        """
+        :returns: Whether the `CSV` files have changed since the current
+            ``server.models.Dataset`` was read.
+        :rtype: bool
+        """
+        return (get_data_version(self.data_path) !=
+                models.get_dataset().version)
+
+    def reload(self, force=False):
+        """
+        Reload the data when it has changed, or anyway when ``force`` is
+        set.
+
+        :type force: bool
+        :returns: Version of the new ``server.models.Dataset``, or ``None``
+            when the data hasn't changed.
+        :rtype: str
+        """
+        with _reload_lock:
+            if not force and not self.is_stale():
+                return None
+
+            started = time.time()
+            dataset = self.build()
+            models.set_dataset(dataset)
+
+        logging.info('[reload]: Data version {0} loaded in {1:.2f}s'.format(
+            dataset.version,
+            time.time() - started
+        ))
+
+        return dataset.version
+
+    def reload_in_background(self, force=False):
+        """
+        Reload the data in a daemon thread.
+
+        :type force: bool
+        :rtype: threading.Thread
+        """
+        thread = threading.Thread(
+            target=self.safe_reload,
+            kwargs={'force': force}
+        )
+        thread.daemon = True
+        thread.start()
+        self.reload_thread = thread
+
+        return thread
+
+    def safe_reload(self, force=False):
+        """
+        Same as ``reload`` but the errors are logged, the current data is
+        kept when the new one can't be read.
+
+        :type force: bool
+        :rtype: str
+        """
+        try:
+            return self.reload(force)
+        except Exception:
+            logging.exception('[reload]: Reloading the data failed')
+
+    def watch(self, interval):
+        """
+        Check the `CSV` files for changes every ``interval`` seconds in a
+        daemon thread, reloading the data when they've changed, until
+        ``stop_watching``.
+
+        :type interval: float
+        :rtype: threading.Thread
+        """
+        stopped = self._stop_watching
+
+        def poll():
+            while not stopped.wait(interval):
+                self.safe_reload()
+
+        thread = threading.Thread(target=poll)
+        thread.daemon = True
+        thread.start()
+        self.watcher_thread = thread
+
+        return thread
+
+    def stop_watching(self):
+        """
+        Stop the threads started by ``watch``, waiting for them to finish.
+
+        :rtype: None
+        """
+        with self._watch_lock:
+            self._stop_watching.set()
+            self._stop_watching = threading.Event()
+
+            if self.watcher_thread is not None:
+                self.watcher_thread.join()
+
+            self.watcher_thread = None
+            self.watcher_pid = None
+
+    def start_watching(self, interval):
+        """
+        Start ``watch`` in the current process, unless it's already
+        watching.
+
+        Threads don't survive a fork, a thread started before the app is
+        forked into workers (e.g. ``gunicorn --preload``) would only run in
+        the master. This is called on the requests instead, so each worker
+        starts its own on its first request.
+
+        :type interval: float
+        :returns: The started thread, or ``None`` when it's already
+            watching.
+        :rtype: threading.Thread
+        """
+        pid = os.getpid()
+
+        if self.watcher_pid == pid:
+            return None
+
+        with self._watch_lock:
+            if self.watcher_pid == pid:
+                return None
+
+            self.watcher_pid = pid
+
+            return self.watch(interval)
+
+    def handle_signal(self, signum, frame):
+        """
+        Signal handler reloading the data in the background, e.g. for
+        ``signal.SIGHUP``.
+
+        :type signum: int
+        :rtype: None
+        """
+        self.reload_in_background(force=True)
@@ -1,6 +1,32 @@
-from numpy import inf
+import os
+from collections import defaultdict
+from heapq import merge
+
+import numpy
+from numpy import (arcsin, argsort, array, atleast_1d, column_stack, cos,
+                   flatnonzero, floor, inf, logical_and, logical_or, minimum,
+                   pi, radians, sin, zeros)
+from numpy.linalg import norm
+import scipy
 from scipy import spatial
 
+from server import metrics
+from server.models import (ModelObjectManager, Shops, Tags, Taggings,
+                           get_dataset)
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS * pi / 180
+
+# Matching the shops having any or all of the tags
+MATCH_ANY = 'any'
+MATCH_ALL = 'all'
+
+# Queries of ``scipy.spatial.cKDTree`` run in ``n_jobs`` processes since
+# scipy 0.16, before it they're only run in the calling process.
+CKDTREE_N_JOBS = tuple(
+    int(i) for i in scipy.__version__.split('.')[:2]
+) >= (0, 16)
+
 
 class Search(object):
     """
@@ -16,50 +42,334 @@ class Search(object):
 
     Ref: http://goo.gl/5XWgBI
 
+    Locations are kept in the tree as 3D points on a unit sphere, instead of
+    latitude and longitude degrees, so the straight line (chord) distance
+    between the points grows with their great-circle distance everywhere on
+    the earth. Distances are in meters and converted to chord lengths for
+    querying the tree.
+
+    Points are the positions (ordinals) of the shops in ``shop_ids``, as the
+    tree returns them, so shops sharing a location are different points.
+    Only the arrays of the shops are kept, not their models, so a ``Search``
+    opened from a snapshot (see ``Search.open``) maps the arrays and builds
+    the tree on the mapped points, sharing them between the processes.
+
 
     Attributes:
     ==========
 
-    * ``shops``: A list of shops to query them for getting neighbors.
-    * ``shop_index``: A hash/dictionary table of shops with their key
-        index as tuple of locations points, the purpose is for faster lookup.
+    * ``shop_ids``: Array of the ``id``s of the shops, in their order.
+    * ``locations``: Array of latitude and longitude degrees of the shops,
+        in their order.
     *``ckdtree``: A ``scipy.spatial.cKDTree`` that makes the queering for
         neighbor easy.
     * ``last_points`` After querying the ``ckdtree``, the nearest points
         will be kept on this attribute.
     """
-    shops = []
-    shops_index = {}
-    locations = [(), ]
+    shop_ids = None
+    locations = None
     ckdtree = None
-    last_points = []
+    last_points = None
 
-    def query(self, latitude, longitude, distance=0.02, max_locations=25):
+    def __init__(self):
+        self.shop_ids = array([], dtype=str)
+        self.locations = array([], dtype=float).reshape(-1, 2)
+        self.last_points = []
+
+    def query(self, latitude, longitude, distance=2000, max_locations=25,
+              shop_ids=None, mask=None):
         """
         :type latitude: float
         :type longitude: float
         :type distance: float
         :type max_locations: int
+        :type shop_ids: set of str
+        :type mask: numpy.ndarray
 
         :rtype: None
         """
-        latitude = float(latitude)
-        longitude = float(longitude)
-        locations = self.get_locations()
+        self.last_points = self.get_points(
+            latitude,
+            longitude,
+            distance,
+            max_locations,
+            shop_ids,
+            mask
+        )
+
+    def get_points(self, latitude, longitude, distance=2000, max_locations=25,
+                   shop_ids=None, mask=None):
+        """
+        Query the ``ckdtree`` without touching the state of the instance,
+        so a single ``Search`` can be shared between requests.
+
+        :type latitude: float
+        :type longitude: float
+        :type distance: float
+        :type max_locations: int
+        :type shop_ids: set of str
+        :type mask: numpy.ndarray
+
+        :rtype: list of int
+        """
+        neighbours = self.get_neighbours(
+            latitude,
+            longitude,
+            distance,
+            max_locations,
+            shop_ids,
+            mask
+        )
+
+        return [point for dist, point in neighbours]
+
+    @metrics.timed('search_query_seconds', mode='single')
+    def get_neighbours(self, latitude, longitude, distance=2000,
+                       max_locations=25, shop_ids=None, mask=None):
+        """
+        Same as ``get_points`` but each point comes with its distance from
+        the queried location in meters, nearest first.
+
+        When ``max_locations`` is ``None``, all the points in the
+        ``distance`` are returned.
+
+        When ``shop_ids`` or ``mask``, a boolean array over the points, is
+        given, points of the shops which are not in them are filtered out
+        after querying the tree. In that case the tree is queried again with
+        a doubled ``k`` until ``max_locations`` points are found or there are
+        no more points in the ``distance``.
+
+        :type latitude: float
+        :type longitude: float
+        :type distance: float
+        :type max_locations: int
+        :type shop_ids: set of str
+        :type mask: numpy.ndarray
+
+        :rtype: list of tuple
+        """
+        if max_locations is None:
+            candidates = self.get_candidates(latitude, longitude, distance)
+            if mask is not None:
+                candidates = candidates[mask[candidates]]
+
+            neighbours = self.get_candidate_neighbours(
+                candidates,
+                latitude,
+                longitude,
+                distance
+            )
+
+            if shop_ids is not None:
+                neighbours = self.filter_neighbours(neighbours, shop_ids)
+
+            return neighbours
+
+        point = to_unit_vectors([(latitude, longitude)])[0]
+        total = len(self.shop_ids)
+        k = max_locations
+
+        if not total or mask is not None and not mask.any():
+            return []
+
+        while True:
+            dst, idc = self.ckdtree.query(
+                point,
+                k=min(k, total),
+                distance_upper_bound=to_chord(distance)
+            )
+            neighbours = to_neighbours(atleast_1d(dst), atleast_1d(idc))
+            found = len(neighbours)
+
+            if mask is not None:
+                neighbours = [i for i in neighbours if mask[i[1]]]
+
+            if shop_ids is not None:
+                neighbours = self.filter_neighbours(neighbours, shop_ids)
+
+            if len(neighbours) >= max_locations or found < k or k >= total:
+                return neighbours[0:max_locations]
+
+            k *= 2
+
+    def filter_neighbours(self, neighbours, shop_ids):
+        """
+        Leave out the neighbours of the shops which are not in ``shop_ids``.
+
+        :type neighbours: list of tuple
+        :type shop_ids: set of str
+        :rtype: list of tuple
+        """
+        neighbour_shop_ids = self.get_shop_ids(
+            [point for dist, point in neighbours]
+        )
+
+        return [i for i, shop_id in zip(neighbours, neighbour_shop_ids)
+                if shop_id in shop_ids]
+
+    def query_many(self, locations, distance=2000, max_locations=25,
+                   n_jobs=1, mask=None):
+        """
+        Batch version of ``get_points``, returning the points of each of
+        the ``locations`` in their order.
+
+        :param locations: List of latitude and longitude degrees.
+        :param n_jobs: Number of processes querying the ``ckdtree``, ``-1``
+            uses all of the CPUs.
+        :type locations: list of tuple
+        :type distance: float
+        :type max_locations: int
+        :type n_jobs: int
+        :type mask: numpy.ndarray
+
+        :rtype: list of list
+        """
+        return [
+            [point for dist, point in neighbours]
+            for neighbours in self.get_neighbours_many(
+                locations,
+                distance,
+                max_locations,
+                n_jobs,
+                mask
+            )
+        ]
+
+    @metrics.timed('search_query_seconds', mode='batch')
+    def get_neighbours_many(self, locations, distance=2000, max_locations=25,
+                            n_jobs=1, mask=None):
+        """
+        Batch version of ``get_neighbours``.
+
+        All of the ``locations`` go through a single vectorized query of the
+        ``ckdtree``, only splitting its results to the points of each
+        location is left to Python. With a ``mask`` and ``max_locations``,
+        the tree may need to be queried again for some of the locations, so
+        each location is queried on its own.
+
+        :param locations: List of latitude and longitude degrees.
+        :param n_jobs: Number of processes querying the ``ckdtree``, ``-1``
+            uses all of the CPUs.
+        :type locations: list of tuple
+        :type distance: float
+        :type max_locations: int
+        :type n_jobs: int
+        :type mask: numpy.ndarray
+
+        :rtype: list of list
+        """
+        points = to_unit_vectors(locations)
+
+        if not len(points) or not len(self.shop_ids):
+            return [[] for i in points]
+
+        if max_locations is None:
+            candidates = [
+                array(i, dtype=int) for i in self.ckdtree.query_ball_point(
+                    points,
+                    to_chord(distance),
+                    **get_jobs_kwargs(n_jobs)
+                )
+            ]
+
+            if mask is not None:
+                candidates = [i[mask[i]] for i in candidates]
+
+            return [
+                self.get_candidate_neighbours(i, latitude, longitude, distance)
+                for i, (latitude, longitude) in zip(candidates, locations)
+            ]
+
+        if mask is not None:
+            return [
+                self.get_neighbours(
+                    latitude,
+                    longitude,
+                    distance,
+                    max_locations,
+                    mask=mask
+                )
+                for latitude, longitude in locations
+            ]
 
         dst, idc = self.ckdtree.query(
-            (latitude, longitude),
-            k=max_locations,
-            distance_upper_bound=distance
+            points,
+            k=min(max_locations, len(self.shop_ids)),
+            distance_upper_bound=to_chord(distance),
+            **get_jobs_kwargs(n_jobs)
         )
+        dst = dst.reshape(len(points), -1)
+        idc = idc.reshape(len(points), -1)
 
-        self.last_points = [locations[idx] for idx, max_locations
-                            in zip(idc, dst) if max_locations != inf]
+        return [to_neighbours(i, j) for i, j in zip(dst, idc)]
 
-    def get_locations(self):
+    def get_candidates(self, latitude, longitude, distance):
         """
+        Return positions of all the locations in the ``distance``.
+
+        :type latitude: float
+        :type longitude: float
+        :type distance: float
+
+        :rtype: numpy.ndarray
+        """
+        candidates = self.ckdtree.query_ball_point(
+            to_unit_vectors([(latitude, longitude)])[0],
+            to_chord(distance)
+        )
+
+        return array(candidates, dtype=int)
+
+    def get_candidate_points(self, candidates, latitude, longitude,
+                             distance=2000, max_locations=25):
+        """
+        Same as ``get_points`` but only the locations in ``candidates``,
+        positions of the locations, are checked.
+
+        :type candidates: numpy.ndarray
+        :type latitude: float
+        :type longitude: float
+        :type distance: float
+        :type max_locations: int
+
+        :rtype: list of int
+        """
+        neighbours = self.get_candidate_neighbours(
+            candidates,
+            latitude,
+            longitude,
+            distance,
+            max_locations
+        )
+
+        return [point for dist, point in neighbours]
+
+    def get_candidate_neighbours(self, candidates, latitude, longitude,
+                                 distance=2000, max_locations=None):
+        """
+        Same as ``get_candidate_points`` but each point comes with its
+        distance from the queried location in meters, nearest first.
+
+        :type candidates: numpy.ndarray
+        :type latitude: float
+        :type longitude: float
+        :type distance: float
+        :type max_locations: int
+
         :rtype: list of tuple
         """
+        point = to_unit_vectors([(latitude, longitude)])[0]
+        dst = norm(self.ckdtree.data[candidates] - point, axis=1)
+        nearest = argsort(dst, kind='mergesort')
+        nearest = nearest[dst[nearest] <= to_chord(distance)]
+        nearest = nearest[0:max_locations]
+
+        return to_neighbours(dst[nearest], candidates[nearest])
+
+    def get_locations(self):
+        """
+        :rtype: numpy.ndarray
+        """
         return self.locations
 
     def get_ckdtree(self):
@@ -70,26 +380,559 @@ class Search(object):
 
     def get_last_points(self):
         """
-        :rtype: list of tuple
+        :rtype: list of int
         """
         return self.last_points
 
-    def get_nearby_shops(self):
+    def get_nearby_shops(self, points=None, dataset=None):
         """
+        :param dataset: ``server.models.Dataset`` that the shops are looked
+            up in, the current one by default.
+        :type points: list of int
+        :type dataset: server.models.Dataset
         :rtype list of Shops
         """
-        points = self.get_last_points()
-        shops = []
+        shop_ids = self.get_shop_ids(points)
+        shops = dict(
+            (i.id, i) for i in ModelObjectManager(Shops(), dataset).filter(
+                {'id__in': set(shop_ids)}
+            )
+        )
+
+        return [shops[i] for i in shop_ids]
+
+    def get_shop_ids(self, points=None):
+        """
+        Same as ``get_nearby_shops`` but only the ``id``s of the shops,
+        without building the shops.
+
+        :type points: list of int
+        :rtype: list of str
+        """
+        if points is None:
+            points = self.get_last_points()
+
+        return self.shop_ids[array(points, dtype=int)].tolist()
+
+    @staticmethod
+    def build_ckdtree(locations):
+        """
+        :param locations: List of latitude and longitude degrees.
+        :type locations: list of tuple
+        :rtype: spatial.cKDTree
+        """
+        return spatial.cKDTree(to_unit_vectors(locations))
 
-        for point in points:
-            shops.append(self.shops_index[point])
+    def set_shops(self, shops, ckdtree=None):
+        """
+        :param shops: Shops, or anything with their ``id``, ``lat`` and
+            ``lng``.
+        :param ckdtree: A tree already built of the ``shops`` locations,
+            in the same order.
+        :type shops: list of Shops
+        :type ckdtree: spatial.cKDTree
+        """
+        self.set_locations(
+            array([i.id for i in shops], dtype=str),
+            array([(i.lat, i.lng) for i in shops], dtype=float),
+            ckdtree=ckdtree
+        )
 
-        return shops
+    def set_locations(self, shop_ids, locations, points=None, ckdtree=None):
+        """
+        Same as ``set_shops`` but with the arrays of the shops.
 
-    def set_shops(self, shops):
-        self.shops = shops
-        self.locations = [(i.lat, i.lng) for i in self.shops]
-        self.ckdtree = spatial.cKDTree(self.locations)
+        :param shop_ids: Array of the ``id``s of the shops.
+        :param locations: Array of latitude and longitude degrees of the
+            shops.
+        :param points: Array of the ``locations`` as unit vectors, see
+            ``to_unit_vectors``. The tree is built on them as they are, e.g.
+            memory mapped, instead of converting the ``locations``.
+        :type shop_ids: numpy.ndarray
+        :type locations: numpy.ndarray
+        :type points: numpy.ndarray
+        :type ckdtree: spatial.cKDTree
+        """
+        self.shop_ids = shop_ids
+        self.locations = locations.reshape(-1, 2)
+        if ckdtree is None:
+            if points is None:
+                points = to_unit_vectors(self.locations)
+            with metrics.span('search_build_seconds'):
+                ckdtree = spatial.cKDTree(points)
+        self.ckdtree = ckdtree
+
+    @classmethod
+    def open(cls, path, mmap_mode='r'):
+        """
+        Open a ``Search`` saved by ``Search.save``, its arrays are memory
+        mapped by default and only the tree is built.
+
+        :type path: str
+        :type mmap_mode: str
+        :rtype: Search
+        """
+        search = cls()
+        search.set_locations(*[
+            numpy.load(os.path.join(path, '{0}.npy'.format(i)), mmap_mode)
+            for i in ('shop_ids', 'locations', 'points')
+        ])
 
-        for shop in self.shops:
-            self.shops_index[(shop.lat, shop.lng)] = shop
+        return search
+
+    def save(self, path):
+        """
+        :type path: str
+        :rtype: None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        arrays = {
+            'shop_ids': self.shop_ids,
+            'locations': self.locations,
+            'points': self.ckdtree.data
+        }
+        for name, values in arrays.items():
+            numpy.save(os.path.join(path, '{0}.npy'.format(name)), values)
+
+
+class TagSearch(object):
+    """
+    TagSearch
+
+    Keeping a prebuilt ``Search`` per tag, so querying the shops of a tag
+    costs the same as querying all the shops.
+
+    Searching with many tags is done by querying the ``Search`` of each tag
+    and merging the neighbours by their distance, a shop which has more than
+    one of the tags is returned once.
+
+    Points are the positions of the shops in all of the shops, the
+    ``Search`` that ``set_masks`` is given, not in the shops of each tag.
+
+    The shops of each tag are kept as a bitset too, a boolean array over all
+    of the shops, so the shops having any or all of the tags are found with
+    vectorized bitwise operations and the result can be applied directly to
+    the points of a ``Search`` of all the shops.
+
+    Attributes:
+    ==========
+
+    * ``searches``: A hash/dictionary table of ``Search`` with their tag as
+        the key.
+    * ``positions``: A hash/dictionary table of sorted arrays of the
+        positions of the shops of each tag, with their tag as the key.
+    * ``masks``: A hash/dictionary table of boolean arrays over all of the
+        shops, ``True`` for the shops of the tag, with their tag as the key.
+    * ``size``: Number of all the shops.
+    """
+    searches = None
+    positions = None
+    masks = None
+    size = 0
+
+    def __init__(self):
+        self.searches = {}
+        self.positions = {}
+        self.masks = {}
+
+    def set_positions(self, search, tagged_positions):
+        """
+        :param search: The ``Search`` of all of the shops.
+        :param tagged_positions: A hash/dictionary of tags to the positions
+            of their shops in ``search``.
+        :type search: Search
+        :type tagged_positions: dict
+        :rtype: None
+        """
+        masks = {}
+
+        for tag, positions in tagged_positions.items():
+            masks[tag] = zeros(len(search.shop_ids), dtype=bool)
+            masks[tag][array(positions, dtype=int)] = True
+
+        self.set_masks(search, masks)
+
+    def set_masks(self, search, masks):
+        """
+        Same as ``set_positions`` but with the ``masks`` of the tags, e.g.
+        memory mapped by ``TagSearch.open``. The tree of each tag is built
+        on the points of the tree of ``search``.
+
+        :param search: The ``Search`` of all of the shops.
+        :param masks: A hash/dictionary of tags to boolean arrays over the
+            shops of ``search``.
+        :type search: Search
+        :type masks: dict
+        :rtype: None
+        """
+        self.searches = {}
+        self.positions = {}
+        self.masks = dict(masks)
+        self.size = len(search.shop_ids)
+        points = search.get_ckdtree().data
+
+        for tag, mask in masks.items():
+            positions = flatnonzero(mask)
+            tag_search = Search()
+            tag_search.set_locations(
+                search.shop_ids[positions],
+                search.locations[positions],
+                points[positions]
+            )
+            self.searches[tag] = tag_search
+            self.positions[tag] = positions
+
+    @classmethod
+    def open(cls, path, search, mmap_mode='r'):
+        """
+        Open a ``TagSearch`` saved by ``TagSearch.save``, its masks are
+        memory mapped by default.
+
+        :param search: The ``Search`` of all of the shops it's saved with.
+        :type path: str
+        :type search: Search
+        :type mmap_mode: str
+        :rtype: TagSearch
+        """
+        tags = numpy.load(os.path.join(path, 'tags.npy'))
+        masks = numpy.load(os.path.join(path, 'masks.npy'), mmap_mode)
+        tag_search = cls()
+        tag_search.set_masks(search, dict(zip(tags.tolist(), masks)))
+
+        return tag_search
+
+    def save(self, path):
+        """
+        :type path: str
+        :rtype: None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        tags = sorted(self.masks)
+        numpy.save(os.path.join(path, 'tags.npy'), array(tags, dtype=str))
+        numpy.save(
+            os.path.join(path, 'masks.npy'),
+            array([self.masks[i] for i in tags], dtype=bool).reshape(
+                len(tags),
+                self.size
+            )
+        )
+
+    def get_tags(self):
+        """
+        :rtype: list of str
+        """
+        return self.searches.keys()
+
+    def get_searches(self):
+        """
+        :rtype: dict
+        """
+        return self.searches
+
+    def get_positions(self, tags, match=MATCH_ANY):
+        """
+        :type tags: list of str
+        :type match: str
+        :returns: Sorted positions of the shops having any, or all, of the
+            ``tags``.
+        :rtype: numpy.ndarray
+        """
+        return flatnonzero(self.get_mask(tags, match))
+
+    def get_mask(self, tags, match=MATCH_ANY):
+        """
+        :type tags: list of str
+        :param match: ``MATCH_ANY`` or ``MATCH_ALL`` of the ``tags``.
+        :type match: str
+        :returns: Boolean array over all of the shops, ``True`` for the
+            shops having any, or all, of the ``tags``.
+        :rtype: numpy.ndarray
+        """
+        masks = [self.masks.get(tag) for tag in set(tags)]
+
+        if match == MATCH_ALL:
+            if not masks or any(i is None for i in masks):
+                return zeros(self.size, dtype=bool)
+
+            return logical_and.reduce(masks)
+
+        masks = [i for i in masks if i is not None]
+
+        if not masks:
+            return zeros(self.size, dtype=bool)
+
+        return logical_or.reduce(masks)
+
+    def to_positions(self, tag, neighbours):
+        """
+        Convert the points of the ``neighbours`` found by the ``Search`` of
+        the ``tag`` to the positions of their shops in all of the shops.
+
+        :type tag: str
+        :type neighbours: list of tuple
+        :rtype: list of tuple
+        """
+        points = array([point for dist, point in neighbours], dtype=int)
+
+        return zip(
+            [dist for dist, point in neighbours],
+            self.positions[tag][points].tolist()
+        )
+
+    def get_points(self, tags, latitude, longitude, distance=2000,
+                   max_locations=25):
+        """
+        When ``max_locations`` is ``None``, all the points in the
+        ``distance`` are returned.
+
+        :type tags: list of str
+        :type latitude: float
+        :type longitude: float
+        :type distance: float
+        :type max_locations: int
+
+        :rtype: list of int
+        """
+        searches = self.get_searches()
+        neighbours = [
+            self.to_positions(tag, searches[tag].get_neighbours(
+                latitude,
+                longitude,
+                distance,
+                max_locations
+            ))
+            for tag in set(tags) if tag in searches
+        ]
+
+        return merge_neighbours(neighbours, max_locations)
+
+    def query_many(self, tags, locations, distance=2000, max_locations=25,
+                   n_jobs=1):
+        """
+        Batch version of ``get_points``, see ``Search.query_many``.
+
+        :type tags: list of str
+        :type locations: list of tuple
+        :type distance: float
+        :type max_locations: int
+        :type n_jobs: int
+
+        :rtype: list of list
+        """
+        searches = self.get_searches()
+        neighbours = [
+            [self.to_positions(tag, i) for i in
+             searches[tag].get_neighbours_many(
+                 locations,
+                 distance,
+                 max_locations,
+                 n_jobs
+             )]
+            for tag in set(tags) if tag in searches
+        ]
+
+        if not neighbours:
+            return [[] for i in locations]
+
+        return [merge_neighbours(i, max_locations) for i in zip(*neighbours)]
+
+
+def merge_neighbours(neighbours, max_locations=None):
+    """
+    Merge lists of neighbours, each sorted by distance, into the points of
+    the nearest ``max_locations`` of them. A point in more than one of the
+    lists is returned once.
+
+    :type neighbours: list of list
+    :type max_locations: int
+    :rtype: list of int
+    """
+    points = []
+    seen = set()
+    for dist, point in merge(*neighbours):
+        if max_locations is not None and len(points) >= max_locations:
+            break
+
+        if point not in seen:
+            seen.add(point)
+            points.append(point)
+
+    return points
+
+
+def get_jobs_kwargs(n_jobs):
+    """
+    :type n_jobs: int
+    :returns: Keyword arguments of the ``n_jobs`` of the queries of
+        ``scipy.spatial.cKDTree``, none when the installed scipy doesn't
+        support them, see ``CKDTREE_N_JOBS``.
+    :rtype: dict
+    """
+    if not CKDTREE_N_JOBS:
+        return {}
+
+    return {'n_jobs': n_jobs}
+
+
+def to_neighbours(chords, points):
+    """
+    Pair the points found by querying the tree with their distances in
+    meters, leaving out the missing points (infinite distance) that
+    ``scipy.spatial.cKDTree.query`` fills its results with.
+
+    :type chords: numpy.ndarray
+    :type points: numpy.ndarray
+    :rtype: list of tuple
+    """
+    found = chords != inf
+
+    return zip(to_meters(chords[found]).tolist(), points[found].tolist())
+
+
+def to_unit_vectors(locations):
+    """
+    Convert latitude and longitude degrees to 3D points on a unit sphere,
+    Earth-centered Earth-fixed (ECEF) coordinates of a spherical earth.
+
+    :type locations: list of tuple
+    :rtype: numpy.ndarray
+    """
+    locations = radians(array(locations, dtype=float).reshape(-1, 2))
+    lat = locations[:, 0]
+    lng = locations[:, 1]
+
+    return column_stack((cos(lat) * cos(lng), cos(lat) * sin(lng), sin(lat)))
+
+
+def to_chord(distance):
+    """
+    Convert a great-circle distance in meters to the length of the chord
+    between the points on a unit sphere, ``None`` is no limit.
+
+    :type distance: float
+    :rtype: float
+    """
+    if distance is None:
+        return inf
+
+    return 2 * sin(min(float(distance) / EARTH_RADIUS, pi) / 2)
+
+
+def to_meters(chord):
+    """
+    Convert lengths of chords on a unit sphere to great-circle distances in
+    meters.
+
+    :type chord: numpy.ndarray
+    :rtype: numpy.ndarray
+    """
+    return 2 * EARTH_RADIUS * arcsin(minimum(chord / 2, 1))
+
+
+def get_cell(latitude, longitude, grid_size):
+    """
+    Snap the location to the cell of a grid with ``grid_size`` degrees
+    cells that it's in.
+
+    :type latitude: float
+    :type longitude: float
+    :type grid_size: float
+
+    :returns: Cell row and column.
+    :rtype: tuple of int
+    """
+    return (
+        int(floor(float(latitude) / grid_size)),
+        int(floor(float(longitude) / grid_size))
+    )
+
+
+def get_search(dataset=None):
+    """
+    Return the ``Search`` of all the shops of the ``dataset``, the current
+    ``server.models.Dataset`` by default.
+
+    The ``ckdtree`` of all the shops is built once on the first use and
+    then is shared read-only between all the requests. Filtering shops
+    (e.g by tags) is done via ``Search.get_points`` and doesn't need
+    rebuilding the tree. A new ``Dataset`` has its own ``Search``.
+
+    :type dataset: server.models.Dataset
+    :rtype: Search
+    """
+    dataset = dataset or get_dataset()
+
+    if dataset.search is None:
+        shops = ModelObjectManager(Shops(), dataset).values_list(
+            'id',
+            'lat',
+            'lng'
+        )
+        search = Search()
+        search.set_locations(
+            array([i[0] for i in shops], dtype=str),
+            array([i[1:] for i in shops], dtype=float)
+        )
+        dataset.search = search
+
+    return dataset.search
+
+
+def set_search(search, dataset=None):
+    """
+    Set the ``Search`` of the ``dataset``, e.g. one loaded from a snapshot.
+
+    :type search: Search
+    :type dataset: server.models.Dataset
+    :rtype: None
+    """
+    (dataset or get_dataset()).search = search
+
+
+def get_tag_search(dataset=None):
+    """
+    Return the ``TagSearch`` of the ``dataset``, the current
+    ``server.models.Dataset`` by default, built on the first use from the
+    shops of its ``Search``.
+
+    :type dataset: server.models.Dataset
+    :rtype: TagSearch
+    """
+    dataset = dataset or get_dataset()
+
+    if dataset.tag_search is None:
+        search = get_search(dataset)
+        positions = dict(
+            (shop_id, i) for i, shop_id in enumerate(search.shop_ids.tolist())
+        )
+        tags = dict(
+            ModelObjectManager(Tags(), dataset).values_list('id', 'tag')
+        )
+        taggings = ModelObjectManager(Taggings(), dataset)
+        tagged_positions = defaultdict(list)
+
+        for shop_id, tag_id in taggings.values_list('shop_id', 'tag_id'):
+            tagged_positions[tags[tag_id]].append(positions[shop_id])
+
+        tag_search = TagSearch()
+        tag_search.set_positions(search, tagged_positions)
+        dataset.tag_search = tag_search
+
+    return dataset.tag_search
+
+
+def reset_search(dataset=None):
+    """
+    Drop the ``Search`` and ``TagSearch`` of the ``dataset``, they will be
+    built again from its data on their next use.
+
+    :type dataset: server.models.Dataset
+    :rtype: None
+    """
+    dataset = dataset or get_dataset()
+    dataset.search = None
+    dataset.tag_search = None
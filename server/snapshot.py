@@ -0,0 +1,314 @@
+"""
+`server.snapshot`
+
+Binary snapshot of the data, compiled from the `CSV` files once and opened
+with memory mapping on each process start instead of parsing the `CSV` files.
+
+The columns and indexes are read-only memory mapped arrays, so every worker
+process which loads the same snapshot shares their pages instead of keeping
+a copy of the data.
+
+A snapshot is a directory of:
+
+* A directory per data set with its ``server.storage.ColumnarTable`` columns
+    as ``.npy`` files and an ``indexes`` directory with the arrays of its
+    ``server.storage.ColumnIndex``s and ``server.storage.SortedIndex``s.
+* A ``search`` directory with the arrays of the ``server.search.Search``
+    and ``server.search.TagSearch`` of the shops: their ``id``s, locations
+    and unit vectors, and the mask of the shops of each tag. Only the k-d
+    trees are built by each process, on the mapped points.
+* ``snapshot.json``: Modification times of the `CSV` files the snapshot is
+    built from, for detecting a stale snapshot, the version of their data
+    and the ``SNAPSHOT_FORMAT`` it's written in.
+
+A snapshot is built in a temporary directory next to ``snapshot_path`` and
+moved in place once it's complete, the files of the previous snapshot are
+only unlinked, so the processes which have them memory mapped keep reading
+them until they load the new snapshot. Processes building the snapshot at
+once each build in a directory of their own and replace the snapshot one
+at a time, holding an exclusive lock on the ``<snapshot_path>.lock`` file,
+which is held shared while a snapshot is opened. A stale snapshot is built
+by one process at a time too, holding an exclusive lock on the
+``<snapshot_path>.build.lock`` file, so when the watchers of the workers
+find it stale at once one of them builds it and the others open it.
+"""
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from os import listdir
+from os.path import exists, getmtime, isdir, join
+
+from server import models
+from server.models import Dataset
+from server.search import (Search, TagSearch, get_search, get_tag_search,
+                           set_search)
+from server.storage import ColumnarTable, ColumnIndex, SortedIndex
+from server.utils import (build_indexes, build_sorted_indexes,
+                          get_data_files, get_data_version, read_data)
+
+MANIFEST_FILE = 'snapshot.json'
+INDEXES_DIR = 'indexes'
+SEARCH_DIR = 'search'
+
+# Suffixes of the lock files of opening/replacing and building a snapshot
+LOCK_SUFFIX = '.lock'
+BUILD_LOCK_SUFFIX = '.build.lock'
+
+# Snapshots written in another format are stale
+SNAPSHOT_FORMAT = 2
+
+
+def get_data_mtimes(data_path=None):
+    """
+    :type data_path: str
+    :returns: Hash/dictionary of `CSV` file names to their modification time.
+    :rtype: dict
+    """
+    return dict(
+        (os.path.basename(i), getmtime(i)) for i in get_data_files(data_path)
+    )
+
+
+def is_snapshot_stale(snapshot_path, data_path=None):
+    """
+    A snapshot is stale when it doesn't exist, it's written in another
+    format or the `CSV` files have been added, removed or modified since it
+    was built.
+
+    :type snapshot_path: str
+    :type data_path: str
+    :rtype: bool
+    """
+    manifest_file = join(snapshot_path, MANIFEST_FILE)
+
+    if not os.path.isfile(manifest_file):
+        return True
+
+    with open(manifest_file, 'r') as infile:
+        manifest = json.load(infile)
+
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        return True
+
+    return manifest.get('mtimes') != get_data_mtimes(data_path)
+
+
+def build_snapshot(snapshot_path, data_path=None):
+    """
+    Compile the `CSV` files in ``data_path`` into a snapshot.
+
+    The snapshot is built in a temporary directory which replaces
+    ``snapshot_path`` once it's complete, so a snapshot which its build has
+    been interrupted is never loaded.
+
+    :type snapshot_path: str
+    :type data_path: str
+    :rtype: None
+    """
+    snapshot_path = os.path.normpath(snapshot_path)
+    parent_path = os.path.dirname(os.path.abspath(snapshot_path))
+
+    if not isdir(parent_path):
+        os.makedirs(parent_path)
+
+    build_path = tempfile.mkdtemp(
+        prefix=os.path.basename(snapshot_path) + '.',
+        dir=parent_path
+    )
+
+    try:
+        write_snapshot(build_path, data_path)
+        replace_snapshot(build_path, snapshot_path)
+    finally:
+        if exists(build_path):
+            shutil.rmtree(build_path)
+
+
+def write_snapshot(build_path, data_path=None):
+    """
+    Write the snapshot of the `CSV` files in ``data_path`` into the
+    existing directory ``build_path``.
+
+    :type build_path: str
+    :type data_path: str
+    :rtype: None
+    """
+    manifest_file = join(build_path, MANIFEST_FILE)
+    mtimes = get_data_mtimes(data_path)
+    version = get_data_version(data_path)
+
+    raw_data = dict(
+        (k, ColumnarTable.from_rows(v, getattr(models, k).schema))
+        for k, v in read_data(data_path).items()
+    )
+
+    dataset = Dataset(
+        raw_data,
+        build_indexes(raw_data),
+        build_sorted_indexes(raw_data),
+        version
+    )
+
+    for model_name, table in raw_data.items():
+        table.save(join(build_path, model_name))
+
+    for model_indexes in (dataset.indexes, dataset.sorted_indexes):
+        for model_name, indexes in model_indexes.items():
+            indexes_path = join(build_path, model_name, INDEXES_DIR)
+            for field_name, index in indexes.items():
+                index.save(indexes_path, field_name)
+
+    get_search(dataset).save(join(build_path, SEARCH_DIR))
+    get_tag_search(dataset).save(join(build_path, SEARCH_DIR))
+
+    with open(manifest_file, 'w') as outfile:
+        json.dump({
+            'mtimes': mtimes,
+            'version': version,
+            'format': SNAPSHOT_FORMAT
+        }, outfile)
+
+
+def replace_snapshot(build_path, snapshot_path):
+    """
+    Move the snapshot in ``build_path`` to ``snapshot_path``, removing the
+    snapshot which was there. Renaming and removing files doesn't change
+    the memory mapped pages of the previous snapshot.
+
+    :type build_path: str
+    :type snapshot_path: str
+    :rtype: None
+    """
+    old_path = snapshot_path + '.old'
+
+    with lock_snapshot(snapshot_path, fcntl.LOCK_EX):
+        if exists(old_path):
+            shutil.rmtree(old_path)
+
+        if exists(snapshot_path):
+            os.rename(snapshot_path, old_path)
+
+        os.rename(build_path, snapshot_path)
+
+        if exists(old_path):
+            shutil.rmtree(old_path)
+
+
+@contextmanager
+def lock_snapshot(snapshot_path, operation, suffix=LOCK_SUFFIX):
+    """
+    Hold a lock on the ``<snapshot_path><suffix>`` file, shared by the
+    processes across the block.
+
+    :param operation: ``fcntl.LOCK_EX`` for replacing the snapshot or
+        ``fcntl.LOCK_SH`` for opening it.
+    :param suffix: ``LOCK_SUFFIX`` or ``BUILD_LOCK_SUFFIX`` for building
+        the snapshot.
+    :type snapshot_path: str
+    :type operation: int
+    :type suffix: str
+    """
+    lock_path = os.path.normpath(snapshot_path) + suffix
+    parent_path = os.path.dirname(os.path.abspath(lock_path))
+
+    if not isdir(parent_path):
+        os.makedirs(parent_path)
+
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def open_snapshot(snapshot_path):
+    """
+    Open the snapshot as a new ``server.models.Dataset``, its columns and
+    indexes are memory mapped, with the ``server.search.Search`` and
+    ``server.search.TagSearch`` of its shops.
+
+    The ``scipy.spatial.cKDTree``s of the shops are built again on their
+    mapped points instead of being kept in the snapshot, it's cheap next
+    to parsing the data and ``cKDTree``s can't be pickled before scipy
+    0.16. No model of the shops is built.
+
+    :type snapshot_path: str
+    :rtype: server.models.Dataset
+    """
+    with lock_snapshot(snapshot_path, fcntl.LOCK_SH):
+        with open(join(snapshot_path, MANIFEST_FILE), 'r') as infile:
+            version = json.load(infile).get('version')
+
+        raw_data = dict(
+            (i, ColumnarTable.open(join(snapshot_path, i)))
+            for i in listdir(snapshot_path)
+            if i != SEARCH_DIR and isdir(join(snapshot_path, i))
+        )
+        indexes = {}
+        sorted_indexes = {}
+
+        for model_name, table in raw_data.items():
+            model = getattr(models, model_name)
+            indexes_path = join(snapshot_path, model_name, INDEXES_DIR)
+            indexes[model_name] = dict(
+                (i, ColumnIndex.open(table, indexes_path, i))
+                for i in model.indexed_fields
+            )
+            sorted_indexes[model_name] = dict(
+                (i, SortedIndex.open(indexes_path, i))
+                for i in model.sorted_fields
+            )
+
+        search = Search.open(join(snapshot_path, SEARCH_DIR))
+        tag_search = TagSearch.open(join(snapshot_path, SEARCH_DIR), search)
+
+    dataset = Dataset(raw_data, indexes, sorted_indexes, version)
+    set_search(search, dataset)
+    dataset.tag_search = tag_search
+
+    return dataset
+
+
+def load_snapshot(snapshot_path):
+    """
+    Open the snapshot and set it as the current ``server.models.Dataset``.
+
+    :type snapshot_path: str
+    :rtype: None
+    """
+    models.set_dataset(open_snapshot(snapshot_path))
+
+
+def open_or_build_snapshot(snapshot_path, data_path=None):
+    """
+    Open the snapshot, building it again first when it's stale.
+
+    Only one process builds a stale snapshot, the others wait for it and
+    open the snapshot it has built instead of parsing the `CSV` files too.
+
+    :type snapshot_path: str
+    :type data_path: str
+    :rtype: server.models.Dataset
+    """
+    if is_snapshot_stale(snapshot_path, data_path):
+        with lock_snapshot(snapshot_path, fcntl.LOCK_EX, BUILD_LOCK_SUFFIX):
+            # It may have been built while waiting for the lock
+            if is_snapshot_stale(snapshot_path, data_path):
+                build_snapshot(snapshot_path, data_path)
+
+    return open_snapshot(snapshot_path)
+
+
+def load_or_build_snapshot(snapshot_path, data_path=None):
+    """
+    Load the snapshot, building it again first when it's stale.
+
+    :type snapshot_path: str
+    :type data_path: str
+    :rtype: None
+    """
+    models.set_dataset(open_or_build_snapshot(snapshot_path, data_path))
@@ -0,0 +1,740 @@
+"""
+`server.storage`
+
+Columnar storage of the data sets, an alternative to keeping each row as a
+hash/dictionary of strings in ``Dataset.raw_data``.
+"""
+import os
+from collections import Mapping
+from os import listdir
+
+import numpy
+
+# Lookups that compare the values instead of matching them, see
+# ``get_range_bounds``
+RANGE_LOOKUPS = ('gt', 'gte', 'lt', 'lte', 'range')
+
+# Types of the columns of the ``Model.schema`` numeric fields
+NUMERIC_DTYPES = {int: numpy.int64, float: numpy.float64}
+
+
+class ColumnarTable(Mapping):
+    """
+    ColumnarTable
+
+    Keeping a data set as typed NumPy columns instead of a dictionary per row.
+
+    Columns of ``int`` and ``float`` fields of the ``Model.schema`` are kept
+    as ``int64`` or ``float64`` arrays, ``str`` fields are kept as
+    categorical columns: an array of the unique values and an ``int32`` array
+    of codes pointing to them, even when their values look like numbers.
+    Fields missing from the schema are numeric when all of their values are
+    numbers, except ``*_id`` fields.
+
+    ``ColumnarTable`` acts as a read-only hash/dictionary of ``id`` to rows,
+    so it can be kept in ``Dataset.raw_data`` in place of the
+    dictionary of rows. Rows are built only when they are accessed.
+
+    Attributes:
+    ==========
+
+    * ``pks``: Sorted array of the ``id``s, position of each ``id`` in it is
+        the position of its row in all of the columns.
+    * ``columns``: A hash/dictionary of field names to their column.
+    * ``categories``: A hash/dictionary of field names of categorical columns
+        to their sorted unique values.
+    """
+    pks = None
+    columns = None
+    categories = None
+
+    def __init__(self, pks, columns, categories):
+        """
+        :type pks: numpy.ndarray
+        :type columns: dict
+        :type categories: dict
+        """
+        self.pks = pks
+        self.columns = columns
+        self.categories = categories
+
+    @classmethod
+    def from_rows(cls, model_data, schema=()):
+        """
+        Build a ``ColumnarTable`` from a hash/dictionary of ``id`` to rows,
+        as they are read from the CSV files.
+
+        :param schema: ``Model.schema`` of the rows, the types of its fields
+            choose the types of their columns.
+        :type model_data: dict
+        :type schema: tuple
+        :rtype: ColumnarTable
+        """
+        pks = sorted(model_data.keys())
+        field_names = model_data[pks[0]].keys() if pks else []
+        types = dict(schema)
+        columns = {}
+        categories = {}
+
+        for field_name in field_names:
+            values = [model_data[pk][field_name] for pk in pks]
+            field_type = types.get(field_name)
+            column = None
+
+            if field_type in NUMERIC_DTYPES:
+                column = numpy.array(values, dtype=NUMERIC_DTYPES[field_type])
+            elif field_type is None and not field_name.endswith('_id'):
+                column = cls.get_numeric_column(values)
+
+            if column is None:
+                categories[field_name], column = numpy.unique(
+                    values,
+                    return_inverse=True
+                )
+                column = column.astype(numpy.int32)
+
+            columns[field_name] = column
+
+        return cls(numpy.array(pks), columns, categories)
+
+    @staticmethod
+    def get_numeric_column(values):
+        """
+        :param values: Values as strings, or already converted to numbers.
+        :type values: list
+
+        :returns: ``int64`` or ``float64`` array of the values or ``None``
+            when a value is not a number.
+        :rtype: numpy.ndarray
+        """
+        column = numpy.array(values)
+
+        if column.dtype.kind == 'i':
+            return column.astype(numpy.int64)
+        elif column.dtype.kind == 'f':
+            return column.astype(numpy.float64)
+        elif column.dtype.kind not in 'SU':
+            return None
+
+        for dtype in (numpy.int64, numpy.float64):
+            try:
+                return numpy.array(values, dtype=dtype)
+            except ValueError:
+                continue
+
+        return None
+
+    @classmethod
+    def open(cls, path, mmap_mode='r'):
+        """
+        Open a ``ColumnarTable`` saved by ``ColumnarTable.save``.
+
+        The columns are memory mapped by default, so opening doesn't read
+        them and the pages are shared between the processes opening them.
+
+        :type path: str
+        :type mmap_mode: str
+        :rtype: ColumnarTable
+        """
+        columns = {}
+        categories = {}
+
+        for file_name in listdir(path):
+            name, ext = os.path.splitext(file_name)
+            if ext != '.npy' or name == 'pks':
+                continue
+
+            column = numpy.load(os.path.join(path, file_name), mmap_mode)
+            if name.endswith('.categories'):
+                categories[name[:-len('.categories')]] = column
+            else:
+                columns[name] = column
+
+        pks = numpy.load(os.path.join(path, 'pks.npy'), mmap_mode)
+
+        return cls(pks, columns, categories)
+
+    def save(self, path):
+        """
+        Save the columns as ``.npy`` files in the ``path`` directory.
+
+        :type path: str
+        :rtype: None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        numpy.save(os.path.join(path, 'pks.npy'), self.pks)
+
+        for field_name, column in self.columns.items():
+            numpy.save(os.path.join(path, field_name + '.npy'), column)
+
+        for field_name, categories in self.categories.items():
+            numpy.save(
+                os.path.join(path, field_name + '.categories.npy'),
+                categories
+            )
+
+    def get_field_names(self):
+        """
+        :rtype: list of str
+        """
+        return ['id'] + self.columns.keys()
+
+    def get_position(self, pk):
+        """
+        :type pk: str
+
+        :returns: Position of the row or ``None`` if ``pk`` doesn't exist.
+        :rtype: int
+        """
+        position = int(numpy.searchsorted(self.pks, pk))
+
+        if position < len(self.pks) and self.pks[position] == pk:
+            return position
+
+        return None
+
+    def get_row(self, position):
+        """
+        :type position: int
+        :rtype: dict
+        """
+        row = {'id': self.pks[position].item()}
+
+        for field_name, column in self.columns.items():
+            if field_name in self.categories:
+                value = self.categories[field_name][column[position]]
+            else:
+                value = column[position]
+            row[field_name] = value.item()
+
+        return row
+
+    def get_codes(self, field_name, values):
+        """
+        Return the codes of ``values`` in a categorical column, values that
+        don't exist are left out.
+
+        :type field_name: str
+        :type values: list
+
+        :rtype: numpy.ndarray
+        """
+        categories = self.categories[field_name]
+        values = get_typed_values(values, categories.dtype)
+        codes = numpy.searchsorted(categories, values)
+        codes = codes[codes < len(categories)]
+
+        return codes[numpy.in1d(categories[codes], values)]
+
+    def get_mask(self, field_name, lookup_type, value, positions=None):
+        """
+        Return a boolean array of the rows that their ``field_name`` matches
+        the ``exact``, ``in`` or one of ``RANGE_LOOKUPS`` lookup.
+
+        :param positions: Positions of the rows to check, by default all of
+            them.
+        :type field_name: str
+        :type lookup_type: str
+        :type value: object
+        :type positions: numpy.ndarray
+
+        :rtype: numpy.ndarray
+        """
+        values = value if lookup_type == 'in' else [value]
+
+        if field_name == 'id':
+            column = self.pks
+        else:
+            column = self.columns[field_name]
+
+        if positions is not None:
+            column = column[positions]
+
+        if lookup_type in RANGE_LOOKUPS:
+            if field_name in self.categories:
+                # Categories are sorted, so comparing them is enough
+                categories = self.categories[field_name]
+                return get_range_mask(categories, lookup_type, value)[column]
+
+            return get_range_mask(column, lookup_type, value)
+
+        if field_name == 'id':
+            return numpy.in1d(column, numpy.array(list(values)))
+
+        if field_name in self.categories:
+            return numpy.in1d(column, self.get_codes(field_name, values))
+
+        return numpy.in1d(column, get_typed_values(values, column.dtype))
+
+    def get_positions(self, lookups, positions=None):
+        """
+        :param lookups: List of ``(field_name, lookup_type, value)``.
+        :param positions: Positions of the rows to check, by default all of
+            them.
+        :type lookups: list of tuple
+        :type positions: numpy.ndarray
+
+        :returns: Positions of the rows matching all of the ``lookups``.
+        :rtype: numpy.ndarray
+        """
+        if positions is None:
+            positions = numpy.arange(len(self))
+
+        for field_name, lookup_type, value in lookups:
+            if not len(positions):
+                break
+
+            positions = positions[
+                self.get_mask(field_name, lookup_type, value, positions)
+            ]
+
+        return positions
+
+    def items(self):
+        """
+        :rtype: list of tuple
+        """
+        rows = (self.get_row(i) for i in xrange(len(self)))
+
+        return [(row['id'], row) for row in rows]
+
+    def __getitem__(self, pk):
+        """
+        :type pk: str
+        :raises KeyError: If ``pk`` doesn't exist.
+        :rtype: dict
+        """
+        position = self.get_position(pk)
+
+        if position is None:
+            raise KeyError(pk)
+
+        return self.get_row(position)
+
+    def __contains__(self, pk):
+        """
+        :type pk: str
+        :rtype: bool
+        """
+        return self.get_position(pk) is not None
+
+    def __iter__(self):
+        """
+        :rtype: iterator
+        """
+        return (i.item() for i in self.pks)
+
+    def __len__(self):
+        """
+        :rtype: int
+        """
+        return len(self.pks)
+
+
+class ColumnIndex(Mapping):
+    """
+    ColumnIndex
+
+    Secondary index of a ``ColumnarTable`` field kept as arrays, so it can
+    be saved next to the columns and memory mapped like them.
+
+    ``ColumnIndex`` acts as a read-only hash/dictionary of field values to
+    the list of ``id``s having that value, like the indexes that
+    ``ModelObjectManager.build_indexes`` builds for hash/dictionary rows.
+
+    Attributes:
+    ==========
+
+    * ``table``: The indexed ``ColumnarTable``.
+    * ``values``: Sorted unique values of the field.
+    * ``positions``: Positions of the rows, grouped by their value.
+    * ``offsets``: Where the group of each of ``values`` starts in
+        ``positions``, with the end of the last group at the end.
+    """
+    table = None
+    values = None
+    positions = None
+    offsets = None
+
+    def __init__(self, table, values, positions, offsets):
+        """
+        :type table: ColumnarTable
+        :type values: numpy.ndarray
+        :type positions: numpy.ndarray
+        :type offsets: numpy.ndarray
+        """
+        self.table = table
+        self.values = values
+        self.positions = positions
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, table, field_name, sort_field=None, reverse=False):
+        """
+        :param sort_field: Field that the group of each value is sorted by.
+        :param reverse: Sort the groups in descending order.
+        :type table: ColumnarTable
+        :type field_name: str
+        :type sort_field: str
+        :type reverse: bool
+        :rtype: ColumnIndex
+        """
+        if field_name in table.categories:
+            values = table.categories[field_name]
+            codes = table.columns[field_name]
+        else:
+            values, codes = numpy.unique(
+                table.columns[field_name],
+                return_inverse=True
+            )
+
+        keys = [codes]
+        if sort_field:
+            # Codes of categorical columns are in the order of their values
+            key = table.columns[sort_field]
+            keys.insert(0, -key if reverse else key)
+
+        positions = numpy.lexsort(keys)
+        offsets = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+        numpy.cumsum(
+            numpy.bincount(codes, minlength=len(values)),
+            out=offsets[1:]
+        )
+
+        return cls(table, values, positions, offsets)
+
+    @classmethod
+    def open(cls, table, path, field_name, mmap_mode='r'):
+        """
+        :type table: ColumnarTable
+        :type path: str
+        :type field_name: str
+        :type mmap_mode: str
+        :rtype: ColumnIndex
+        """
+        arrays = [
+            numpy.load(
+                os.path.join(path, '{0}.{1}.npy'.format(field_name, i)),
+                mmap_mode
+            )
+            for i in ('values', 'positions', 'offsets')
+        ]
+
+        return cls(table, *arrays)
+
+    def save(self, path, field_name):
+        """
+        :type path: str
+        :type field_name: str
+        :rtype: None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for name in ('values', 'positions', 'offsets'):
+            numpy.save(
+                os.path.join(path, '{0}.{1}.npy'.format(field_name, name)),
+                getattr(self, name)
+            )
+
+    def get_code(self, value):
+        """
+        :type value: object
+        :returns: Position of ``value`` in ``values`` or ``None``.
+        :rtype: int
+        """
+        codes = self.get_codes([value])
+
+        return int(codes[0]) if len(codes) else None
+
+    def get_codes(self, values):
+        """
+        :type values: list
+        :returns: Codes of the ``values`` which exist, in their order, see
+            ``get_code``.
+        :rtype: numpy.ndarray
+        """
+        values = get_typed_values(values, self.values.dtype)
+        codes = numpy.searchsorted(self.values, values)
+        found = codes < len(self.values)
+        codes = codes[found]
+
+        return codes[self.values[codes] == values[found]]
+
+    def get_group(self, value):
+        """
+        :type value: object
+        :returns: Positions of the rows having the ``value``, in the order
+            of the index, or ``None`` when no row has it.
+        :rtype: numpy.ndarray
+        """
+        code = self.get_code(value)
+
+        if code is None:
+            return None
+
+        return self.positions[self.offsets[code]:self.offsets[code + 1]]
+
+    def get_positions(self, values):
+        """
+        :type values: list
+        :returns: Positions of the rows having any of the ``values``, in the
+            order of the index.
+        :rtype: numpy.ndarray
+        """
+        groups = [self.get_group(i) for i in values]
+
+        return numpy.concatenate([numpy.array([], dtype=int)] +
+                                 [i for i in groups if i is not None])
+
+    def __getitem__(self, value):
+        """
+        :type value: object
+        :raises KeyError: If no row has the ``value``.
+        :rtype: list of str
+        """
+        positions = self.get_group(value)
+
+        if positions is None:
+            raise KeyError(value)
+
+        return self.table.pks[positions].tolist()
+
+    def __contains__(self, value):
+        """
+        :type value: object
+        :rtype: bool
+        """
+        return self.get_code(value) is not None
+
+    def __iter__(self):
+        """
+        :rtype: iterator
+        """
+        return (i.item() for i in self.values)
+
+    def __len__(self):
+        """
+        :rtype: int
+        """
+        return len(self.values)
+
+
+class SortedIndex(object):
+    """
+    SortedIndex
+
+    Values of a field in sorted order with the key of the row of each one,
+    so range lookups are done by binary search in ``O(log n + k)`` instead
+    of checking every row.
+
+    Keys are the ``id``s of the rows for hash/dictionary rows and the
+    positions of the rows for a ``ColumnarTable``.
+
+    Attributes:
+    ==========
+
+    * ``values``: Sorted array of the values of the field.
+    * ``keys``: Array of the keys of the rows, in the order of ``values``.
+    """
+    values = None
+    keys = None
+
+    def __init__(self, values, keys):
+        """
+        :type values: numpy.ndarray
+        :type keys: numpy.ndarray
+        """
+        self.values = values
+        self.keys = keys
+
+    @classmethod
+    def build(cls, values, keys):
+        """
+        :type values: numpy.ndarray
+        :type keys: numpy.ndarray
+        :rtype: SortedIndex
+        """
+        order = numpy.argsort(values, kind='mergesort')
+
+        return cls(values[order], keys[order])
+
+    @classmethod
+    def from_rows(cls, model_data, field_name):
+        """
+        :param model_data: A hash/dictionary of ``id`` to rows.
+        :type model_data: dict
+        :type field_name: str
+        :rtype: SortedIndex
+        """
+        pks = list(model_data)
+
+        return cls.build(
+            numpy.array([model_data[pk][field_name] for pk in pks]),
+            numpy.array(pks)
+        )
+
+    @classmethod
+    def from_table(cls, table, field_name):
+        """
+        :type table: ColumnarTable
+        :type field_name: str
+        :rtype: SortedIndex
+        """
+        return cls.build(table.columns[field_name], numpy.arange(len(table)))
+
+    @classmethod
+    def open(cls, path, field_name, mmap_mode='r'):
+        """
+        :type path: str
+        :type field_name: str
+        :type mmap_mode: str
+        :rtype: SortedIndex
+        """
+        arrays = [
+            numpy.load(
+                os.path.join(path, '{0}.sorted.{1}.npy'.format(field_name, i)),
+                mmap_mode
+            )
+            for i in ('values', 'keys')
+        ]
+
+        return cls(*arrays)
+
+    def save(self, path, field_name):
+        """
+        :type path: str
+        :type field_name: str
+        :rtype: None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for name in ('values', 'keys'):
+            numpy.save(
+                os.path.join(
+                    path,
+                    '{0}.sorted.{1}.npy'.format(field_name, name)
+                ),
+                getattr(self, name)
+            )
+
+    def get_keys(self, lookup_type, value):
+        """
+        :param lookup_type: One of ``RANGE_LOOKUPS``.
+        :type lookup_type: str
+        :type value: object
+
+        :returns: Keys of the rows matching the lookup, in the order of
+            their values.
+        :rtype: numpy.ndarray
+        """
+        low, high, include_low, include_high = get_range_bounds(
+            lookup_type,
+            value
+        )
+        start = 0
+        end = len(self.values)
+
+        if low is not None:
+            side = 'left' if include_low else 'right'
+            start = int(numpy.searchsorted(self.values, low, side))
+
+        if high is not None:
+            side = 'right' if include_high else 'left'
+            end = int(numpy.searchsorted(self.values, high, side))
+
+        return self.keys[start:max(start, end)]
+
+    def __len__(self):
+        """
+        :rtype: int
+        """
+        return len(self.values)
+
+
+def get_typed_values(values, dtype):
+    """
+    Convert the lookup ``values`` to the ``dtype`` of a column, leaving out
+    the ones which can't be converted as they are, e.g. strings longer than
+    the width of a string ``dtype`` would be truncated, unicode which isn't
+    `ASCII` can't be encoded and fractions would be rounded to integers.
+    Those can't be equal to any of the values of the column.
+
+    :type values: list
+    :type dtype: numpy.dtype
+    :rtype: numpy.ndarray
+    """
+    values = list(values)
+
+    try:
+        typed = numpy.array(values, dtype=dtype)
+    except (TypeError, ValueError, UnicodeError):
+        convertible = []
+        for value in values:
+            try:
+                numpy.array(value, dtype=dtype)
+            except (TypeError, ValueError, UnicodeError):
+                continue
+            convertible.append(value)
+
+        values = convertible
+        typed = numpy.array(values, dtype=dtype)
+
+    return typed[numpy.array(
+        [i == j for i, j in zip(typed.tolist(), values)],
+        dtype=bool
+    )]
+
+
+def get_range_bounds(lookup_type, value):
+    """
+    Convert a range lookup to its bounds, ``range`` lookup takes a pair of
+    the low and high values and includes both of them.
+
+    :param lookup_type: One of ``RANGE_LOOKUPS``.
+    :type lookup_type: str
+    :type value: object
+
+    :returns: The ``low`` and ``high`` bounds, ``None`` for no bound, and
+        whether each of them is included.
+    :rtype: tuple
+    """
+    if lookup_type == 'range':
+        low, high = value
+        return low, high, True, True
+
+    return {
+        'gt': (value, None, False, True),
+        'gte': (value, None, True, True),
+        'lt': (None, value, True, False),
+        'lte': (None, value, True, True)
+    }[lookup_type]
+
+
+def get_range_mask(values, lookup_type, value):
+    """
+    :param values: Array of the values to compare.
+    :param lookup_type: One of ``RANGE_LOOKUPS``.
+    :type values: numpy.ndarray
+    :type lookup_type: str
+    :type value: object
+
+    :returns: A boolean array of the ``values`` matching the lookup.
+    :rtype: numpy.ndarray
+    """
+    low, high, include_low, include_high = get_range_bounds(
+        lookup_type,
+        value
+    )
+    mask = numpy.ones(len(values), dtype=bool)
+
+    if low is not None:
+        mask &= values >= low if include_low else values > low
+
+    if high is not None:
+        mask &= values <= high if include_high else values < high
+
+    return mask
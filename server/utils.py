@@ -1,50 +1,434 @@
 import csv
+import hashlib
+import itertools
 import logging
 import os
+import threading
 from os.path import join
-from os.path import isfile
+from os.path import getmtime, getsize, isfile
 from os import listdir
 
-from werkzeug.contrib.cache import SimpleCache
+import cPickle as pickle
+from collections import OrderedDict, defaultdict
+from time import time
+
+from werkzeug.contrib.cache import BaseCache
 
 from server import models
+from server.storage import ColumnarTable
+
+
+class LRUCache(BaseCache):
+    """
+    LRUCache
+
+    Memory cache bounded by the size of its values, the least recently used
+    values are evicted to make room for the new ones.
 
-cache = SimpleCache()
+    Values are kept pickled, like ``werkzeug.contrib.cache.SimpleCache``,
+    and the size of a value is the length of its pickled string.
 
+    Keys are grouped into namespaces by their prefix before the first ``.``,
+    e.g. ``search.<md5>`` is in ``search`` namespace and keys without any
+    ``.`` are in ``default`` namespace. Each namespace can have its own size
+    quota on top of the ``max_size`` of the whole cache, so a namespace with
+    many distinct keys doesn't evict the values of the others.
 
-def load_data():
+    Attributes:
+    ==========
+
+    * ``max_size``: Maximum size of all the values in bytes.
+    * ``quotas``: A hash/dictionary of namespaces to their maximum size in
+        bytes.
+    * ``stats``: A hash/dictionary of namespaces to their ``hits``,
+        ``misses`` and ``evictions`` counters.
     """
-    Beginning of getting our data into memory.
+    DEFAULT_NAMESPACE = 'default'
 
-    In the beginning of app_creation in flask, ``load_data`` will be called
-    walk through ``./data/`` directory to get all the data files which are
-    in `CSV` format.
+    max_size = None
+    quotas = None
+    stats = None
 
-    CSV files then will be loaded into `ModelObjectManager.raw_data`
-    dictionary. The ``key`` for each data set will be set by their
-    corresponding ``server.models.Model`` name.
+    def __init__(self, max_size=64 * 1024 * 1024, quotas=None,
+                 default_timeout=300):
+        """
+        :type max_size: int
+        :type quotas: dict
+        :type default_timeout: int
+        """
+        BaseCache.__init__(self, default_timeout)
+        self.max_size = max_size
+        self.quotas = quotas or {}
+        self.stats = defaultdict(
+            lambda: {'hits': 0, 'misses': 0, 'evictions': 0}
+        )
+        self._lock = threading.Lock()
+        self._tick = 0
+        self.clear()
 
-    All the data are being casted/converted into hash/dictionary data type.
+    def get_namespace(self, key):
+        """
+        :type key: str
+        :rtype: str
+        """
+        if '.' not in key:
+            return self.DEFAULT_NAMESPACE
+
+        return key.split('.', 1)[0]
+
+    def get_stats(self):
+        """
+        :returns: A hash/dictionary of namespaces to their counters, number
+            of ``items`` and ``size``.
+        :rtype: dict
+        """
+        with self._lock:
+            stats = {}
+
+            for namespace in set(self.stats) | set(self._entries):
+                stats[namespace] = dict(self.stats[namespace])
+                stats[namespace]['items'] = len(
+                    self._entries.get(namespace, ())
+                )
+                stats[namespace]['size'] = self._sizes[namespace]
+
+            return stats
+
+    def get_size(self):
+        """
+        :rtype: int
+        """
+        return sum(self._sizes.values())
+
+    def get(self, key):
+        namespace = self.get_namespace(key)
+
+        with self._lock:
+            entries = self._entries.get(namespace)
+            entry = entries.pop(key, None) if entries else None
+
+            if entry is not None and entry[0] <= time():
+                self._sizes[namespace] -= len(entry[1])
+                entry = None
+
+                if not entries:
+                    del self._entries[namespace]
+
+            if entry is None:
+                self.stats[namespace]['misses'] += 1
+                return None
+
+            self._tick += 1
+            entries[key] = (entry[0], entry[1], self._tick)
+            self.stats[namespace]['hits'] += 1
+
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        namespace = self.get_namespace(key)
+        quota = self.quotas.get(namespace, self.max_size)
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        if len(value) > min(quota, self.max_size):
+            return False
+
+        with self._lock:
+            self._delete(namespace, key)
+
+            self._tick += 1
+            entries = self._entries.setdefault(namespace, OrderedDict())
+            entries[key] = (time() + timeout, value, self._tick)
+            self._sizes[namespace] += len(value)
+
+            while self._sizes[namespace] > quota:
+                self._evict(namespace)
+
+            while self.get_size() > self.max_size:
+                # Least recently used value is one of the first values of
+                # the namespaces
+                self._evict(min(
+                    self._entries,
+                    key=lambda i: next(self._entries[i].itervalues())[2]
+                ))
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        namespace = self.get_namespace(key)
+
+        with self._lock:
+            if key in self._entries.get(namespace, ()):
+                return False
+
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._delete(self.get_namespace(key), key)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._sizes = defaultdict(int)
 
+        return True
+
+    def _delete(self, namespace, key):
+        """
+        :type namespace: str
+        :type key: str
+        :rtype: bool
+        """
+        entries = self._entries.get(namespace)
+        entry = entries.pop(key, None) if entries else None
+
+        if entry is None:
+            return False
+
+        self._sizes[namespace] -= len(entry[1])
+        if not entries:
+            del self._entries[namespace]
+
+        return True
+
+    def _evict(self, namespace):
+        """
+        Evict the least recently used value of the namespace.
+
+        :type namespace: str
+        :rtype: None
+        """
+        key = next(iter(self._entries[namespace]))
+        self._delete(namespace, key)
+        self.stats[namespace]['evictions'] += 1
+
+
+cache = LRUCache()
+
+# Versions of the data sets which are not read from files
+_versions = itertools.count(1)
+
+# Locks of the keys which their values are being generated, with the number
+# of calls waiting for each of them
+_single_flight = {}
+_single_flight_lock = threading.Lock()
+
+
+def set_cache(new_cache):
+    """
+    Set the cache used by ``get_cash``, any ``werkzeug.contrib.cache``
+    cache can be used.
+
+    :type new_cache: BaseCache
     :rtype: None
     """
-    data_path = os.path.join(os.path.dirname(__file__), '..', 'data')
-    data_files = [join(data_path, f) for f in listdir(data_path)
-                  if isfile(join(data_path, f))]
+    global cache
+
+    cache = new_cache
+
+
+def get_cache():
+    """
+    :returns: The cache used by ``get_cash``.
+    :rtype: BaseCache
+    """
+    return cache
+
+
+def get_data_path():
+    """
+    :returns: The default ``./data/`` directory.
+    :rtype: str
+    """
+    return os.path.join(os.path.dirname(__file__), '..', 'data')
+
+
+def get_data_files(data_path=None):
+    """
+    :type data_path: str
+    :returns: Paths of the `CSV` files in ``data_path``.
+    :rtype: list of str
+    """
+    data_path = data_path or get_data_path()
+
+    return [join(data_path, f) for f in listdir(data_path)
+            if isfile(join(data_path, f)) and f.endswith('.csv')]
+
+
+def get_data_version(data_path=None):
+    """
+    Version of the `CSV` files in ``data_path``, it changes when any of
+    them is added, removed or modified. It's the same for every process
+    reading the same files, so processes sharing a cache share the values
+    of the same data.
+
+    :type data_path: str
+    :rtype: str
+    """
+    files = sorted(
+        (os.path.basename(i), getmtime(i), getsize(i))
+        for i in get_data_files(data_path)
+    )
+
+    return hashlib.md5(repr(files)).hexdigest()[0:12]
+
+
+def get_version():
+    """
+    :returns: Version of the current ``server.models.Dataset``.
+    :rtype: str
+    """
+    return models.get_dataset().version
+
+
+def read_data(data_path=None):
+    """
+    Read the `CSV` files in ``data_path`` into hash/dictionary of rows for
+    each data set, keyed by their corresponding ``server.models.Model`` name.
+    Values are converted to the types of the ``Model.schema``.
+
+    :type data_path: str
+    :rtype: dict
+    """
     raw_data = {}
 
-    for file_name in data_files:
+    for file_name in get_data_files(data_path):
         data = {}
+        model_name = file_name.split('/')[-1].split('.')[0].capitalize()
+        model = getattr(models, model_name)
+
         with open(file_name, 'r') as infile:
             reader = csv.DictReader(infile)
             for i in reader:
-                data[i['id']] = {k: v for k, v in i.items() if k != 'id'}
+                data[i['id']] = model.to_python(
+                    {k: v for k, v in i.items() if k != 'id'}
+                )
 
-        model_name = file_name.split('/')[-1].split('.')[0].capitalize()
         raw_data[model_name] = data
-        setattr(models, model_name, getattr(models, model_name))
 
-    setattr(models.ModelObjectManager, 'raw_data', raw_data)
+    return raw_data
+
+
+def build_indexes(raw_data):
+    """
+    Build the secondary indexes of ``Model.indexed_fields`` for each data
+    set, sorted by ``Model.ordering``.
+
+    :type raw_data: dict
+    :rtype: dict
+    """
+    indexes = {}
+
+    for model_name, data in raw_data.items():
+        model = getattr(models, model_name)
+        indexes[model_name] = models.ModelObjectManager.build_indexes(
+            data,
+            model.indexed_fields,
+            model.ordering
+        )
+
+    return indexes
+
+
+def build_sorted_indexes(raw_data):
+    """
+    Build the sorted indexes of ``Model.sorted_fields`` for each data set.
+
+    :type raw_data: dict
+    :rtype: dict
+    """
+    return dict(
+        (model_name, models.ModelObjectManager.build_sorted_indexes(
+            data,
+            getattr(models, model_name).sorted_fields
+        ))
+        for model_name, data in raw_data.items()
+    )
+
+
+def set_data(raw_data, indexes, sorted_indexes=None, version=None):
+    """
+    Set the data and their indexes as the current ``server.models.Dataset``,
+    the sorted indexes are built when they're not given.
+
+    The ``server.search.Search`` of the new ``Dataset`` is built from its
+    data on the next use.
+
+    :type raw_data: dict
+    :type indexes: dict
+    :type sorted_indexes: dict
+    :param version: Version of the data, a new one is made up when it's not
+        given.
+    :type version: str
+    :rtype: None
+    """
+    if sorted_indexes is None:
+        sorted_indexes = build_sorted_indexes(raw_data)
+
+    if version is None:
+        version = str(next(_versions))
+
+    models.set_dataset(
+        models.Dataset(raw_data, indexes, sorted_indexes, version)
+    )
+
+
+def read_dataset(data_path=None, columnar=False):
+    """
+    Read the `CSV` files in ``data_path`` into a new ``server.models.Dataset``
+    with its indexes, without setting it as the current one.
+
+    The version is taken before reading the files, so when they're modified
+    meanwhile the data is read again on the next reload.
+
+    :type data_path: str
+    :type columnar: bool
+    :rtype: server.models.Dataset
+    """
+    version = get_data_version(data_path)
+    raw_data = read_data(data_path)
+
+    if columnar:
+        raw_data = dict(
+            (k, ColumnarTable.from_rows(v, getattr(models, k).schema))
+            for k, v in raw_data.items()
+        )
+
+    return models.Dataset(
+        raw_data,
+        build_indexes(raw_data),
+        build_sorted_indexes(raw_data),
+        version
+    )
+
+
+def load_data(data_path=None, columnar=False):
+    """
+    Beginning of getting our data into memory.
+
+    In the beginning of app_creation in flask, ``load_data`` will be called
+    walk through ``./data/`` directory to get all the data files which are
+    in `CSV` format.
+
+    CSV files then will be loaded into ``Dataset.raw_data`` dictionary of
+    the current ``server.models.Dataset``. The ``key`` for each data set
+    will be set by their corresponding ``server.models.Model`` name.
+
+    All the data are being casted/converted into hash/dictionary data type.
+    When ``columnar`` is set, each data set is kept as a
+    ``server.storage.ColumnarTable`` of typed NumPy columns instead.
+
+    Secondary indexes of ``Model.indexed_fields`` are built for each data set,
+    sorted by ``Model.ordering``, and kept in ``Dataset.indexes``.
+
+    :type data_path: str
+    :type columnar: bool
+    :rtype: None
+    """
+    models.set_dataset(read_dataset(data_path, columnar))
 
 
 def get_cash(key, timeout=60*5, new_value=None, default_value=None):
@@ -64,6 +448,9 @@ def get_cash(key, timeout=60*5, new_value=None, default_value=None):
 
     :param new_value: New value to set if the stored cache value doesn't exist.
     This value will be cached and `default_value` will be ignored.
+    When it's a callable, it will be called without arguments to generate the
+    new value only if the stored cache value doesn't exist, see
+    ``get_cash_single_flight``.
     :type new_value: object
 
     :param default_value: Default value if the stored cache value doesn't exist.
@@ -84,6 +471,9 @@ def get_cash(key, timeout=60*5, new_value=None, default_value=None):
 
             return default_value
 
+        if callable(new_value):
+            return get_cash_single_flight(key, timeout, new_value)
+
         if new_value:
             logging.info("[get_cash]: Caching new value")
             cache.set(key, new_value, timeout)
@@ -91,3 +481,53 @@ def get_cash(key, timeout=60*5, new_value=None, default_value=None):
             return new_value
 
     return value
+
+
+def get_cash_single_flight(key, timeout, factory):
+    """
+    Get cached value of the ``key`` or generate it by calling ``factory``.
+
+    Concurrent calls for the same ``key`` wait for each other, so when the
+    value doesn't exist ``factory`` is called only once and the rest of the
+    calls get the value it has cached. ``None`` values are not cached.
+
+    :param key: Cache key
+    :type key: str
+
+    :param timeout: Cache value timeout
+    :type timeout: int
+
+    :param factory: Callable without arguments generating the new value.
+    :type factory: callable
+    """
+    with _single_flight_lock:
+        lock, waiting = _single_flight.get(key, (threading.Lock(), 0))
+        _single_flight[key] = (lock, waiting + 1)
+
+    try:
+        if lock.acquire(False):
+            value = None
+        else:
+            # Another call is generating the value, it's cached once we
+            # get the lock.
+            lock.acquire()
+            value = cache.get(key)
+
+        try:
+            if value is None:
+                logging.info("[get_cash]: Caching new generated value")
+                value = factory()
+
+                if value is not None:
+                    cache.set(key, value, timeout)
+
+            return value
+        finally:
+            lock.release()
+    finally:
+        with _single_flight_lock:
+            lock, waiting = _single_flight[key]
+            if waiting == 1:
+                del _single_flight[key]
+            else:
+                _single_flight[key] = (lock, waiting - 1)
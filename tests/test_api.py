@@ -1,8 +1,14 @@
+import json
 from urllib import urlencode
 
 from flask.ext.testing import TestCase
 
+from server.api import (get_adaptive_shop_ids, get_candidates,
+                        get_valid_tags, search_products)
 from server.app import create_app
+from server.models import Dataset, Products, Tags, Taggings
+from server.search import MATCH_ALL, TagSearch, get_search
+from server.utils import get_cache
 
 
 class TestAPI(TestCase):
@@ -47,6 +53,9 @@ class TestAPI(TestCase):
             products[-1]['popularity']
         )
 
+        popularity = [i['popularity'] for i in products]
+        self.assertEqual(popularity, sorted(popularity, reverse=True))
+
         # If tags is not passed into request, still should get results
         params = {
             'tags[]': '',
@@ -120,4 +129,384 @@ class TestAPI(TestCase):
         resp = self.client.get("/search?{0}".format(urlencode(params, True)))
         self.assertEqual(resp.status_code, 404)
 
+    def test_search_not_valid_numbers(self):
+        params = {
+            'radius': 500,
+            'count': 20,
+            'lat': float(59.33258),
+            'lng': float(18.0649)
+        }
+
+        for key, value in (('radius', '-1'), ('radius', 'inf'),
+                           ('radius', 'nan'), ('lat', 'inf'),
+                           ('lat', 'nan'), ('lng', '-inf')):
+            resp = self.client.get("/search?{0}".format(
+                urlencode(dict(params, **{key: value}))
+            ))
+            self.assertEqual(resp.status_code, 400, (key, value))
+
+        data = {
+            'points': [[59.33258, 18.0649]],
+            'radius': 1000,
+            'count': 10
+        }
+
+        for key, value in (('radius', -1), ('radius', 'inf'),
+                           ('radius', 'nan'), ('points', [['nan', 18.0]]),
+                           ('points', [[59.3, 'inf']])):
+            resp = self.client.post(
+                '/search/batch',
+                data=json.dumps(dict(data, **{key: value})),
+                content_type='application/json'
+            )
+            self.assertEqual(resp.status_code, 400, (key, value))
+
+    def test_get_valid_tags_dataset(self):
+        tag_search = TagSearch()
+        tag_search.set_positions(get_search(), {'reloaded': [0]})
+        dataset = Dataset()
+        dataset.tag_search = tag_search
+
+        self.assertEqual(
+            get_valid_tags(['reloaded', 'shirts', ''], dataset=dataset),
+            ['reloaded']
+        )
+        self.assertEqual(get_valid_tags(['reloaded', 'shirts']), ['shirts'])
+
+    def test_search_batch_tags_not_valid(self):
+        data = {
+            'points': [[59.33258, 18.0649]],
+            'radius': 1000,
+            'count': 10
+        }
+
+        for tags in (5, 'men', ['men', 5], {'men': 1}):
+            resp = self.client.post(
+                '/search/batch',
+                data=json.dumps(dict(data, tags=tags)),
+                content_type='application/json'
+            )
+            self.assertEqual(resp.status_code, 400, tags)
+
+    def test_search_tags_not_ascii(self):
+        params = {
+            'tags[]': [u'\xe9t\xe9'.encode('utf-8')],
+            'tags_match': 'all',
+            'radius': 500,
+            'count': 10,
+            'lat': float(59.33258),
+            'lng': float(18.0649)
+        }
+
+        resp = self.client.get("/search?{0}".format(urlencode(params, True)))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['products'], [])
+
+    def test_search_tags_match(self):
+        tags = ['men', 'women']
+        tag_ids = set(i.id for i in Tags().objects.filter({'tag__in': tags}))
+        shop_tags = {}
+
+        for shop_id, tag_id in Taggings().objects.values_list(
+                'shop_id', 'tag_id'):
+            if tag_id in tag_ids:
+                shop_tags.setdefault(shop_id, set()).add(tag_id)
+
+        params = {
+            'tags[]': tags,
+            'tags_match': 'all',
+            'radius': 3000,
+            'count': 20,
+            'lat': float(59.33258),
+            'lng': float(18.0649)
+        }
+
+        resp = self.client.get("/search?{0}".format(urlencode(params, True)))
+        products = resp.json['products']
+
+        self.assertGreaterEqual(len(products), 1)
+
+        for product in products:
+            self.assertEqual(shop_tags[product['shop']['id']], tag_ids)
+
+        params['tags[]'] = ['men', 'no such tag']
+        resp = self.client.get("/search?{0}".format(urlencode(params, True)))
+        self.assertEqual(resp.json['products'], [])
+
+        params['tags_match'] = 'some'
+        resp = self.client.get("/search?{0}".format(urlencode(params, True)))
+        self.assertEqual(resp.status_code, 400)
+
+    def test_search_stream(self):
+        self.app.config['SEARCH_STREAM_CHUNK_SIZE'] = 7
+        params = {
+            'radius': 3000,
+            'count': 50,
+            'lat': float(59.33258),
+            'lng': float(18.0649)
+        }
+        expected = json.loads(search_products(59.33258, 18.0649, 3000, 50,
+                                              []))
+
+        resp = self.client.get("/search?{0}".format(
+            urlencode(dict(params, stream='json'))
+        ))
+
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(len(expected['products']), 50)
+        self.assertEqual(resp.json, expected)
+
+        resp = self.client.get("/search?{0}".format(
+            urlencode(dict(params, stream='ndjson'))
+        ))
+        lines = resp.data.splitlines()
+
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        self.assertEqual([json.loads(i) for i in lines],
+                         expected['products'])
+
+        # Streamed products are not kept encoded
+        get_cache().clear()
+        resp = self.client.get("/search?{0}".format(
+            urlencode(dict(params, stream='ndjson', count=500))
+        ))
+        self.assertEqual(len(resp.data.splitlines()), 500)
+        self.assertEqual(get_cache().get_stats()['fragments']['items'], 0)
+
+        resp = self.client.get("/search?{0}".format(
+            urlencode(dict(params, stream='ndjson', lat=0, lng=0))
+        ))
+        self.assertEqual(resp.data, '')
+
+        resp = self.client.get("/search?{0}".format(
+            urlencode(dict(params, stream='json', lat=0, lng=0))
+        ))
+        self.assertEqual(resp.json, {'products': []})
+
+        resp = self.client.get("/search?{0}".format(
+            urlencode(dict(params, stream='xml'))
+        ))
+        self.assertEqual(resp.status_code, 400)
+
+    def test_metrics(self):
+        params = {
+            'radius': 500,
+            'count': 10,
+            'lat': float(59.33258),
+            'lng': float(18.0649)
+        }
+
+        for i in range(2):
+            self.client.get("/search?{0}".format(urlencode(params, True)))
+
+        resp = self.client.get('/metrics')
+        lines = resp.data.splitlines()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+
+        for stage in ('parse', 'cache', 'spatial', 'products', 'serialize',
+                      'jsonify'):
+            self.assertTrue(any(
+                i.startswith('search_stage_seconds_count{{stage="{0}"}}'
+                             .format(stage))
+                for i in lines
+            ), stage)
+
+        self.assertIn('cache_hits_total{namespace="search"} 1', lines)
+        self.assertIn('cache_misses_total{namespace="search"} 1', lines)
+        self.assertTrue(any(i.startswith('model_rows_scanned_total')
+                            for i in lines))
+        self.assertTrue(any(i.startswith('search_shops_returned_total')
+                            for i in lines))
+
+
+class TestAPISearchGrid(TestCase):
+    def create_app(self):
+        return create_app(
+            settings_overrides={
+                'TESTING': True,
+                'PRESERVE_CONTEXT_ON_EXCEPTION': False,
+                'SEARCH_GRID_SIZE': 0.005
+            }
+        )
+
+    def test_search(self):
+        for tags in ([], ['men', 'women']):
+            params = {
+                'tags[]': tags,
+                'radius': 500,
+                'count': 20,
+                'lat': float(59.33258),
+                'lng': float(18.0649)
+            }
+
+            resp = self.client.get(
+                "/search?{0}".format(urlencode(params, True))
+            )
+            products = resp.json['products']
+
+            self.app.config['SEARCH_GRID_SIZE'] = None
+            expected = json.loads(search_products(
+                59.33258,
+                18.0649,
+                500,
+                20,
+                tags
+            ))
+            self.app.config['SEARCH_GRID_SIZE'] = 0.005
+
+            self.assertGreaterEqual(len(products), 1)
+            self.assertEqual(
+                [i['popularity'] for i in products],
+                [i['popularity'] for i in expected['products']]
+            )
+
+    def test_search_radius_not_finite(self):
+        for radius in ('inf', '-inf', 'nan'):
+            params = {
+                'radius': radius,
+                'count': 20,
+                'lat': float(59.33258),
+                'lng': float(18.0649)
+            }
+            resp = self.client.get("/search?{0}".format(urlencode(params)))
+
+            self.assertEqual(resp.status_code, 400, radius)
+
+    def test_get_candidates_grid_size(self):
+        get_candidates(59.33258, 18.0649, 500, [], 1.0)
+        get_candidates(59.33258, 18.0649, 500, [], 1.0000001)
+
+        # Same cell and radius in cells, cached apart for each grid size
+        self.assertEqual(get_cache().get_stats()['candidates']['items'], 2)
+
+    def test_search_tags_match(self):
+        tags = ['men', 'women']
+        params = {
+            'tags[]': tags,
+            'tags_match': 'all',
+            'radius': 3000,
+            'count': 20,
+            'lat': float(59.33258),
+            'lng': float(18.0649)
+        }
+
+        resp = self.client.get("/search?{0}".format(urlencode(params, True)))
+
+        self.app.config['SEARCH_GRID_SIZE'] = None
+        expected = json.loads(search_products(59.33258, 18.0649, 3000, 20,
+                                              tags, MATCH_ALL))
+        self.app.config['SEARCH_GRID_SIZE'] = 0.005
+
+        self.assertGreaterEqual(len(expected['products']), 1)
+        self.assertEqual(resp.json, expected)
+
+    def test_search_batch(self):
+        points = [[59.33258, 18.0649], [59.338298666466834, 18.11972347031265]]
+        data = {
+            'points': points,
+            'radius': 1000,
+            'count': 10,
+            'tags': ['men', 'women']
+        }
+
+        resp = self.client.post(
+            '/search/batch',
+            data=json.dumps(data),
+            content_type='application/json'
+        )
+        results = resp.json['results']
+
+        self.assertEqual(len(results), 2)
+
+        for (lat, lng), result in zip(points, results):
+            self.assertEqual(
+                result,
+                json.loads(search_products(lat, lng, 1000, 10,
+                                           ['men', 'women']))
+            )
+
+        resp = self.client.post(
+            '/search/batch',
+            data=json.dumps({'points': [[59.33258]], 'count': 10}),
+            content_type='application/json'
+        )
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.post(
+            '/search/batch',
+            data=json.dumps(dict(data, tags_match='all')),
+            content_type='application/json'
+        )
+
+        for (lat, lng), result in zip(points, resp.json['results']):
+            self.assertEqual(
+                result,
+                json.loads(search_products(lat, lng, 1000, 10,
+                                           ['men', 'women'], MATCH_ALL))
+            )
+
+        resp = self.client.post('/search/batch', data='nope')
+        self.assertEqual(resp.status_code, 400)
+
+        self.app.config['SEARCH_BATCH_MAX_POINTS'] = 1
+        resp = self.client.post(
+            '/search/batch',
+            data=json.dumps(data),
+            content_type='application/json'
+        )
+        self.assertEqual(resp.status_code, 413)
+
+        # Too many points are rejected before any of them is converted
+        resp = self.client.post(
+            '/search/batch',
+            data=json.dumps(dict(data, points=[['x', 'y']] * 2)),
+            content_type='application/json'
+        )
+        self.assertEqual(resp.status_code, 413)
+
+
+class TestAPISearchAdaptive(TestCase):
+    def create_app(self):
+        return create_app(
+            settings_overrides={
+                'TESTING': True,
+                'PRESERVE_CONTEXT_ON_EXCEPTION': False,
+                'SEARCH_ADAPTIVE': True
+            }
+        )
+
+    def test_get_adaptive_shop_ids(self):
+        search = get_search()
+        points = []
+
+        def get_points(k):
+            points.append(k)
+            return search.get_points(59.33258, 18.0649, 2000, k)
+
+        shop_ids = get_adaptive_shop_ids(get_points, 100)
+        products = [Products().objects.filter({'shop_id': i})
+                    for i in shop_ids]
+
+        self.assertEqual(points[0], 8)
+        self.assertEqual(len(shop_ids), points[-1])
+        self.assertGreaterEqual(sum(len(i) for i in products), 100)
+        self.assertLess(
+            sum(len(i) for i in products[0:len(shop_ids) / 2]),
+            100
+        )
+
+    def test_search(self):
+        params = {
+            'radius': 2000,
+            'count': 20,
+            'lat': float(59.33258),
+            'lng': float(18.0649)
+        }
+
+        resp = self.client.get("/search?{0}".format(urlencode(params, True)))
+        products = resp.json['products']
 
+        self.assertEqual(len(products), 20)
@@ -0,0 +1,62 @@
+import json
+import shutil
+import tempfile
+from os.path import join
+from unittest import TestCase
+
+from server.benchmark import PERCENTILES, dump, measure, run
+from server.generator import DataGenerator
+from server.utils import load_data
+
+
+class TestBenchmark(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data_path = tempfile.mkdtemp()
+        DataGenerator(shops=300, products=3000).write(cls.data_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_path)
+        load_data()
+
+    def test_measure(self):
+        calls = []
+        result = measure(calls.append, 10)
+
+        self.assertEqual(calls, range(10))
+        self.assertEqual(result['count'], 10)
+
+        for i in PERCENTILES:
+            self.assertGreaterEqual(result['latency_ms']['p{0}'.format(i)], 0)
+
+    def test_run(self):
+        results = run(self.data_path, count=5, load_count=1, isolated=False)
+
+        self.assertEqual(
+            sorted(results['benchmarks']),
+            ['api', 'filter', 'load', 'query', 'set_shops']
+        )
+        self.assertEqual(
+            results['benchmarks']['query']['result']['count'],
+            5
+        )
+        self.assertIn('shop_id', results['benchmarks']['filter']['result'])
+
+        output_file = join(self.data_path, 'results.json')
+        dump(results, output_file)
+
+        with open(output_file, 'r') as infile:
+            self.assertEqual(
+                json.load(infile)['data_version'],
+                results['data_version']
+            )
+
+    def test_run_isolated(self):
+        results = run(self.data_path, names=['query'], count=5)
+        query = results['benchmarks']['query']
+
+        self.assertEqual(list(results['benchmarks']), ['query'])
+        self.assertNotIn('error', query)
+        self.assertGreater(query['peak_memory_kb'], 0)
+        self.assertGreater(query['result']['throughput'], 0)
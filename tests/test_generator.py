@@ -0,0 +1,61 @@
+import csv
+import filecmp
+import shutil
+import tempfile
+from os.path import join
+from unittest import TestCase
+
+from server.generator import CITIES, DataGenerator
+from server.models import Products, Shops, Tags, Taggings
+from server.utils import load_data
+
+
+class TestDataGenerator(TestCase):
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+        load_data()
+
+    def test_write(self):
+        counts = DataGenerator(shops=200, products=1000, tags=30).write(
+            self.data_path
+        )
+        load_data(self.data_path)
+
+        self.assertEqual(len(Shops().objects.all()), 200)
+        self.assertEqual(len(Products().objects.all()), 1000)
+        self.assertEqual(len(Tags().objects.all()), 30)
+        self.assertEqual(len(Taggings().objects.all()), counts['taggings'])
+        self.assertIn('tag29', [i.tag for i in Tags().objects.all()])
+
+        shop_ids = set(i.id for i in Shops().objects.all())
+        for product in Products().objects.all():
+            self.assertIn(product.shop_id, shop_ids)
+            self.assertTrue(0 <= product.popularity <= 1)
+
+        # Every shop is around one of the cities
+        for shop in Shops().objects.all():
+            self.assertLess(
+                min(abs(shop.lat - i[1]) + abs(shop.lng - i[2])
+                    for i in CITIES),
+                1
+            )
+
+    def test_seed(self):
+        other_path = tempfile.mkdtemp()
+        DataGenerator(shops=10, products=100, seed=1).write(self.data_path)
+        DataGenerator(shops=10, products=100, seed=1).write(other_path)
+
+        for file_name in ('shops.csv', 'products.csv', 'taggings.csv'):
+            self.assertTrue(filecmp.cmp(
+                join(self.data_path, file_name),
+                join(other_path, file_name),
+                shallow=False
+            ))
+
+        with open(join(self.data_path, 'products.csv'), 'rb') as infile:
+            self.assertEqual(len(list(csv.DictReader(infile))), 100)
+
+        shutil.rmtree(other_path)
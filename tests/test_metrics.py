@@ -0,0 +1,94 @@
+from unittest import TestCase
+
+from server.metrics import NOOP_SPAN, Histogram, Registry, timed
+
+
+class TestHistogram(TestCase):
+    def test_observe(self):
+        histogram = Histogram(buckets=(1, 2, 4))
+
+        for value in (0.5, 1.5, 1.5, 3, 10):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 16.5)
+        self.assertEqual(
+            histogram.get_cumulative_counts(),
+            [('1', 1), ('2', 3), ('4', 4), ('+Inf', 5)]
+        )
+
+    def test_get_quantile(self):
+        histogram = Histogram(buckets=(1, 2, 4))
+        self.assertIsNone(histogram.get_quantile(0.5))
+
+        for value in [0.5] * 50 + [1.5] * 45 + [3] * 5:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.get_quantile(0.5), 1)
+        self.assertAlmostEqual(histogram.get_quantile(0.95), 2)
+        self.assertAlmostEqual(histogram.get_quantile(0.99), 3.6)
+
+        histogram.observe(100)
+        self.assertEqual(histogram.get_quantile(1), 4)
+
+
+class TestRegistry(TestCase):
+    def test_span(self):
+        registry = Registry()
+
+        with registry.span('search_stage_seconds', stage='parse'):
+            pass
+
+        registry.inc('model_rows_scanned_total', 10, model='Products')
+        registry.inc('model_rows_scanned_total', 5, model='Products')
+
+        histogram = registry.get_histogram('search_stage_seconds',
+                                           stage='parse')
+        self.assertEqual(histogram.count, 1)
+        self.assertEqual(
+            registry.get_counter('model_rows_scanned_total',
+                                 model='Products'),
+            15
+        )
+
+        registry.enabled = False
+        self.assertIs(registry.span('search_stage_seconds'), NOOP_SPAN)
+        registry.inc('model_rows_scanned_total', 10, model='Products')
+        self.assertEqual(
+            registry.get_counter('model_rows_scanned_total',
+                                 model='Products'),
+            15
+        )
+
+    def test_render(self):
+        registry = Registry()
+        registry.observe('search_stage_seconds', 0.002, stage='parse')
+        registry.inc('model_rows_scanned_total', 3, model='Products')
+
+        lines = registry.render({
+            ('cache_hits_total', (('namespace', 'se"arch'), )): 2
+        }).splitlines()
+
+        self.assertIn('# TYPE search_stage_seconds histogram', lines)
+        self.assertIn(
+            'search_stage_seconds_bucket{stage="parse",le="0.0025"} 1',
+            lines
+        )
+        self.assertIn(
+            'search_stage_seconds_bucket{stage="parse",le="+Inf"} 1',
+            lines
+        )
+        self.assertIn('search_stage_seconds_count{stage="parse"} 1', lines)
+        self.assertIn('# TYPE search_stage_seconds_quantile gauge', lines)
+        self.assertIn('# TYPE model_rows_scanned_total counter', lines)
+        self.assertIn('model_rows_scanned_total{model="Products"} 3', lines)
+        self.assertIn('cache_hits_total{namespace="se\\"arch"} 2', lines)
+
+    def test_timed(self):
+        @timed('test_seconds')
+        def double(value):
+            return value * 2
+
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double.__name__, 'double')
@@ -1,13 +1,21 @@
+import json
 import os
 from unittest import TestCase
 from os.path import join, isfile
 from os import listdir
 
 from server import exceptions
-from server.models import ModelObjectManager, Tags, Products
+from server.models import (Dataset, Model, ModelObjectManager, Relation,
+                           Tags, Products, Shops, Taggings, get_dataset,
+                           set_dataset)
+from server.utils import LRUCache, load_data
 
 
 class TestModelObjectManager(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        load_data()
+
     def test_get_model_name(self):
         manager = ModelObjectManager(Tags())
 
@@ -17,10 +25,13 @@ class TestModelObjectManager(TestCase):
         manager = ModelObjectManager(Tags)
         allowed_lookup = manager.get_allowed_lookups()
 
-        self.assertEqual(len(allowed_lookup), 2)
+        self.assertEqual(len(allowed_lookup), 7)
         self.assertIn('in', allowed_lookup)
         self.assertIn('exact', allowed_lookup)
 
+        for lookup_type in ('gt', 'gte', 'lt', 'lte', 'range'):
+            self.assertIn(lookup_type, allowed_lookup)
+
     def test_filter_lookup_in(self):
         attr = 'tag'
         data = {attr: 'men'}
@@ -134,6 +145,244 @@ class TestModelObjectManager(TestCase):
         self.assertIsInstance(tags, list)
         self.assertEquals(len(tags), 0)
 
+    def test_get_plan(self):
+        manager = ModelObjectManager(Taggings())
+        TAG_ID = '4202dd8da64d4ebea7577f0f2b2e991b'
+        SHOP_ID = Taggings().objects.filter({'tag_id': TAG_ID})[0].shop_id
+        filters = {'id__in': ['nope'], 'shop_id': SHOP_ID, 'tag_id': TAG_ID}
+
+        plan = manager.get_plan(filters)
+
+        self.assertIs(plan, manager.get_plan(dict(filters, id__in=[])))
+        self.assertEqual(
+            [i[0] for i in plan.lookups],
+            ['shop_id', 'tag_id', 'id__in']
+        )
+        self.assertEqual(plan.index_lookup, 0)
+        self.assertEqual(
+            plan.get_lookups(filters)[2][3],
+            frozenset(['nope'])
+        )
+
+        with self.assertRaises(exceptions.LookupIsNotAllowed):
+            manager.get_plan({'id__in': [], 'tag_id__miow': TAG_ID})
+
+        del filters['id__in']
+        taggings = manager.filter(filters)
+
+        self.assertEqual(filters, {'shop_id': SHOP_ID, 'tag_id': TAG_ID})
+        self.assertEqual(len(taggings), 1)
+        self.assertEqual(
+            (taggings[0].shop_id, taggings[0].tag_id),
+            (SHOP_ID, TAG_ID)
+        )
+
+        manager.clear_plans()
+        self.assertIsNot(plan, manager.get_plan(filters))
+
+    def test_filter_range(self):
+        manager = Products().objects
+        products = manager.all()
+        popularity = sorted(i.popularity for i in products)
+        middle = popularity[len(popularity) / 2]
+        lookups = [
+            ('gt', middle, lambda i: i > middle),
+            ('gte', middle, lambda i: i >= middle),
+            ('lt', middle, lambda i: i < middle),
+            ('lte', middle, lambda i: i <= middle),
+            ('range', (0.25, middle), lambda i: 0.25 <= i <= middle)
+        ]
+
+        for lookup_type, value, check in lookups:
+            key = 'popularity__{0}'.format(lookup_type)
+            expected = [i.id for i in products if check(i.popularity)]
+            plan = manager.get_plan({key: value})
+
+            self.assertEqual(plan.index_lookup, 0)
+            self.assertEqual(
+                sorted(i.id for i in manager.filter({key: value})),
+                sorted(expected)
+            )
+
+        products = manager.filter({
+            'popularity__gte': middle,
+            'quantity__lt': 5,
+            'title__gt': 'Product 1'
+        })
+        self.assertGreaterEqual(len(products), 1)
+
+        for product in products:
+            self.assertGreaterEqual(product.popularity, middle)
+            self.assertLess(product.quantity, 5)
+            self.assertGreater(product.title, 'Product 1')
+
+    def test_build_sorted_indexes(self):
+        model_data = {
+            '1': {'name': 'me', 'age': 42},
+            '2': {'name': 'you', 'age': 23},
+            '3': {'name': 'wine', 'age': 2000}
+        }
+        indexes = ModelObjectManager.build_sorted_indexes(
+            model_data,
+            ('age', )
+        )
+
+        self.assertEqual(indexes.keys(), ['age'])
+        self.assertEqual(list(indexes['age'].keys), ['2', '1', '3'])
+        self.assertEqual(list(indexes['age'].get_keys('gt', 23)), ['1', '3'])
+
+    def test_build_indexes(self):
+        model_data = {
+            '1': {'name': 'me', 'age': 42},
+            '2': {'name': 'you', 'age': 23},
+            '3': {'name': 'wine', 'age': 42}
+        }
+        indexes = ModelObjectManager.build_indexes(model_data, ('age', ))
+
+        self.assertEqual(indexes.keys(), ['age'])
+        self.assertEqual(sorted(indexes['age'][42]), ['1', '3'])
+        self.assertEqual(indexes['age'][23], ['2'])
+
+    def test_get_index_pks(self):
+        manager = ModelObjectManager(Taggings())
+        TAG_ID = '4202dd8da64d4ebea7577f0f2b2e991b'
+
+        self.assertIn('tag_id', manager.get_indexes())
+        self.assertIsNone(manager.get_index_pks({'id__miow': 'x'}))
+
+        pks = manager.get_index_pks({'tag_id__exact': TAG_ID})
+        expected = [pk for pk, tag_id in manager.values_list('id', 'tag_id')
+                    if tag_id == TAG_ID]
+
+        self.assertEqual(sorted(pks), sorted(expected))
+
+        pks = manager.get_index_pks({'id__in': [expected[0], 'nope']})
+        self.assertEqual(pks, [expected[0]])
+
+        taggings = manager.filter({'tag_id__in': [TAG_ID]})
+        self.assertEqual(sorted(i.id for i in taggings), sorted(expected))
+
+    def test_merge(self):
+        manager = ModelObjectManager(Products())
+        shop_ids = list(set(
+            shop_id for shop_id, in manager.values_list('shop_id')
+        ))[0:20]
+        expected = manager.filter(
+            {'shop_id__in': shop_ids},
+            ('popularity', ModelObjectManager.SORT_BY_DESCENDING)
+        )
+
+        products = manager.merge('shop_id', shop_ids, 10)
+
+        self.assertEqual(len(products), 10)
+        self.assertEqual(
+            [i.popularity for i in products],
+            [i.popularity for i in expected[0:10]]
+        )
+
+        products = manager.merge('shop_id', shop_ids, len(expected) + 10)
+        self.assertEqual(len(products), len(expected))
+
+        self.assertEqual(manager.merge('shop_id', ['nope'], 10), [])
+
+        with self.assertRaises(exceptions.FieldDoesNotExist):
+            manager.merge('title', shop_ids, 10)
+
+    def test_iter_merge(self):
+        manager = ModelObjectManager(Products())
+        shop_ids = list(set(
+            shop_id for shop_id, in manager.values_list('shop_id')
+        ))[0:20]
+        expected = manager.merge('shop_id', shop_ids, 1000)
+
+        self.assertEqual(
+            [i.id for i in manager.iter_merge('shop_id', shop_ids)],
+            [i.id for i in expected]
+        )
+        self.assertEqual(list(manager.iter_merge('shop_id', ['nope'])), [])
+
+        with self.assertRaises(exceptions.FieldDoesNotExist):
+            manager.iter_merge('title', shop_ids)
+
+    def test_get_fragments(self):
+        manager = ModelObjectManager(Products())
+        products = manager.all()[0:10]
+        cache = LRUCache()
+
+        fragments = manager.get_fragments(products, cache)
+
+        self.assertEqual([json.loads(i) for i in fragments],
+                         [i.to_dict() for i in products])
+        self.assertEqual(cache.get_stats()['fragments']['items'],
+                         10 + len(set(i.shop_id for i in products)))
+
+        # Encoded once, the same fragments are joined again
+        again = manager.get_fragments(products[::-1], cache)[::-1]
+        self.assertEqual(again, fragments)
+        self.assertEqual(cache.get_stats()['fragments']['hits'], 10)
+
+        # Without storing them, only the cached ones are used
+        others = manager.all()[10:20]
+        self.assertEqual(manager.get_fragments(others, cache, store=False),
+                         manager.get_fragments(others))
+        self.assertEqual(cache.get_stats()['fragments']['items'],
+                         10 + len(set(i.shop_id for i in products)))
+
+        # Without a cache they're encoded again
+        self.assertEqual(manager.get_fragments(products), fragments)
+        self.assertEqual(manager.get_fragments([]), [])
+
+    def test_get_fragments_quota(self):
+        manager = ModelObjectManager(Products())
+        products = manager.all()[0:100]
+        cache = LRUCache(quotas={'fragments': 4096})
+
+        fragments = manager.get_fragments(products, cache)
+
+        self.assertEqual([json.loads(i) for i in fragments],
+                         [i.to_dict() for i in products])
+        self.assertLessEqual(cache.get_stats()['fragments']['size'], 4096)
+        self.assertGreater(cache.get_stats()['fragments']['evictions'], 0)
+
+    def test_values_list(self):
+        manager = ModelObjectManager(Tags())
+        values = manager.values_list('id', 'tag')
+
+        self.assertIsInstance(values, list)
+        self.assertEqual(len(values), len(manager.all()))
+        self.assertIn(('b4a59f0e2e1342efa451237125bb331a', 'trousers'), values)
+
+        with self.assertRaises(exceptions.FieldDoesNotExist):
+            manager.values_list('id', 'tagz')
+
+    def test_select_related(self):
+        manager = Taggings().objects
+        taggings = manager.all(select_related=('shop', 'tag'))[0:500]
+        shops = {}
+
+        for tagging in taggings:
+            self.assertTrue(hasattr(tagging, '_shop'))
+            self.assertTrue(hasattr(tagging, '_tag'))
+            self.assertEqual(tagging.shop.id, tagging.shop_id)
+            self.assertEqual(tagging.tag.id, tagging.tag_id)
+            self.assertIs(shops.setdefault(tagging.shop_id, tagging.shop),
+                          tagging.shop)
+
+        products = Products().objects.merge('shop_id', list(shops), 100,
+                                            ('shop', ))
+        product_shops = {}
+        self.assertEqual(len(products), 100)
+
+        for product in products:
+            self.assertEqual(product.shop.id, product.shop_id)
+            self.assertIs(
+                product_shops.setdefault(product.shop_id, product.shop),
+                product.shop
+            )
+
+        with self.assertRaises(exceptions.FieldDoesNotExist):
+            manager.filter({'tag_id': taggings[0].tag_id}, None, ('miow', ))
+
     def test_sort_by(self):
         data_list = [
             {
@@ -166,6 +415,10 @@ class TestModelObjectManager(TestCase):
 
 
 class TestModel(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        load_data()
+
     def test_get_model_field_names(self):
         TAG_ID = 'b4a59f0e2e1342efa451237125bb331a'
         tag = Tags().objects.get(TAG_ID)
@@ -205,6 +458,67 @@ class TestModel(TestCase):
         self.assertIsNotNone(product_dict['shop'])
         self.assertIsInstance(product_dict['shop'], dict)
 
+    def test_relation(self):
+        PRODUCT_ID = 'e4ce888809454e80a49adec1de0b35a5'
+        product = Products().objects.get(PRODUCT_ID)
+
+        self.assertFalse(hasattr(product, '_shop'))
+        self.assertIsInstance(product.shop, Shops)
+        self.assertEqual(product.shop.id, product.shop_id)
+        self.assertIs(product.shop, product._shop)
+        self.assertIs(Products.objects, Products().objects)
+        self.assertIsNot(Products.objects, Tags.objects)
+
+    def test_relation_dataset(self):
+        PRODUCT_ID = 'e4ce888809454e80a49adec1de0b35a5'
+        dataset = get_dataset()
+        product = Products().objects.get(PRODUCT_ID)
+
+        set_dataset(Dataset())
+        try:
+            shop = product.shop
+        finally:
+            set_dataset(dataset)
+
+        self.assertEqual(shop.id, product.shop_id)
+        self.assertIs(product._dataset, dataset)
+        self.assertIs(shop._dataset, dataset)
+
+    def test_schema(self):
+        PRODUCT_ID = 'e4ce888809454e80a49adec1de0b35a5'
+        product = Products().objects.get(PRODUCT_ID)
+
+        self.assertFalse(hasattr(product, '__dict__'))
+        self.assertEqual(
+            product.get_model_field_names(),
+            ['id', 'shop_id', 'title', 'popularity', 'quantity']
+        )
+        self.assertIsInstance(product.popularity, float)
+        self.assertIsInstance(product.quantity, int)
+        self.assertIsInstance(product.shop.lat, float)
+        self.assertEqual(
+            product.get_values(),
+            tuple(getattr(product, i) for i in product.fields)
+        )
+
+        self.assertEqual(
+            Products.to_python({'popularity': '0.5', 'title': '1'}),
+            {'popularity': 0.5, 'title': '1'}
+        )
+
+    def test_without_schema(self):
+        class Wines(Model):
+            shop = Relation('shop_id')
+
+        shop_id = Shops().objects.all()[0].id
+        wine = Wines(id='a', name='wine', shop_id=shop_id)
+
+        self.assertEqual(sorted(wine.get_model_field_names()),
+                         ['id', 'name', 'shop_id'])
+        self.assertEqual(wine.to_dict()['name'], 'wine')
+        self.assertEqual(wine.to_dict()['shop']['id'], shop_id)
+        self.assertEqual(Wines.to_python({'age': '1'}), {'age': '1'})
+
     def test_special_getitem(self):
         TAG_ID = 'b4a59f0e2e1342efa451237125bb331a'
         tag = Tags().objects.get(TAG_ID)
@@ -0,0 +1,116 @@
+import os
+import pstats
+import shutil
+import tempfile
+from urllib import urlencode
+
+from flask.ext.testing import TestCase
+
+from server.app import create_app
+
+PARAMS = urlencode({
+    'radius': 500,
+    'count': 10,
+    'lat': 59.33258,
+    'lng': 18.0649
+})
+
+
+class TestProfiling(TestCase):
+    def create_app(self):
+        self.profile_dir = tempfile.mkdtemp()
+
+        return create_app(
+            settings_overrides={
+                'TESTING': True,
+                'PRESERVE_CONTEXT_ON_EXCEPTION': False,
+                'PROFILE_ENABLED': True,
+                'PROFILE_DIR': self.profile_dir,
+                'PROFILE_TOP': 5,
+                'ADMIN_TOKEN': 'secret'
+            }
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+
+    def test_header(self):
+        resp = self.client.get('/search?' + PARAMS,
+                               headers={'X-Profile': '1'})
+        self.assertNotIn('X-Profile-Path', resp.headers)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+        resp = self.client.get('/search?' + PARAMS, headers={
+            'X-Profile': '1',
+            'X-Admin-Token': 'secret'
+        })
+        path = resp.headers['X-Profile-Path']
+
+        self.assertIn('products', resp.json)
+        self.assertTrue(path.startswith(self.profile_dir))
+        self.assertTrue(os.path.isfile(path[:-len('.pstats')] + '.txt'))
+        self.assertGreater(pstats.Stats(path).total_calls, 0)
+
+    def test_inline(self):
+        resp = self.client.get('/search?' + PARAMS, headers={
+            'X-Profile': 'inline',
+            'X-Admin-Token': 'secret'
+        })
+
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn('function calls', resp.data)
+        self.assertIn('search', resp.data)
+
+    def test_cached(self):
+        self.app.config['PROFILE_TOP'] = 50
+
+        # Cached by a request which isn't profiled
+        self.client.get('/search?' + PARAMS)
+
+        resp = self.client.get('/search?' + PARAMS, headers={
+            'X-Profile': 'inline',
+            'X-Admin-Token': 'secret'
+        })
+
+        self.assertIn('search_products', resp.data)
+
+    def test_sample(self):
+        self.app.config['PROFILE_SAMPLE_PERCENT'] = 100
+        resp = self.client.get('/search?' + PARAMS,
+                               headers={'X-Admin-Token': 'secret'})
+        self.assertIn('X-Profile-Path', resp.headers)
+
+        # The path is not shown to the other callers, the profile is dumped
+        resp = self.client.get('/search?' + PARAMS)
+        self.assertNotIn('X-Profile-Path', resp.headers)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 4)
+
+        # Other endpoints are not profiled
+        resp = self.client.get('/metrics')
+        self.assertNotIn('X-Profile-Path', resp.headers)
+
+        self.app.config['PROFILE_SAMPLE_PERCENT'] = 0
+        resp = self.client.get('/search?' + PARAMS)
+        self.assertNotIn('X-Profile-Path', resp.headers)
+
+
+class TestProfilingDisabled(TestCase):
+    def create_app(self):
+        return create_app(
+            settings_overrides={
+                'TESTING': True,
+                'PRESERVE_CONTEXT_ON_EXCEPTION': False,
+                'ADMIN_TOKEN': 'secret'
+            }
+        )
+
+    def test_disabled(self):
+        self.assertEqual(self.app.before_request_funcs, {})
+
+        resp = self.client.get('/search?' + PARAMS, headers={
+            'X-Profile': 'inline',
+            'X-Admin-Token': 'secret'
+        })
+
+        self.assertIn('products', resp.json)
+        self.assertNotIn('X-Profile-Path', resp.headers)
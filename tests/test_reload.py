@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+from urllib import urlencode
+
+from flask.ext.testing import TestCase
+
+from server.app import create_app
+from server.models import Products, get_dataset
+from server.utils import get_data_path, load_data
+
+PRODUCT_ID = 'f' * 32
+SHOP_ID = '4aa53e646bf84faca9a76c020b0682de'
+
+
+class TestDataReloader(TestCase):
+    def create_app(self):
+        self.data_path = tempfile.mkdtemp()
+        self.watching = []
+
+        for file_name in os.listdir(get_data_path()):
+            shutil.copy(os.path.join(get_data_path(), file_name),
+                        self.data_path)
+
+        return create_app(
+            settings_overrides={
+                'TESTING': True,
+                'PRESERVE_CONTEXT_ON_EXCEPTION': False,
+                'DATA_PATH': self.data_path,
+                'ADMIN_TOKEN': 'secret'
+            }
+        )
+
+    def tearDown(self):
+        for reloader in self.watching:
+            reloader.stop_watching()
+
+        shutil.rmtree(self.data_path)
+        load_data()
+
+    def add_product(self):
+        products_file = os.path.join(self.data_path, 'products.csv')
+
+        with open(products_file, 'a') as outfile:
+            outfile.write('{0},{1},Best seller,1000.0,1\n'.format(
+                PRODUCT_ID,
+                SHOP_ID
+            ))
+
+        # Modification times may be in seconds
+        mtime = os.path.getmtime(products_file) + 10
+        os.utime(products_file, (mtime, mtime))
+
+    def search(self):
+        params = {
+            'radius': 500,
+            'count': 5,
+            'lat': 59.33265972650577,
+            'lng': 18.06061237898499
+        }
+        resp = self.client.get('/search?{0}'.format(urlencode(params)))
+
+        return [i['id'] for i in resp.json['products']]
+
+    def test_reload(self):
+        reloader = self.app.extensions['data_reloader']
+        dataset = get_dataset()
+        manager = Products().objects
+
+        self.assertFalse(reloader.is_stale())
+        self.assertIsNone(reloader.reload())
+        self.assertIs(get_dataset(), dataset)
+        self.assertNotIn(PRODUCT_ID, self.search())
+
+        self.add_product()
+        self.assertTrue(reloader.is_stale())
+
+        version = reloader.reload()
+
+        self.assertIsNotNone(version)
+        self.assertNotEqual(version, dataset.version)
+        self.assertEqual(get_dataset().version, version)
+        self.assertIsNotNone(get_dataset().search)
+        self.assertIsNotNone(get_dataset().tag_search)
+        self.assertEqual(Products().objects.get(PRODUCT_ID).shop_id, SHOP_ID)
+        self.assertEqual(self.search()[0], PRODUCT_ID)
+
+        # Managers of the previous dataset keep working on it
+        self.assertIs(manager.dataset, dataset)
+        self.assertNotIn(PRODUCT_ID, manager.get_raw_data()['Products'])
+
+    def test_reload_in_background(self):
+        reloader = self.app.extensions['data_reloader']
+        self.add_product()
+
+        reloader.reload_in_background().join()
+
+        self.assertFalse(reloader.is_stale())
+        self.assertEqual(self.search()[0], PRODUCT_ID)
+
+    def test_start_watching(self):
+        reloader = self.app.extensions['data_reloader']
+        self.assertIsNone(reloader.watcher_pid)
+
+        # Started by the first request of each process, not by create_app
+        self.app.config['DATA_RELOAD_INTERVAL'] = 3600
+        app = create_app(settings_overrides=self.app.config)
+        reloader = app.extensions['data_reloader']
+        self.watching.append(reloader)
+        self.assertIsNone(reloader.watcher_pid)
+
+        app.test_client().get('/metrics')
+        self.assertEqual(reloader.watcher_pid, os.getpid())
+        self.assertIsNone(reloader.start_watching(3600))
+        threads = [reloader.watcher_thread]
+
+        # Like in a forked worker, where the thread of the master is gone
+        reloader.watcher_pid = -1
+        app.test_client().get('/metrics')
+        self.assertEqual(reloader.watcher_pid, os.getpid())
+        threads.append(reloader.watcher_thread)
+
+        reloader.stop_watching()
+        self.assertIsNone(reloader.watcher_pid)
+        for thread in threads:
+            thread.join(1)
+            self.assertFalse(thread.is_alive())
+
+    def test_admin_reload(self):
+        resp = self.client.post('/admin/reload')
+        self.assertEqual(resp.status_code, 403)
+
+        resp = self.client.post('/admin/reload',
+                                headers={'X-Admin-Token': 'nope'})
+        self.assertEqual(resp.status_code, 403)
+
+        resp = self.client.post('/admin/reload',
+                                headers={'X-Admin-Token': 'secret'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {
+            'version': get_dataset().version,
+            'reloading': False
+        })
+
+        # The data is read in the background
+        version = get_dataset().version
+        self.add_product()
+        resp = self.client.post('/admin/reload',
+                                headers={'X-Admin-Token': 'secret'})
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue(resp.json['reloading'])
+        self.app.extensions['data_reloader'].reload_thread.join()
+        self.assertNotEqual(get_dataset().version, version)
+        self.assertEqual(self.search()[0], PRODUCT_ID)
+
+        self.app.config['ADMIN_TOKEN'] = None
+        resp = self.client.post('/admin/reload',
+                                headers={'X-Admin-Token': 'secret'})
+        self.assertEqual(resp.status_code, 404)
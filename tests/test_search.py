@@ -1,19 +1,33 @@
+import shutil
+import tempfile
+from collections import namedtuple
 from unittest import TestCase
 
+import numpy
 import scipy
 
-from server.models import Shops
-from server.search import Search
+import server.search
+from server.models import Shops, Tags, Taggings
+from server.search import (EARTH_RADIUS, MATCH_ALL, Search, TagSearch,
+                           get_cell, get_jobs_kwargs, get_search,
+                           get_tag_search, reset_search, to_chord, to_meters,
+                           to_unit_vectors)
+from server.utils import load_data
 
 
 class TestSearch(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        load_data()
+
     def test_get_locations(self):
         search = Search()
         search.set_shops(Shops().objects.all())
         locations = search.get_locations()
 
         self.assertIsNotNone(locations)
-        self.assertIsInstance(locations, list)
+        self.assertIsInstance(locations, numpy.ndarray)
+        self.assertEqual(locations.shape, (len(search.shop_ids), 2))
 
     def test_get_ckdtree(self):
         search = Search()
@@ -59,3 +73,388 @@ class TestSearch(TestCase):
         self.assertIsNotNone(shops)
         self.assertIsInstance(shops, list)
         self.assertEqual(len(shops), MAX_LOCATIONS)
+
+    def test_set_shops(self):
+        Shop = namedtuple('Shop', 'id lat lng')
+        shops = [
+            Shop('a', 59.33, 18.06),
+            Shop('b', 59.33, 18.06),
+            Shop('c', 59.34, 18.07)
+        ]
+        search = Search()
+        search.set_shops(shops)
+
+        points = search.get_points(59.33, 18.06, 100, None)
+        self.assertEqual(sorted(points), [0, 1])
+        self.assertEqual(sorted(search.get_shop_ids(points)), ['a', 'b'])
+        self.assertEqual(
+            search.query_many([(59.33, 18.06)], 100, 5),
+            [search.get_points(59.33, 18.06, 100, 5)]
+        )
+        self.assertEqual(len(search.get_points(59.33, 18.06, 100, 5)), 2)
+
+        other = Search()
+        other.set_shops(shops[2:])
+
+        self.assertEqual(other.get_points(59.33, 18.06, 100, None), [])
+        self.assertEqual(other.get_shop_ids([0]), ['c'])
+        self.assertEqual(search.get_shop_ids([2]), ['c'])
+
+    def test_get_points_shop_ids(self):
+        search = Search()
+        shops = Shops().objects.all()
+        search.set_shops(shops)
+        shop_ids = set(i.id for i in shops[0:100])
+        MAX_LOCATIONS = 25
+
+        points = search.get_points(
+            latitude=59.338298666466834,
+            longitude=18.11972347031265,
+            max_locations=MAX_LOCATIONS,
+            shop_ids=shop_ids
+        )
+        shops = search.get_nearby_shops(points)
+
+        self.assertIsInstance(points, list)
+        self.assertLessEqual(len(points), MAX_LOCATIONS)
+        self.assertGreaterEqual(len(points), 1)
+
+        for shop in shops:
+            self.assertIn(shop.id, shop_ids)
+
+    def test_get_candidate_points(self):
+        search = get_search()
+        candidates = search.get_candidates(59.33, 18.11, 3000)
+
+        self.assertGreaterEqual(len(candidates), 1)
+        self.assertLess(len(candidates), len(search.get_locations()))
+
+        points = search.get_candidate_points(
+            candidates,
+            latitude=59.338298666466834,
+            longitude=18.11972347031265,
+            distance=1000,
+            max_locations=25
+        )
+        expected = search.get_points(
+            latitude=59.338298666466834,
+            longitude=18.11972347031265,
+            distance=1000,
+            max_locations=25
+        )
+
+        self.assertEqual(sorted(points), sorted(expected))
+
+    def test_get_neighbours(self):
+        search = get_search()
+        latitude = 59.338298666466834
+        longitude = 18.11972347031265
+        DISTANCE = 1000
+
+        neighbours = search.get_neighbours(
+            latitude,
+            longitude,
+            distance=DISTANCE,
+            max_locations=10000
+        )
+
+        self.assertGreaterEqual(len(neighbours), 1)
+
+        for dist, point in neighbours:
+            lat, lng = search.get_locations()[point]
+            lat1, lng1, lat2, lng2 = numpy.radians(
+                [latitude, longitude, float(lat), float(lng)]
+            )
+            haversine = 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(
+                numpy.sin((lat2 - lat1) / 2) ** 2 +
+                numpy.cos(lat1) * numpy.cos(lat2) *
+                numpy.sin((lng2 - lng1) / 2) ** 2
+            ))
+
+            self.assertLessEqual(dist, DISTANCE)
+            self.assertAlmostEqual(dist, haversine, places=3)
+
+    def test_to_chord(self):
+        self.assertEqual(to_chord(None), numpy.inf)
+        self.assertAlmostEqual(to_chord(numpy.pi * EARTH_RADIUS), 2)
+        self.assertAlmostEqual(
+            to_meters(numpy.array([to_chord(2000)]))[0],
+            2000
+        )
+
+        points = to_unit_vectors([(0, 0), (90, 0), (0, 90)])
+        self.assertTrue(numpy.allclose(
+            points,
+            [[1, 0, 0], [0, 0, 1], [0, 1, 0]]
+        ))
+
+    def test_get_points_radius(self):
+        search = get_search()
+        latitude = 59.338298666466834
+        longitude = 18.11972347031265
+
+        points = search.get_points(latitude, longitude, 1000, None)
+        expected = search.get_points(latitude, longitude, 1000, 10000)
+
+        self.assertGreater(len(points), 50)
+        self.assertEqual(sorted(points), sorted(expected))
+
+        tag_search = get_tag_search()
+        points = tag_search.get_points(
+            ['men'],
+            latitude,
+            longitude,
+            1000,
+            None
+        )
+        expected = tag_search.get_points(
+            ['men'],
+            latitude,
+            longitude,
+            1000,
+            10000
+        )
+
+        self.assertGreaterEqual(len(points), 1)
+        self.assertEqual(sorted(points), sorted(expected))
+
+    def test_query_many(self):
+        search = get_search()
+        locations = [
+            (59.338298666466834, 18.11972347031265),
+            (59.33258, 18.0649),
+            (0.0, 0.0)
+        ]
+
+        for max_locations in (1, 25, None):
+            points = search.query_many(locations, 1000, max_locations, 2)
+            expected = [
+                search.get_points(lat, lng, 1000, max_locations)
+                for lat, lng in locations
+            ]
+
+            self.assertEqual(points, expected)
+
+        self.assertEqual(points[2], [])
+        self.assertEqual(search.query_many([], 1000), [])
+
+    def test_query_many_without_n_jobs(self):
+        search = get_search()
+        locations = [
+            (59.338298666466834, 18.11972347031265),
+            (59.33258, 18.0649)
+        ]
+        expected = [
+            search.query_many(locations, 1000, i, 2) for i in (25, None)
+        ]
+
+        # Like scipy before 0.16, where the queries have no ``n_jobs``
+        ckdtree_n_jobs = server.search.CKDTREE_N_JOBS
+        server.search.CKDTREE_N_JOBS = False
+
+        try:
+            self.assertEqual(
+                [search.query_many(locations, 1000, i, 2) for i in (25, None)],
+                expected
+            )
+            self.assertEqual(get_jobs_kwargs(2), {})
+        finally:
+            server.search.CKDTREE_N_JOBS = ckdtree_n_jobs
+
+    def test_get_cell(self):
+        self.assertEqual(get_cell(59.338, 18.119, 0.01), (5933, 1811))
+        self.assertEqual(get_cell(-0.001, 0.001, 0.01), (-1, 0))
+
+    def test_save_open(self):
+        search = get_search()
+        path = tempfile.mkdtemp()
+        search.save(path)
+        opened = Search.open(path)
+        shutil.rmtree(path)
+
+        self.assertIsInstance(opened.shop_ids, numpy.memmap)
+        self.assertTrue(numpy.array_equal(opened.shop_ids, search.shop_ids))
+        self.assertEqual(
+            opened.get_points(59.338298666466834, 18.11972347031265),
+            search.get_points(59.338298666466834, 18.11972347031265)
+        )
+
+    def test_get_search(self):
+        reset_search()
+        search = get_search()
+
+        self.assertIsInstance(search, Search)
+        self.assertIs(search, get_search())
+        self.assertIsNotNone(search.get_ckdtree())
+
+        reset_search()
+        self.assertIsNot(search, get_search())
+
+
+class TestTagSearch(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        load_data()
+
+    def test_get_points(self):
+        tag_search = get_tag_search()
+        search = get_search()
+        tags = ['men', 'women']
+        MAX_LOCATIONS = 50
+
+        self.assertIsInstance(tag_search, TagSearch)
+        self.assertIs(tag_search, get_tag_search())
+        self.assertIn('men', tag_search.get_tags())
+
+        tag_ids = [i.id for i in Tags().objects.filter({'tag__in': tags})]
+        shop_ids = set(
+            shop_id for shop_id, tag_id
+            in Taggings().objects.values_list('shop_id', 'tag_id')
+            if tag_id in tag_ids
+        )
+
+        points = tag_search.get_points(
+            tags,
+            latitude=59.338298666466834,
+            longitude=18.11972347031265,
+            max_locations=MAX_LOCATIONS
+        )
+        expected = search.get_points(
+            latitude=59.338298666466834,
+            longitude=18.11972347031265,
+            max_locations=MAX_LOCATIONS,
+            shop_ids=shop_ids
+        )
+
+        self.assertEqual(len(points), MAX_LOCATIONS)
+        self.assertEqual(len(set(points)), MAX_LOCATIONS)
+        self.assertEqual(points, expected)
+
+        points = tag_search.get_points(
+            ['no such tag'],
+            latitude=59.338298666466834,
+            longitude=18.11972347031265
+        )
+        self.assertEqual(points, [])
+
+    def test_query_many(self):
+        tag_search = get_tag_search()
+        locations = [
+            (59.338298666466834, 18.11972347031265),
+            (59.33258, 18.0649)
+        ]
+        tags = ['men', 'women']
+
+        for max_locations in (25, None):
+            points = tag_search.query_many(
+                tags,
+                locations,
+                1000,
+                max_locations
+            )
+            expected = [
+                tag_search.get_points(tags, lat, lng, 1000, max_locations)
+                for lat, lng in locations
+            ]
+
+            self.assertEqual(points, expected)
+
+        self.assertEqual(
+            tag_search.query_many(['no such tag'], locations),
+            [[], []]
+        )
+
+    def test_get_positions(self):
+        tag_search = get_tag_search()
+        search = get_search()
+        tag_id = Tags().objects.filter({'tag': 'men'})[0].id
+        shop_ids = set(
+            shop_id for shop_id, tag_id_
+            in Taggings().objects.values_list('shop_id', 'tag_id')
+            if tag_id_ == tag_id
+        )
+
+        positions = tag_search.get_positions(['men', 'no such tag'])
+
+        self.assertEqual(sorted(search.get_shop_ids(positions)),
+                         sorted(shop_ids))
+        self.assertEqual(len(tag_search.get_positions([])), 0)
+
+    def test_get_mask(self):
+        tag_search = get_tag_search()
+        search = get_search()
+        men = tag_search.get_mask(['men'])
+        women = tag_search.get_mask(['women'])
+
+        self.assertEqual(men.dtype, bool)
+        self.assertEqual(len(men), len(search.shop_ids))
+        self.assertTrue(numpy.array_equal(
+            tag_search.get_mask(['men', 'women']),
+            men | women
+        ))
+        self.assertTrue(numpy.array_equal(
+            tag_search.get_mask(['men', 'women'], MATCH_ALL),
+            men & women
+        ))
+        self.assertTrue(numpy.array_equal(
+            tag_search.get_positions(['men', 'women'], MATCH_ALL),
+            numpy.flatnonzero(men & women)
+        ))
+        self.assertFalse(
+            tag_search.get_mask(['men', 'no such tag'], MATCH_ALL).any()
+        )
+        self.assertFalse(tag_search.get_mask([], MATCH_ALL).any())
+
+    def test_save_open(self):
+        tag_search = get_tag_search()
+        path = tempfile.mkdtemp()
+        tag_search.save(path)
+        opened = TagSearch.open(path, get_search())
+        shutil.rmtree(path)
+
+        self.assertEqual(sorted(opened.get_tags()),
+                         sorted(tag_search.get_tags()))
+        self.assertIsInstance(opened.masks['men'], numpy.memmap)
+        self.assertTrue(numpy.array_equal(
+            opened.get_mask(['men', 'women']),
+            tag_search.get_mask(['men', 'women'])
+        ))
+        self.assertEqual(
+            opened.get_points(['men'], 59.338298666466834, 18.11972347031265),
+            tag_search.get_points(['men'], 59.338298666466834,
+                                  18.11972347031265)
+        )
+
+    def test_get_points_mask(self):
+        tag_search = get_tag_search()
+        search = get_search()
+        mask = tag_search.get_mask(['men', 'women'], MATCH_ALL)
+        shop_ids = set(search.get_shop_ids(numpy.flatnonzero(mask)))
+
+        for max_locations in (5, None):
+            points = search.get_points(
+                59.338298666466834,
+                18.11972347031265,
+                3000,
+                max_locations,
+                mask=mask
+            )
+            expected = search.get_points(
+                59.338298666466834,
+                18.11972347031265,
+                3000,
+                max_locations,
+                shop_ids=shop_ids
+            )
+
+            self.assertGreaterEqual(len(points), 1)
+            self.assertEqual(points, expected)
+            self.assertEqual(
+                search.query_many(
+                    [(59.338298666466834, 18.11972347031265)],
+                    3000,
+                    max_locations,
+                    mask=mask
+                ),
+                [points]
+            )
@@ -0,0 +1,217 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from os.path import join
+from unittest import TestCase
+
+import numpy
+
+from server import snapshot, utils
+from server.app import create_app
+from server.models import Products, Shops, get_dataset
+from server.search import get_search, get_tag_search
+from server.snapshot import (BUILD_LOCK_SUFFIX, LOCK_SUFFIX, MANIFEST_FILE,
+                             build_snapshot, is_snapshot_stale,
+                             load_or_build_snapshot, load_snapshot,
+                             open_or_build_snapshot)
+from server.storage import ColumnarTable, ColumnIndex, SortedIndex
+from server.utils import load_data
+
+
+class TestSnapshot(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.snapshot_path = tempfile.mkdtemp()
+        build_snapshot(cls.snapshot_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.snapshot_path)
+        for suffix in (LOCK_SUFFIX, BUILD_LOCK_SUFFIX):
+            if os.path.exists(cls.snapshot_path + suffix):
+                os.remove(cls.snapshot_path + suffix)
+        load_data()
+
+    def test_is_snapshot_stale(self):
+        empty_path = tempfile.mkdtemp()
+        self.assertTrue(is_snapshot_stale(empty_path))
+        shutil.rmtree(empty_path)
+
+        self.assertFalse(is_snapshot_stale(self.snapshot_path))
+
+        manifest_file = join(self.snapshot_path, MANIFEST_FILE)
+        with open(manifest_file, 'r') as infile:
+            manifest = infile.read()
+
+        with open(manifest_file, 'w') as outfile:
+            json.dump({'mtimes': {'shops.csv': 0}}, outfile)
+
+        self.assertTrue(is_snapshot_stale(self.snapshot_path))
+
+        with open(manifest_file, 'w') as outfile:
+            outfile.write(manifest)
+
+    def test_load_snapshot(self):
+        load_snapshot(self.snapshot_path)
+
+        raw_data = get_dataset().raw_data
+        self.assertIn('Products', raw_data)
+        self.assertIsInstance(raw_data['Products'], ColumnarTable)
+        self.assertIsInstance(raw_data['Products'].pks, numpy.memmap)
+
+        index = get_dataset().indexes['Products']['shop_id']
+        self.assertIsInstance(index, ColumnIndex)
+        self.assertIsInstance(index.positions, numpy.memmap)
+
+        index = get_dataset().sorted_indexes['Shops']['lat']
+        self.assertIsInstance(index, SortedIndex)
+        self.assertIsInstance(index.keys, numpy.memmap)
+
+        PRODUCT_ID = 'e4ce888809454e80a49adec1de0b35a5'
+        product = Products().objects.get(PRODUCT_ID)
+        self.assertEqual(product.id, PRODUCT_ID)
+
+        # The k-d tree is built again, nothing is unpickled
+        self.assertEqual(
+            [i for i in os.listdir(self.snapshot_path)
+             if i.endswith('.pickle')],
+            []
+        )
+
+        search = get_search()
+        points = search.get_points(
+            latitude=59.338298666466834,
+            longitude=18.11972347031265,
+            max_locations=10
+        )
+        self.assertEqual(len(points), 10)
+
+        for shop in search.get_nearby_shops(points):
+            self.assertIsInstance(shop, Shops)
+
+        # The arrays of the searches are mapped, not the models of the shops
+        self.assertIsInstance(search.shop_ids, numpy.memmap)
+        self.assertFalse(search.get_ckdtree().data.flags.owndata)
+        self.assertIsInstance(get_tag_search().masks['men'], numpy.memmap)
+
+    def test_load_or_build_snapshot(self):
+        load_or_build_snapshot(self.snapshot_path)
+
+        self.assertFalse(is_snapshot_stale(self.snapshot_path))
+        self.assertIsInstance(
+            get_dataset().raw_data['Shops'],
+            ColumnarTable
+        )
+
+    def test_build_snapshot_loaded(self):
+        load_snapshot(self.snapshot_path)
+        manager = Products().objects
+        PRODUCT_ID = 'e4ce888809454e80a49adec1de0b35a5'
+
+        build_snapshot(self.snapshot_path)
+
+        self.assertEqual(manager.get(PRODUCT_ID).id, PRODUCT_ID)
+        self.assertEqual(self.get_leftovers(), [])
+        self.assertFalse(is_snapshot_stale(self.snapshot_path))
+
+    def test_build_snapshot_concurrently(self):
+        threads = [
+            threading.Thread(target=build_snapshot,
+                             args=(self.snapshot_path, ))
+            for i in range(3)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.get_leftovers(), [])
+        self.assertFalse(is_snapshot_stale(self.snapshot_path))
+
+        load_snapshot(self.snapshot_path)
+        self.assertIsInstance(get_dataset().raw_data['Shops'], ColumnarTable)
+
+    def get_leftovers(self):
+        """
+        :returns: Files next to the snapshot, other than its lock files.
+        :rtype: list of str
+        """
+        name = os.path.basename(self.snapshot_path)
+        lock_files = (name + LOCK_SUFFIX, name + BUILD_LOCK_SUFFIX)
+
+        return [
+            i for i in os.listdir(os.path.dirname(self.snapshot_path))
+            if i.startswith(name + '.') and i not in lock_files
+        ]
+
+    def test_open_or_build_snapshot_concurrently(self):
+        parent_path = tempfile.mkdtemp()
+        snapshot_path = join(parent_path, 'snapshot')
+        builds = []
+
+        def build_snapshot(*args):
+            builds.append(args)
+            original(*args)
+
+        original = snapshot.build_snapshot
+        snapshot.build_snapshot = build_snapshot
+        datasets = []
+
+        try:
+            threads = [
+                threading.Thread(
+                    target=lambda: datasets.append(
+                        open_or_build_snapshot(snapshot_path)
+                    )
+                )
+                for i in range(3)
+            ]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+        finally:
+            snapshot.build_snapshot = original
+            shutil.rmtree(parent_path)
+
+        # One of them has built it, the others have opened it
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(len(datasets), 3)
+
+    def test_import_loads_nothing(self):
+        output = subprocess.check_output([
+            sys.executable,
+            '-c',
+            'import server.app, server.models; '
+            'print len(server.models.get_dataset().raw_data)'
+        ])
+
+        self.assertEqual(output.strip(), '0')
+
+    def test_snapshot_start(self):
+        def read_data(data_path=None):
+            raise AssertionError('The CSV files are read')
+
+        originals = utils.read_data, snapshot.read_data
+        utils.read_data = snapshot.read_data = read_data
+
+        try:
+            create_app(settings_overrides={
+                'TESTING': True,
+                'SNAPSHOT_PATH': self.snapshot_path
+            })
+        finally:
+            utils.read_data, snapshot.read_data = originals
+
+        self.assertIsInstance(
+            get_dataset().raw_data['Products'],
+            ColumnarTable
+        )
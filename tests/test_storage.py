@@ -0,0 +1,334 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+
+from server import exceptions, models
+from server.models import (Dataset, ModelObjectManager, Tags, Products, Shops,
+                           Taggings, get_dataset, set_dataset)
+from server.storage import (ColumnarTable, ColumnIndex, SortedIndex,
+                            get_range_bounds)
+from server.utils import build_indexes, build_sorted_indexes, load_data
+
+
+class TestColumnarTable(TestCase):
+    def setUp(self):
+        self.table = ColumnarTable.from_rows({
+            'c': {'name': 'wine', 'age': '2000', 'weight': '1.5'},
+            'a': {'name': 'me', 'age': '42', 'weight': '80.2'},
+            'b': {'name': 'you', 'age': '23', 'weight': 'heavy'}
+        })
+
+    def test_from_rows(self):
+        table = self.table
+
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(table), ['a', 'b', 'c'])
+        self.assertEqual(
+            sorted(table.get_field_names()),
+            ['age', 'id', 'name', 'weight']
+        )
+        self.assertEqual(table.columns['age'].dtype, numpy.int64)
+        self.assertIn('name', table.categories)
+        self.assertIn('weight', table.categories)
+
+    def test_from_rows_schema(self):
+        table = ColumnarTable.from_rows({
+            'a': {'zip': '01234', 'age': '42', 'weight': '80'},
+            'b': {'zip': '56789', 'age': '23', 'weight': '61'}
+        }, (('id', str), ('zip', str), ('age', int), ('weight', float)))
+
+        self.assertIn('zip', table.categories)
+        self.assertEqual(table['a']['zip'], '01234')
+        self.assertEqual(table.columns['age'].dtype, numpy.int64)
+        self.assertEqual(table.columns['weight'].dtype, numpy.float64)
+
+    def test_get_numeric_column(self):
+        column = ColumnarTable.get_numeric_column(['1.5', '2'])
+
+        self.assertEqual(column.dtype, numpy.float64)
+        self.assertIsNone(ColumnarTable.get_numeric_column(['1', 'x']))
+        self.assertEqual(
+            ColumnarTable.get_numeric_column([1.0, 0.5]).dtype,
+            numpy.float64
+        )
+        self.assertEqual(
+            ColumnarTable.get_numeric_column([1, 2]).dtype,
+            numpy.int64
+        )
+
+    def test_getitem(self):
+        table = self.table
+
+        self.assertEqual(
+            table['a'],
+            {'id': 'a', 'name': 'me', 'age': 42, 'weight': '80.2'}
+        )
+        self.assertIn('c', table)
+        self.assertNotIn('d', table)
+
+        with self.assertRaises(KeyError):
+            table['d']
+
+    def test_get_positions(self):
+        table = self.table
+
+        positions = table.get_positions([('name', 'in', ['me', 'wine'])])
+        self.assertEqual(list(positions), [0, 2])
+
+        positions = table.get_positions([
+            ('name', 'in', ['me', 'wine', 'nope']),
+            ('age', 'exact', 2000)
+        ])
+        self.assertEqual(list(positions), [2])
+
+        positions = table.get_positions([('age', 'exact', 'old')])
+        self.assertEqual(list(positions), [])
+
+        positions = table.get_positions([('id', 'in', ['b', 'd'])])
+        self.assertEqual(list(positions), [1])
+
+        positions = table.get_positions(
+            [('name', 'in', ['me', 'you'])],
+            numpy.array([2, 1])
+        )
+        self.assertEqual(list(positions), [1])
+
+        positions = table.get_positions([('age', 'range', (23, 42))])
+        self.assertEqual(list(positions), [0, 1])
+
+        positions = table.get_positions([
+            ('name', 'gt', 'me'),
+            ('age', 'lt', 2000)
+        ])
+        self.assertEqual(list(positions), [1])
+
+    def test_get_positions_not_fitting(self):
+        table = self.table
+
+        # Values wider than the column aren't truncated to match
+        for value in ('wineyard', u'w\xefne', 80):
+            positions = table.get_positions([('name', 'in', [value])])
+            self.assertEqual(list(positions), [], value)
+
+        positions = table.get_positions([('age', 'exact', 42.5)])
+        self.assertEqual(list(positions), [])
+
+        positions = table.get_positions([('name', 'in', ['wineyard', 'me'])])
+        self.assertEqual(list(positions), [0])
+
+
+class TestColumnIndex(TestCase):
+    def setUp(self):
+        self.table = ColumnarTable.from_rows({
+            'a': {'name': 'me', 'age': '42'},
+            'b': {'name': 'you', 'age': '23'},
+            'c': {'name': 'me', 'age': '2000'},
+            'd': {'name': 'wine', 'age': '23'}
+        })
+
+    def test_build(self):
+        index = ColumnIndex.build(self.table, 'name', 'age', True)
+
+        self.assertEqual(sorted(index), ['me', 'wine', 'you'])
+        self.assertEqual(index['me'], ['c', 'a'])
+        self.assertEqual(index['you'], ['b'])
+        self.assertEqual(index.get('nope', []), [])
+        self.assertIn('wine', index)
+        self.assertNotIn('nope', index)
+
+        index = ColumnIndex.build(self.table, 'age')
+
+        self.assertEqual(sorted(index[23]), ['b', 'd'])
+        self.assertNotIn('old', index)
+
+    def test_get_positions(self):
+        index = ColumnIndex.build(self.table, 'name', 'age', True)
+
+        self.assertEqual(list(index.get_positions(['me', 'nope'])), [2, 0])
+        self.assertEqual(list(index.get_positions(['you', 'wine'])), [1, 3])
+        self.assertEqual(list(index.get_positions([])), [])
+
+    def test_get_codes(self):
+        index = ColumnIndex.build(self.table, 'name', 'age', True)
+
+        self.assertEqual(list(index.get_codes(['you', 'nope', 'me'])),
+                         [2, 0])
+        self.assertEqual(list(index.get_codes([])), [])
+
+        index = ColumnIndex.build(self.table, 'age')
+        self.assertEqual(list(index.get_codes([2000, 'old', 23])), [2, 0])
+
+    def test_get_codes_not_fitting(self):
+        index = ColumnIndex.build(self.table, 'name')
+
+        self.assertEqual(list(index.get_codes(['wineyard', u'w\xefne'])), [])
+        self.assertEqual(list(index.get_positions(['youth', 'you'])), [1])
+        self.assertNotIn('wineyard', index)
+        self.assertNotIn(u'w\xefne', index)
+        self.assertIn(u'wine', index)
+
+        index = ColumnIndex.build(self.table, 'age')
+        self.assertNotIn(23.5, index)
+        self.assertEqual(index[23.0], ['b', 'd'])
+
+    def test_save_open(self):
+        path = tempfile.mkdtemp()
+        ColumnIndex.build(self.table, 'name', 'age').save(path, 'name')
+        index = ColumnIndex.open(self.table, path, 'name')
+        shutil.rmtree(path)
+
+        self.assertEqual(index['me'], ['a', 'c'])
+
+
+class TestSortedIndex(TestCase):
+    def setUp(self):
+        self.index = SortedIndex.build(
+            numpy.array([3.0, 1.0, 2.0, 2.0, 5.0]),
+            numpy.array(['a', 'b', 'c', 'd', 'e'])
+        )
+
+    def test_get_keys(self):
+        index = self.index
+
+        self.assertEqual(list(index.get_keys('gt', 2)), ['a', 'e'])
+        self.assertEqual(list(index.get_keys('gte', 2)), ['c', 'd', 'a', 'e'])
+        self.assertEqual(list(index.get_keys('lt', 2)), ['b'])
+        self.assertEqual(list(index.get_keys('lte', 2)), ['b', 'c', 'd'])
+        self.assertEqual(list(index.get_keys('range', (2, 3))),
+                         ['c', 'd', 'a'])
+        self.assertEqual(list(index.get_keys('range', (4, 3))), [])
+        self.assertEqual(list(index.get_keys('gt', 5)), [])
+
+    def test_save_open(self):
+        path = tempfile.mkdtemp()
+        self.index.save(path, 'age')
+        index = SortedIndex.open(path, 'age')
+
+        self.assertEqual(list(index.get_keys('lt', 3)), ['b', 'c', 'd'])
+        shutil.rmtree(path)
+
+    def test_get_range_bounds(self):
+        self.assertEqual(get_range_bounds('gt', 1), (1, None, False, True))
+        self.assertEqual(get_range_bounds('lte', 1), (None, 1, True, True))
+        self.assertEqual(get_range_bounds('range', (1, 2)),
+                         (1, 2, True, True))
+
+
+class TestColumnarModelObjectManager(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        load_data()
+
+    def setUp(self):
+        self.dataset = get_dataset()
+        raw_data = dict(
+            (k, ColumnarTable.from_rows(v, getattr(models, k).schema))
+            for k, v in self.dataset.raw_data.items()
+        )
+        set_dataset(Dataset(
+            raw_data,
+            build_indexes(raw_data),
+            build_sorted_indexes(raw_data)
+        ))
+
+    def tearDown(self):
+        set_dataset(self.dataset)
+
+    def test_merge(self):
+        manager = ModelObjectManager(Products())
+        shop_ids = list(set(
+            shop_id for shop_id, in manager.values_list('shop_id')
+        ))[0:20]
+        expected = manager.filter(
+            {'shop_id__in': shop_ids},
+            ('popularity', ModelObjectManager.SORT_BY_DESCENDING)
+        )
+
+        products = manager.merge('shop_id', shop_ids, 10)
+
+        self.assertEqual(
+            [i.popularity for i in products],
+            [i.popularity for i in expected[0:10]]
+        )
+
+        products = list(manager.iter_merge('shop_id', shop_ids + ['nope']))
+
+        self.assertEqual(
+            [i.popularity for i in products],
+            [i.popularity for i in expected]
+        )
+        self.assertEqual(sorted(i.id for i in products),
+                         sorted(i.id for i in expected))
+
+    def test_merge_ordering(self):
+        raw_data = get_dataset().raw_data
+        shop_ids = [shop_id for shop_id, in
+                    ModelObjectManager(Taggings()).values_list('shop_id')]
+        shop_ids = shop_ids[0:50]
+
+        # Not ordered, or by the codes of a categorical column
+        for ordering in (None,
+                         ('tag_id', ModelObjectManager.SORT_BY_ASCENDING),
+                         ('tag_id', ModelObjectManager.SORT_BY_DESCENDING)):
+            Taggings.ordering = ordering
+
+            try:
+                manager = ModelObjectManager(
+                    Taggings(),
+                    Dataset(raw_data, build_indexes(raw_data))
+                )
+                taggings = manager.merge('shop_id', shop_ids, 1000)
+            finally:
+                Taggings.ordering = None
+
+            expected = manager.filter({'shop_id__in': shop_ids})
+            self.assertEqual(sorted(i.id for i in taggings),
+                             sorted(i.id for i in expected))
+
+            if ordering:
+                tag_ids = [i.tag_id for i in taggings]
+                self.assertEqual(tag_ids, sorted(
+                    tag_ids,
+                    reverse=ordering[1] == manager.SORT_BY_DESCENDING
+                ))
+
+    def test_filter(self):
+        manager = ModelObjectManager(Tags())
+
+        with self.assertRaises(exceptions.LookupIsNotAllowed):
+            manager.filter({'tag__miow': 'oik'})
+
+        tags = manager.filter({'tag__in': ['trousers', 'plates', 'nope'],
+                               'id__in': [i.id for i in manager.all()]})
+
+        self.assertEqual(len(tags), 2)
+        self.assertEqual(
+            sorted(i.tag for i in tags),
+            ['plates', 'trousers']
+        )
+
+    def test_filter_range(self):
+        manager = ModelObjectManager(Shops())
+        shops = manager.all()
+        filters = {'lat__range': (59.33, 59.34), 'lng__gt': 18.07}
+        expected = [i.id for i in shops
+                    if 59.33 <= i.lat <= 59.34 and i.lng > 18.07]
+
+        self.assertIsInstance(
+            manager.get_sorted_indexes()['lat'].keys,
+            numpy.ndarray
+        )
+        self.assertEqual(
+            sorted(i.id for i in manager.filter(filters)),
+            sorted(expected)
+        )
+
+    def test_get(self):
+        PRODUCT_ID = 'e4ce888809454e80a49adec1de0b35a5'
+        product = Products().objects.get(PRODUCT_ID)
+
+        self.assertEqual(product.id, PRODUCT_ID)
+        self.assertIsInstance(product.popularity, float)
+        self.assertIsInstance(product.shop.lat, float)
@@ -0,0 +1,124 @@
+import threading
+import time
+from unittest import TestCase
+
+from server import utils
+from server.utils import LRUCache, get_cash
+
+
+class TestLRUCache(TestCase):
+    def test_get_set(self):
+        cache = LRUCache()
+
+        self.assertIsNone(cache.get('miow'))
+        self.assertTrue(cache.set('miow', {'oik': [1, 2]}))
+        self.assertEqual(cache.get('miow'), {'oik': [1, 2]})
+        self.assertFalse(cache.add('miow', 'oik'))
+
+        self.assertTrue(cache.set('expired', 'oik', timeout=-1))
+        self.assertIsNone(cache.get('expired'))
+
+        self.assertTrue(cache.delete('miow'))
+        self.assertFalse(cache.delete('miow'))
+        self.assertIsNone(cache.get('miow'))
+        self.assertEqual(cache.get_size(), 0)
+
+    def test_get_namespace(self):
+        cache = LRUCache()
+
+        self.assertEqual(cache.get_namespace('search.abc'), 'search')
+        self.assertEqual(cache.get_namespace('abc'), 'default')
+
+    def test_max_size(self):
+        value = 'x' * 100
+        cache = LRUCache(max_size=350)
+
+        for i in range(3):
+            cache.set('a.{0}'.format(i), value)
+        cache.get('a.0')
+        cache.set('b.0', value)
+
+        self.assertLessEqual(cache.get_size(), 350)
+        self.assertIsNotNone(cache.get('a.0'))
+        self.assertIsNone(cache.get('a.1'))
+        self.assertIsNotNone(cache.get('b.0'))
+
+        self.assertFalse(cache.set('a.big', 'x' * 400))
+
+    def test_quotas(self):
+        value = 'x' * 100
+        cache = LRUCache(max_size=1000, quotas={'a': 250})
+
+        for i in range(5):
+            cache.set('a.{0}'.format(i), value)
+        cache.set('b.0', value)
+
+        stats = cache.get_stats()
+
+        self.assertEqual(stats['a']['items'], 2)
+        self.assertLessEqual(stats['a']['size'], 250)
+        self.assertEqual(stats['a']['evictions'], 3)
+        self.assertEqual(stats['b']['items'], 1)
+        self.assertEqual(stats['b']['evictions'], 0)
+
+    def test_get_stats(self):
+        cache = LRUCache()
+        cache.get('a.miow')
+        cache.set('a.miow', 'oik')
+        cache.get('a.miow')
+        cache.get('a.miow')
+
+        stats = cache.get_stats()['a']
+
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['items'], 1)
+        self.assertGreater(stats['size'], 0)
+
+
+class TestGetCash(TestCase):
+    def setUp(self):
+        utils.cache.clear()
+
+    def test_get_cash(self):
+        self.assertIsNone(get_cash('miow'))
+        self.assertEqual(get_cash('miow', default_value='oik'), 'oik')
+        self.assertIsNone(utils.cache.get('miow'))
+
+        self.assertEqual(get_cash('miow', new_value='oik'), 'oik')
+        self.assertEqual(get_cash('miow', new_value='new oik'), 'oik')
+
+    def test_get_cash_callable(self):
+        calls = []
+
+        def factory():
+            calls.append(1)
+            return 'oik'
+
+        self.assertEqual(get_cash('miow', new_value=factory), 'oik')
+        self.assertEqual(get_cash('miow', new_value=factory), 'oik')
+        self.assertEqual(len(calls), 1)
+
+        self.assertIsNone(get_cash('none', new_value=lambda: None))
+        self.assertIsNone(utils.cache.get('none'))
+
+    def test_get_cash_single_flight(self):
+        calls = []
+        results = []
+
+        def factory():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'oik'
+
+        def get():
+            results.append(get_cash('miow', new_value=factory))
+
+        threads = [threading.Thread(target=get) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['oik'] * 5)